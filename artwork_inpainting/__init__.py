@@ -0,0 +1,45 @@
+'''
+Tooling around the Colab training scripts of this repository (benchmarks, sweeps, inference helpers).
+
+The model classes themselves still live in the top level scripts, they are pulled out of them with
+artwork_inpainting.loader so none of the scripts' top level work (unzipping, mask generation, dataset copying) runs.
+
+Importing the package does no work : the names below are resolved on first access, torch and the script definitions
+are only loaded when a model class, build_model() or inpaint() is used (python -m artwork_inpainting.startup_benchmark
+checks the cold start times).
+
+  import artwork_inpainting
+  restored = artwork_inpainting.inpaint('scan.png', 'damage.png', checkpoint='model.pth', mode='crop')
+'''
+
+# public name : (module, attribute) for the functions, (script, class) for the model classes
+_FUNCTIONS = {'inpaint':('artwork_inpainting.inference', 'inpaint'),
+              'build_model':('artwork_inpainting.loader', 'build_model'),
+              'load_script':('artwork_inpainting.loader', 'load_script'),
+              'MODEL_SPECS':('artwork_inpainting.loader', 'MODEL_SPECS')}
+_MODEL_CLASSES = {'UNet':('unet', 'UNet'),
+                  'PartialConvUNet':('pconv', 'PartialConvUNet'),
+                  'ResNetUNet':('resnet', 'ResNetUNet')}
+
+__all__ = list(_FUNCTIONS) + list(_MODEL_CLASSES)
+
+
+def __getattr__(name):
+  import importlib
+
+  if name in _FUNCTIONS:
+    module, attr = _FUNCTIONS[name]
+    value = getattr(importlib.import_module(module), attr)
+  elif name in _MODEL_CLASSES:
+    from artwork_inpainting.loader import load_script
+
+    script, attr = _MODEL_CLASSES[name]
+    value = getattr(load_script(script), attr)
+  else:
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+  globals()[name] = value # resolved once
+  return value
+
+
+def __dir__():
+  return sorted(list(globals()) + __all__)
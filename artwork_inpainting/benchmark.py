@@ -0,0 +1,251 @@
+'''
+Throughput / latency / memory benchmark of the inpainting architectures on CPU.
+
+Every (model, batch size, resolution, thread count) configuration is measured in its own spawned process, so that
+torch.set_num_threads() and the peak resident memory (ru_maxrss) are not shared between configurations. Results are
+written to a json file which can be compared with a previous run to spot performance regressions:
+
+  python -m artwork_inpainting.benchmark --models unet pconv_unet --batch-sizes 1 8 --output bench.json
+  python -m artwork_inpainting.benchmark --output new.json --compare bench.json
+'''
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import multiprocessing as mp
+from queue import Empty
+
+from artwork_inpainting.loader import MODEL_SPECS, build_model, make_inputs
+
+CONFIG = {'models':list(MODEL_SPECS),
+          'batch_sizes':[1, 8, 32],
+          'resolutions':[128, 256],
+          'threads':[1, os.cpu_count()],
+          'modes':['forward', 'forward_backward'],
+          'warmup':3,
+          'iters':10,
+          'channels_last':[False], # memory formats to run, [False, True] compares NCHW with channels last
+          'regression_tolerance':0.1, # relative slow down flagged as a regression by compare_results()
+          'output':'benchmark_results.json'}
+
+
+def percentile(values, q):
+  '''
+  Linearly interpolated percentile of a list of values, q in [0, 100].
+  '''
+  values = sorted(values)
+  k = (len(values) - 1) * q / 100
+  lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+  return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def peak_rss_mb():
+  # ru_maxrss is in kilobytes on linux and in bytes on macOS
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+def measure(fn, warmup=CONFIG['warmup'], iters=CONFIG['iters'], items=1):
+  '''
+  Time a callable and return its latency statistics.
+
+  fn : callable to time, called without arguments
+  warmup : number of untimed calls made first (allocator and oneDNN primitive caches warm up)
+  iters : number of timed calls
+  items : number of images processed by one call, used for the throughput
+  '''
+  for _ in range(warmup):
+    fn()
+
+  latencies = []
+  for _ in range(iters):
+    start = time.perf_counter()
+    fn()
+    latencies.append(time.perf_counter() - start)
+
+  mean = statistics.mean(latencies)
+  return {'latency_mean_ms':1000 * mean,
+          'latency_p50_ms':1000 * percentile(latencies, 50),
+          'latency_p90_ms':1000 * percentile(latencies, 90),
+          'latency_p99_ms':1000 * percentile(latencies, 99),
+          'images_per_sec':items / mean}
+
+
+def run_config(model_name, batch_size, resolution, threads, modes, warmup, iters, prepare=None, channels_last=False):
+  '''
+  Benchmark one configuration in the current process and return a list of result dictionaries (one per mode).
+
+  prepare : optional callable model -> model applied before timing (e.g. BatchNorm folding)
+  channels_last : run the model weights and inputs in torch.channels_last memory format
+  '''
+  import torch
+
+  torch.set_num_threads(threads)
+  torch.manual_seed(0)
+
+  model = build_model(model_name)
+  if prepare is not None:
+    model = prepare(model)
+  if channels_last:
+    model = model.to(memory_format=torch.channels_last)
+  inputs = make_inputs(model_name, batch_size, resolution, channels_last=channels_last)
+  rss_model = peak_rss_mb()
+
+  results = []
+  for mode in modes:
+    if mode == 'forward':
+      model.eval()
+
+      @torch.no_grad()
+      def step():
+        model(*inputs)
+
+    else:
+      model.train()
+
+      def step():
+        output = model(*inputs)
+        output.float().mean().backward()
+        model.zero_grad(set_to_none=True)
+
+    stats = measure(step, warmup, iters, items=batch_size)
+    stats.update({'model':model_name, 'mode':mode, 'batch_size':batch_size, 'resolution':resolution,
+                  'threads':threads, 'channels_last':channels_last, 'model_rss_mb':rss_model,
+                  'peak_rss_mb':peak_rss_mb()})
+    results.append(stats)
+  return results
+
+
+def _worker(queue, fn, args):
+  try:
+    queue.put(fn(*args))
+  except Exception as e: # report out of memory / unsupported shapes instead of killing the whole run
+    queue.put({'error':f'{type(e).__name__}: {e}'})
+
+
+def run_isolated(fn, *args):
+  '''
+  Call fn(*args) in a freshly spawned process and return its result, or {'error': message} if it failed.
+  fn must be a module level function so that it can be pickled.
+  '''
+  ctx = mp.get_context('spawn')
+  queue = ctx.Queue()
+  process = ctx.Process(target=_worker, args=(queue, fn, args))
+  process.start()
+  while True:
+    try:
+      result = queue.get(timeout=1)
+      break
+    except Empty:
+      if not process.is_alive(): # killed (e.g. by the OOM killer) before reporting anything
+        result = {'error':f'worker exited with code {process.exitcode}'}
+        break
+  process.join()
+  return result
+
+
+def environment():
+  import torch
+
+  try:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+  except OSError:
+    commit = ''
+  return {'torch':torch.__version__, 'python':platform.python_version(), 'platform':platform.platform(),
+          'processor':platform.processor(), 'cpu_count':os.cpu_count(), 'commit':commit,
+          'time':time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run_benchmark(models=CONFIG['models'], batch_sizes=CONFIG['batch_sizes'], resolutions=CONFIG['resolutions'],
+                  threads=CONFIG['threads'], modes=CONFIG['modes'], warmup=CONFIG['warmup'], iters=CONFIG['iters'],
+                  channels_last=CONFIG['channels_last'], verbose=True):
+  results = []
+  for model_name in models:
+    for batch_size in batch_sizes:
+      for resolution in resolutions:
+        for n_threads in sorted(set(threads)):
+          for cl in channels_last:
+            config_results = run_isolated(run_config, model_name, batch_size, resolution, n_threads, modes, warmup,
+                                          iters, None, cl)
+            if isinstance(config_results, dict):
+              config_results = [{'model':model_name, 'batch_size':batch_size, 'resolution':resolution,
+                                 'threads':n_threads, 'channels_last':cl, **config_results}]
+            for result in config_results:
+              results.append(result)
+              if verbose:
+                print(format_result(result))
+  return {'environment':environment(), 'results':results}
+
+
+def format_result(result):
+  head = (f"{result['model']:>26} bs={result['batch_size']:<3} res={result['resolution']:<4} threads={result['threads']:<3}"
+          f"{' NHWC' if result.get('channels_last') else ' NCHW'}")
+  if 'error' in result:
+    return f"{head} ERROR {result['error']}"
+  return (f"{head} {result['mode']:>16} : {result['images_per_sec']:9.2f} img/s  p50 {result['latency_p50_ms']:9.2f} ms"
+          f"  p99 {result['latency_p99_ms']:9.2f} ms  peak {result['peak_rss_mb']:8.1f} MB")
+
+
+def _key(result):
+  # results written before the channels last option are NCHW
+  return (result['model'], result.get('mode'), result['batch_size'], result['resolution'], result['threads'],
+          result.get('channels_last', False))
+
+
+def compare_results(new, old, tolerance=CONFIG['regression_tolerance']):
+  '''
+  Compare two benchmark outputs and return the configurations whose throughput dropped by more than `tolerance`.
+  '''
+  old_results = {_key(r):r for r in old['results'] if 'error' not in r}
+  regressions = []
+  for result in new['results']:
+    previous = old_results.get(_key(result))
+    if previous is None or 'error' in result:
+      continue
+    change = result['images_per_sec'] / previous['images_per_sec'] - 1
+    if change < -tolerance:
+      regressions.append({'config':_key(result), 'old_images_per_sec':previous['images_per_sec'],
+                          'new_images_per_sec':result['images_per_sec'], 'change':change})
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--models', nargs='+', default=CONFIG['models'], choices=list(MODEL_SPECS))
+  parser.add_argument('--batch-sizes', nargs='+', type=int, default=CONFIG['batch_sizes'])
+  parser.add_argument('--resolutions', nargs='+', type=int, default=CONFIG['resolutions'])
+  parser.add_argument('--threads', nargs='+', type=int, default=CONFIG['threads'])
+  parser.add_argument('--modes', nargs='+', default=CONFIG['modes'], choices=CONFIG['modes'])
+  parser.add_argument('--warmup', type=int, default=CONFIG['warmup'])
+  parser.add_argument('--iters', type=int, default=CONFIG['iters'])
+  parser.add_argument('--channels-last', nargs='+', type=lambda v: v.lower() in ('1', 'true', 'yes'),
+                      default=CONFIG['channels_last'], help='memory formats to run, e.g. --channels-last false true')
+  parser.add_argument('--output', default=CONFIG['output'])
+  parser.add_argument('--compare', help='previous benchmark json, regressions are reported and make the exit code 1')
+  args = parser.parse_args(argv)
+
+  report = run_benchmark(args.models, args.batch_sizes, args.resolutions, args.threads, args.modes, args.warmup,
+                         args.iters, args.channels_last)
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f'results written to {args.output}')
+
+  if args.compare:
+    with open(args.compare) as f:
+      regressions = compare_results(report, json.load(f))
+    for r in regressions:
+      print(f"REGRESSION {r['config']} : {r['old_images_per_sec']:.2f} -> {r['new_images_per_sec']:.2f} img/s "
+            f"({100 * r['change']:.1f}%)")
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,147 @@
+'''
+Channels last (NHWC) mode of the models and audit of the ops that silently convert it back to NCHW.
+
+oneDNN convolutions run natively on channels last tensors, NCHW ones are reordered before and after every convolution.
+to_channels_last() converts a model (and make_inputs(..., channels_last=True) the inputs); the training scripts do the
+same with CONFIG['channels_last']. The benefit is lost as soon as one op returns an NCHW tensor from channels last
+inputs (every following convolution then pays the reorders again), which nothing reports : layout_audit() runs a
+forward (and backward) pass under a dispatch mode that looks at the strides of every aten op input and output and
+lists the ops, with the module they ran in, whose output left channels last.
+
+  python -m artwork_inpainting.channels_last --models unet pconv_unet resnet_unet --batch-size 8
+'''
+
+import argparse
+from collections import Counter
+
+import torch
+from torch.utils._pytree import tree_flatten
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from artwork_inpainting.benchmark import run_config, run_isolated
+from artwork_inpainting.loader import MODEL_SPECS, build_model, make_inputs
+
+CONFIG = {'models':['unet', 'unet_inception', 'pconv_unet', 'resnet_unet'],
+          'batch_size':8,
+          'resolution':128,
+          'threads':4,
+          'modes':['forward', 'forward_backward'],
+          'warmup':2,
+          'iters':10}
+
+
+def to_channels_last(model):
+  return model.to(memory_format=torch.channels_last)
+
+
+def layout(tensor):
+  '''
+  'channels_last', 'nchw', 'both' (one channel or 1x1 spatial size, the strides satisfy both formats) or 'strided' for a
+  4d tensor, None otherwise.
+  '''
+  if not isinstance(tensor, torch.Tensor) or tensor.dim() != 4:
+    return None
+  channels_last = tensor.is_contiguous(memory_format=torch.channels_last)
+  nchw = tensor.is_contiguous()
+  if channels_last and nchw:
+    return 'both'
+  return 'channels_last' if channels_last else 'nchw' if nchw else 'strided'
+
+
+class _LayoutAudit(TorchDispatchMode):
+  def __init__(self, module_stack):
+    super().__init__()
+    self.module_stack = module_stack
+    self.conversions = Counter()
+    self.ops = 0
+
+  def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+    out = func(*args, **(kwargs or {}))
+    if getattr(func, 'is_view', False): # views only reinterpret strides, whatever reads them is what counts
+      return out
+    self.ops += 1
+    inputs = [layout(t) for t in tree_flatten((args, kwargs))[0]]
+    outputs = [layout(t) for t in tree_flatten(out)[0]]
+    if 'channels_last' in inputs and any(o in ('nchw', 'strided') for o in outputs):
+      where = self.module_stack[-1] if self.module_stack else 'backward'
+      self.conversions[(where, str(func.overloadpacket), ','.join(o for o in outputs if o))] += 1
+    return out
+
+
+def layout_audit(model, inputs, backward=True):
+  '''
+  Run model(*inputs) (and a backward pass) and return the ops whose output is not channels last while one of their
+  inputs is : a list of {'module', 'op', 'output_layout', 'count'}, the module being the innermost module the op ran in
+  ('backward' for the ops of the backward pass), together with the total number of ops.
+  '''
+  module_stack = []
+  handles = []
+
+  def leave(module, args, output):
+    module_stack.pop() # a forward hook returning a value would replace the module output
+
+  for name, module in model.named_modules():
+    name = name or type(model).__name__
+    handles.append(module.register_forward_pre_hook(lambda m, args, name=name: module_stack.append(name)))
+    handles.append(module.register_forward_hook(leave))
+
+  audit = _LayoutAudit(module_stack)
+  try:
+    with audit:
+      output = model(*inputs)
+      if backward:
+        output.float().mean().backward()
+  finally:
+    for handle in handles:
+      handle.remove()
+  model.zero_grad(set_to_none=True)
+
+  report = [{'module':module, 'op':op, 'output_layout':out, 'count':count}
+            for (module, op, out), count in audit.conversions.most_common()]
+  return {'conversions':report, 'ops':audit.ops}
+
+
+def audit_model(model_name, batch_size, resolution, backward=True):
+  torch.manual_seed(0)
+  model = to_channels_last(build_model(model_name))
+  model.train(backward)
+  return layout_audit(model, make_inputs(model_name, batch_size, resolution, channels_last=True), backward)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--models', nargs='+', default=CONFIG['models'], choices=list(MODEL_SPECS))
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--resolution', type=int, default=CONFIG['resolution'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  parser.add_argument('--modes', nargs='+', default=CONFIG['modes'], choices=CONFIG['modes'])
+  parser.add_argument('--warmup', type=int, default=CONFIG['warmup'])
+  parser.add_argument('--iters', type=int, default=CONFIG['iters'])
+  parser.add_argument('--no-audit', action='store_true')
+  args = parser.parse_args(argv)
+
+  for name in args.models:
+    if not args.no_audit:
+      audit = run_isolated(audit_model, name, 2, args.resolution, 'forward_backward' in args.modes)
+      if 'error' in audit:
+        print(f"{name} audit : ERROR {audit['error']}")
+      else:
+        print(f"{name} audit : {sum(c['count'] for c in audit['conversions'])} layout conversions in {audit['ops']} ops")
+        for c in audit['conversions']:
+          print(f"  {c['count']:4d} x {c['op']:<36} -> {c['output_layout']:<14} in {c['module']}")
+
+    results = {}
+    for channels_last in [False, True]:
+      r = run_isolated(run_config, name, args.batch_size, args.resolution, args.threads, args.modes, args.warmup,
+                       args.iters, None, channels_last)
+      results[channels_last] = {'error':r['error']} if 'error' in r else {x['mode']:x for x in r}
+    if any('error' in r for r in results.values()):
+      print(f"{name} benchmark : ERROR {[r['error'] for r in results.values() if 'error' in r][0]}")
+      continue
+    for mode in args.modes:
+      nchw, nhwc = results[False][mode]['latency_mean_ms'], results[True][mode]['latency_mean_ms']
+      print(f"{name:>26} {mode:>16} : NCHW {nchw:8.1f} ms  channels last {nhwc:8.1f} ms  (x{nchw / nhwc:.2f})")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,356 @@
+'''
+Analytic FLOP, parameter and activation memory count of the models, without a forward pass.
+
+torchsummary.summary() runs a forward pass at a fixed size and reports neither FLOPs nor activation memory. model_cost()
+walks the model structure instead and propagates the shapes layer by layer with a cost formula per layer type :
+
+  Conv2d / ConvTranspose2d   2 x MACs (+ the bias additions), MACs = outputs x in_channels / groups x kernel area
+  PartialConv                input x mask product, the convolution, the mask update (channel max + box filter) and the
+                             hole fill
+  InceptionModule            the four branches (or the merged projection and the branches) and the concatenation
+  ResidualUnit               conv1, conv2, the strided skip convolution of the first unit, the addition and activation
+  Upsample                   0 FLOP per output for nearest, 7 for bilinear
+  BatchNorm2d / activations  2 / 1 FLOP per element (4 for sigmoid, tanh, elu, gelu), in place ones keep no output
+  MaxPool2d                  kernel area - 1 comparisons per output
+
+The model is built on the meta device, so no memory is allocated whatever its size. Per layer the output activation
+bytes are reported; the totals are the FLOPs, the parameters actually used by the forward (the UNets also build their
+inception modules when add_inception is False), the activations kept for the backward pass (every non in place
+output) and the peak of the live activations during an inference forward (layer input and output plus the skip
+connections and branch outputs waiting to be concatenated).
+
+  python -m artwork_inpainting.cost_model --models unet unet_small pconv_unet resnet_unet --resolution 512 --layers
+'''
+
+import math
+import json
+import argparse
+
+from artwork_inpainting.loader import MODEL_SPECS, build_model
+
+CONFIG = {'models':list(MODEL_SPECS),
+          'resolution':128,
+          'batch_size':1,
+          'bytes_per_element':4}
+
+_ACTIVATION_FLOPS = {'ReLU':1, 'LeakyReLU':1, 'ReLU6':1, 'Sigmoid':4, 'Tanh':4, 'ELU':4, 'GELU':4, 'SiLU':4}
+_UPSAMPLE_FLOPS = {'nearest':0, 'bilinear':7, 'bicubic':31}
+
+
+class CostTrace:
+  '''
+  Per layer records of a walk through a model, and the live activation bookkeeping for the inference peak.
+  Shapes are per sample (channels, height, width), the counts are for the whole batch.
+  '''
+  def __init__(self, batch_size=CONFIG['batch_size'], bytes_per_element=CONFIG['bytes_per_element']):
+    self.batch_size, self.bytes_per_element = batch_size, bytes_per_element
+    self.layers = []
+    self.live = {} # activations waiting for a later layer (skip connections, branch outputs)
+    self.peak_bytes = 0
+
+  def nbytes(self, *shapes):
+    return self.batch_size * self.bytes_per_element * sum(math.prod(shape) for shape in shapes)
+
+  def add(self, name, kind, inputs, output, macs=0, flops=None, params=0, inplace=False):
+    inputs = inputs if isinstance(inputs, list) else [inputs]
+    output_bytes = 0 if inplace else self.nbytes(output)
+    self.peak_bytes = max(self.peak_bytes, sum(self.live.values()) + self.nbytes(*inputs) + output_bytes)
+    self.layers.append({'name':name, 'type':kind, 'input':inputs[0] if len(inputs) == 1 else inputs, 'output':output,
+                        'macs':self.batch_size * macs,
+                        'flops':self.batch_size * (2 * macs if flops is None else flops),
+                        'params':params, 'activation_bytes':output_bytes})
+    return output
+
+  def hold(self, key, shape):
+    self.live[key] = self.nbytes(shape)
+
+  def release(self, key):
+    self.live.pop(key, None)
+
+
+def _own_params(module):
+  return sum(p.numel() for p in module.parameters(recurse=False))
+
+
+def _pair(value):
+  return tuple(value) if isinstance(value, (tuple, list)) else (value, value)
+
+
+def _window_out(size, kernel, stride, padding, dilation):
+  return (size + 2 * padding - dilation * (kernel - 1) - 1) // stride + 1
+
+
+def _conv2d(m, shape, trace, name):
+  c, h, w = shape
+  (kh, kw), (sh, sw), (dh, dw) = m.kernel_size, m.stride, m.dilation
+  if m.padding == 'same':
+    ho, wo = h, w
+  else:
+    ph, pw = (0, 0) if m.padding == 'valid' else m.padding
+    ho, wo = _window_out(h, kh, sh, ph, dh), _window_out(w, kw, sw, pw, dw)
+  outputs = m.out_channels * ho * wo
+  macs = outputs * (m.in_channels // m.groups) * kh * kw
+  return trace.add(name, 'Conv2d', shape, (m.out_channels, ho, wo), macs,
+                   2 * macs + (outputs if m.bias is not None else 0), _own_params(m))
+
+
+def _conv_transpose2d(m, shape, trace, name):
+  c, h, w = shape
+  (kh, kw), (sh, sw), (ph, pw), (dh, dw) = m.kernel_size, m.stride, m.padding, m.dilation
+  oph, opw = m.output_padding
+  ho, wo = (h - 1) * sh - 2 * ph + dh * (kh - 1) + oph + 1, (w - 1) * sw - 2 * pw + dw * (kw - 1) + opw + 1
+  macs = m.in_channels * h * w * (m.out_channels // m.groups) * kh * kw
+  return trace.add(name, 'ConvTranspose2d', shape, (m.out_channels, ho, wo), macs,
+                   2 * macs + (m.out_channels * ho * wo if m.bias is not None else 0), _own_params(m))
+
+
+def _batch_norm(m, shape, trace, name):
+  return trace.add(name, 'BatchNorm2d', shape, shape, flops=2 * math.prod(shape), params=_own_params(m))
+
+
+def _activation(m, shape, trace, name):
+  kind = type(m).__name__
+  return trace.add(name, kind, shape, shape, flops=_ACTIVATION_FLOPS[kind] * math.prod(shape), params=_own_params(m),
+                   inplace=getattr(m, 'inplace', False))
+
+
+def _pool(m, shape, trace, name):
+  c, h, w = shape
+  (kh, kw), (ph, pw) = _pair(m.kernel_size), _pair(m.padding)
+  (sh, sw) = _pair(m.stride if m.stride is not None else m.kernel_size)
+  (dh, dw) = _pair(getattr(m, 'dilation', 1))
+  out = (c, _window_out(h, kh, sh, ph, dh), _window_out(w, kw, sw, pw, dw))
+  return trace.add(name, type(m).__name__, shape, out, flops=(kh * kw - 1) * math.prod(out))
+
+
+def _upsample(m, shape, trace, name):
+  c, h, w = shape
+  if m.size is not None:
+    ho, wo = _pair(m.size)
+  else:
+    fh, fw = _pair(m.scale_factor)
+    ho, wo = int(h * fh), int(w * fw)
+  return trace.add(name, 'Upsample', shape, (c, ho, wo), flops=_UPSAMPLE_FLOPS.get(m.mode, 7) * c * ho * wo)
+
+
+def _identity(m, shape, trace, name):
+  return shape
+
+
+def _sequential(m, shape, trace, name):
+  for child_name, child in m.named_children():
+    shape = layer_cost(child, shape, trace, f'{name}.{child_name}')
+  return shape
+
+
+def _cat(trace, name, shapes):
+  return trace.add(name, 'cat', shapes, (sum(s[0] for s in shapes),) + tuple(shapes[0][1:]))
+
+
+def _partial_conv(m, shapes, trace, name):
+  shape, mask_shape = shapes
+  trace.add(f'{name}.mask_input', 'mul', [shape, mask_shape], shape, flops=math.prod(shape))
+  out = _conv2d(m.input_conv, shape, trace, f'{name}.input_conv')
+  kh, kw = m.input_conv.kernel_size
+  window_macs = out[1] * out[2] * kh * kw # single channel box filter of the channel max
+  trace.add(f'{name}.mask_update', 'PartialConv mask update', mask_shape, (1,) + out[1:], window_macs,
+            2 * window_macs + math.prod(mask_shape))
+  trace.add(f'{name}.hole_fill', 'where', out, out, flops=math.prod(out), inplace=m.hole_fill is None)
+  return out, (1,) + out[1:]
+
+
+def _double_pconv(m, shapes, trace, name):
+  x, mask = _partial_conv(m.pconv1, shapes, trace, f'{name}.pconv1')
+  for layer in ['bn1', 'act1']:
+    x = layer_cost(getattr(m, layer), x, trace, f'{name}.{layer}')
+  x, mask = _partial_conv(m.pconv2, (x, mask), trace, f'{name}.pconv2')
+  for layer in ['bn2', 'act2']:
+    x = layer_cost(getattr(m, layer), x, trace, f'{name}.{layer}')
+  return x, mask
+
+
+def _double_conv(m, shape, trace, name):
+  for layer in ['conv1', 'bn1', 'act1', 'conv2', 'bn2', 'act2']:
+    shape = layer_cost(getattr(m, layer), shape, trace, f'{name}.{layer}')
+  return shape
+
+
+def _inception(m, shape, trace, name):
+  c, h, w = shape
+  trace.hold(name, shape) # the input is read by every branch
+  if getattr(m, 'merge_projections', False):
+    layer_cost(m.projection, shape, trace, f'{name}.projection')
+    branch_inputs = [(channels, h, w) for channels in m.projection_split]
+  else:
+    branch_inputs = [shape] * 3
+  outputs = []
+  for i, branch_input in enumerate(branch_inputs + [shape]):
+    outputs.append(layer_cost(getattr(m, f'channel_{i+1}'), branch_input, trace, f'{name}.channel_{i+1}'))
+    trace.hold(f'{name}.channel_{i+1}', outputs[-1])
+  for key in [name] + [f'{name}.channel_{i+1}' for i in range(4)]:
+    trace.release(key)
+  out = _cat(trace, f'{name}.cat', outputs)
+  if getattr(m, 'coding_layer', False): # the bottleneck script applies CONFIG['coding_layer_activation'] to the output
+    out = trace.add(f'{name}.coding_activation', 'Sigmoid', out, out, flops=4 * math.prod(out))
+  return out
+
+
+def _residual_unit(m, shape, trace, name):
+  trace.hold(name, shape) # the skip connection input
+  x = layer_cost(m.conv1, shape, trace, f'{name}.conv1')
+  x = layer_cost(m.conv2, x, trace, f'{name}.conv2')
+  if m.first:
+    trace.hold(f'{name}.conv2', x)
+    skip = layer_cost(m.skipconv, shape, trace, f'{name}.skipconv')
+    trace.release(f'{name}.conv2')
+  trace.release(name)
+  x = trace.add(f'{name}.add', 'add', [x, skip if m.first else shape], x, flops=math.prod(x))
+  return layer_cost(m.final_activation, x, trace, f'{name}.final_activation')
+
+
+def _residual_block(m, shape, trace, name):
+  return layer_cost(m.ru2, layer_cost(m.ru1, shape, trace, f'{name}.ru1'), trace, f'{name}.ru2')
+
+
+def _decoder(m, x, skips, trace, prefix):
+  # up_transpose / concatenation with the skip / up_conv, then output_conv : the UNet and PartialConvUNet decoders
+  for i, skip in zip([1, 2, 3], skips[::-1]):
+    x = layer_cost(getattr(m, f'up_transpose{i}'), x, trace, f'{prefix}up_transpose{i}')
+    trace.release(f'x{4 - i}')
+    x = _cat(trace, f'{prefix}cat{i}', [x, skip])
+    x = layer_cost(getattr(m, f'up_conv{i}'), x, trace, f'{prefix}up_conv{i}')
+  return layer_cost(m.output_conv, x, trace, f'{prefix}output_conv')
+
+
+def _unet(m, shape, trace, name):
+  # the inception modules follow the down convolutions in training_loop_without_contrastive_learning.py and sit at the
+  # bottleneck in unet_with_inception_modules.py
+  skip_inception = m.add_inception and m.inception_module_1.channel_4[1].in_channels == m.down_conv_out[0]
+  x, skips = shape, []
+  for i in [1, 2, 3]:
+    x = layer_cost(getattr(m, f'down_conv{i}'), x, trace, f'down_conv{i}')
+    if skip_inception:
+      x = layer_cost(getattr(m, f'inception_module_{i}'), x, trace, f'inception_module_{i}')
+    trace.hold(f'x{i}', x)
+    skips.append(x)
+    x = layer_cost(m.maxpool, x, trace, f'maxpool{i}')
+  x = layer_cost(m.down_conv4, x, trace, 'down_conv4')
+  if m.add_inception and not skip_inception:
+    for i in [1, 2, 3]:
+      x = layer_cost(getattr(m, f'inception_module_{i}'), x, trace, f'inception_module_{i}')
+  return _decoder(m, x, skips, trace, '')
+
+
+def _partial_conv_unet(m, shapes, trace, name):
+  encoder = m.encoder
+  x, mask = shapes
+  skips = []
+  for i in [1, 2, 3]:
+    x, mask = _double_pconv(getattr(encoder, f'down_conv{i}'), (x, mask), trace, f'encoder.down_conv{i}')
+    trace.hold(f'x{i}', x)
+    skips.append(x)
+    x = layer_cost(encoder.maxpool, x, trace, f'encoder.maxpool{i}')
+    mask = layer_cost(encoder.maxpool, mask, trace, f'encoder.maxpool{i}_mask')
+  x, mask = _double_pconv(encoder.down_conv4, (x, mask), trace, 'encoder.down_conv4')
+  if encoder.add_inception:
+    for i in [1, 2, 3]:
+      x = layer_cost(getattr(encoder, f'inception_module_{i}'), x, trace, f'encoder.inception_module_{i}')
+  return _decoder(m.decoder, x, skips, trace, 'decoder.')
+
+
+def _resnet_unet(m, shape, trace, name):
+  encoder, decoder = m.encoder, m.decoder
+  x = layer_cost(encoder.conv, shape, trace, 'encoder.conv')
+  skips = []
+  for i, block in enumerate(['residual_block_64', 'residual_block_128', 'residual_block_256']):
+    x = layer_cost(getattr(encoder, block), x, trace, f'encoder.{block}')
+    trace.hold(f'x{i + 1}', x)
+    skips.append(x)
+  x = layer_cost(encoder.residual_block_512, x, trace, 'encoder.residual_block_512')
+  for i, skip in zip([1, 2, 3], skips[::-1]):
+    x = layer_cost(getattr(decoder, f'upsample_conv_{i}'), x, trace, f'decoder.upsample_conv_{i}')
+    trace.release(f'x{4 - i}')
+    x = _cat(trace, f'decoder.cat{i}', [x, skip])
+    x = layer_cost(getattr(decoder, f'up_conv_{i}'), x, trace, f'decoder.up_conv_{i}')
+  x = layer_cost(decoder.upsample_conv_4, x, trace, 'decoder.upsample_conv_4')
+  return layer_cost(decoder.final_conv, x, trace, 'decoder.final_conv')
+
+
+# cost function of every module type, by class name since the script classes are loaded out of the scripts
+_COSTS = {'Conv2d':_conv2d, 'ConvTranspose2d':_conv_transpose2d, 'BatchNorm2d':_batch_norm,
+          'MaxPool2d':_pool, 'AvgPool2d':_pool, 'Upsample':_upsample, 'Identity':_identity, 'Dropout':_identity,
+          'Sequential':_sequential, 'PartialConv':_partial_conv, 'DoublePConv':_double_pconv, 'DoubleConv':_double_conv,
+          'InceptionModule':_inception, 'ResidualUnit':_residual_unit, 'ResidualBlock':_residual_block,
+          'UNet':_unet, 'PartialConvUNet':_partial_conv_unet, 'ResNetUNet':_resnet_unet,
+          **{kind:_activation for kind in _ACTIVATION_FLOPS}}
+
+
+def layer_cost(module, shape, trace, name):
+  '''
+  Record the cost of `module` applied to an input of per sample shape `shape` in `trace`, return the output shape
+  ((image shape, mask shape) in and out for the partial convolution blocks).
+  '''
+  kind = type(module).__name__
+  if kind not in _COSTS:
+    raise ValueError(f'no cost model for {kind} ({name})')
+  return _COSTS[kind](module, shape, trace, name)
+
+
+def model_cost(model, resolution=CONFIG['resolution'], batch_size=CONFIG['batch_size'],
+               bytes_per_element=CONFIG['bytes_per_element'], **kwargs):
+  '''
+  Cost of a forward pass at resolution x resolution : {'layers', 'flops', 'macs', 'params', 'model_params',
+  'activation_bytes' (kept for backward), 'peak_activation_bytes' (inference)}.
+
+  model : key of MODEL_SPECS (built on the meta device with the extra constructor kwargs) or a model instance
+  '''
+  import torch
+
+  if isinstance(model, str):
+    with torch.device('meta'):
+      model = build_model(model, **kwargs)
+  trace = CostTrace(batch_size, bytes_per_element)
+  image = (3, resolution, resolution)
+  inputs = (image, image) if type(model).__name__ == 'PartialConvUNet' else image # the mask has the image channels
+  output = layer_cost(model, inputs, trace, type(model).__name__)
+  return {'layers':trace.layers, 'output':output,
+          'flops':sum(layer['flops'] for layer in trace.layers),
+          'macs':sum(layer['macs'] for layer in trace.layers),
+          'params':sum(layer['params'] for layer in trace.layers),
+          'model_params':sum(p.numel() for p in model.parameters()),
+          'activation_bytes':sum(layer['activation_bytes'] for layer in trace.layers),
+          'peak_activation_bytes':trace.peak_bytes}
+
+
+def format_layers(cost):
+  lines = [f"{'layer':<48} {'type':<24} {'output':>18} {'MFLOPs':>10} {'params':>10} {'act MB':>8}"]
+  for layer in cost['layers']:
+    output = 'x'.join(str(s) for s in layer['output'])
+    lines.append(f"{layer['name']:<48} {layer['type']:<24} {output:>18} {layer['flops'] / 1e6:10.1f} "
+                 f"{layer['params']:10d} {layer['activation_bytes'] / 1024**2:8.2f}")
+  return '\n'.join(lines)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--models', nargs='+', default=CONFIG['models'], choices=list(MODEL_SPECS))
+  parser.add_argument('--resolution', type=int, default=CONFIG['resolution'])
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--bytes-per-element', type=int, default=CONFIG['bytes_per_element'])
+  parser.add_argument('--kwargs', type=json.loads, default={},
+                      help='extra constructor arguments as json, e.g. \'{"down_conv_out": [32, 64, 128, 256]}\'')
+  parser.add_argument('--layers', action='store_true', help='print the per layer table')
+  args = parser.parse_args(argv)
+
+  for name in args.models:
+    cost = model_cost(name, args.resolution, args.batch_size, args.bytes_per_element, **args.kwargs)
+    if args.layers:
+      print(format_layers(cost))
+    print(f"{name:>26} @ {args.resolution} x{args.batch_size} : {cost['flops'] / 1e9:8.2f} GFLOPs  "
+          f"{cost['params'] / 1e6:6.2f} M params used ({cost['model_params'] / 1e6:.2f} M in the model)  "
+          f"activations {cost['activation_bytes'] / 1024**2:8.1f} MB kept for backward, "
+          f"inference peak {cost['peak_activation_bytes'] / 1024**2:7.1f} MB")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,142 @@
+'''
+Decode-once dataset and mask bank shared between processes.
+
+prepare_shared_data() decodes the 128x128 artwork crops a single time into a uint8 .npy file, generates the free-form
+mask bank with the scripts' generate_mask() and stores a fixed train/validation split. Every process then opens these
+files memory mapped, so the decoded pixels and the masks live once in the OS page cache however many trainings run.
+
+data_dir layout :
+  images.npy   uint8 (N, size, size, 3)
+  masks.npy    bool  (n_masks, size, size), True for valid pixels and False for holes like generate_mask()
+  splits.npz   'train' and 'val' indices into images.npy
+  meta.json    image file names (the image ids) and generation parameters
+'''
+
+import os
+import json
+
+import numpy as np
+
+CONFIG = {'size':128,
+          'n_masks':10000,
+          'val_fraction':0.07,
+          'seed':1}
+
+
+def _load_image(path, size):
+  from PIL import Image
+
+  image = Image.open(path).convert('RGB')
+  if image.size != (size, size):
+    # centre crop to a square and resize, the same preprocessing the processed_dataset went through
+    w, h = image.size
+    side = min(w, h)
+    image = image.crop(((w - side)//2, (h - side)//2, (w - side)//2 + side, (h - side)//2 + side)).resize((size, size))
+  return np.asarray(image)
+
+
+def prepare_shared_data(image_dir, data_dir, size=CONFIG['size'], n_masks=CONFIG['n_masks'],
+                        val_fraction=CONFIG['val_fraction'], seed=CONFIG['seed'], verbose=True):
+  '''
+  Decode all the images of image_dir and generate the mask bank into data_dir, does nothing if it already exists.
+
+  image_dir : directory of images, e.g. /content/processed_dataset
+  data_dir : output directory
+  size : side of the square images and masks
+  n_masks : size of the mask bank
+  val_fraction : fraction of the images used for validation
+  seed : seed of the split and of the mask generation
+  '''
+  import tqdm
+  from numpy.lib.format import open_memmap
+  from artwork_inpainting.loader import load_script
+
+  meta_path = os.path.join(data_dir, 'meta.json')
+  if os.path.exists(meta_path):
+    return
+  os.makedirs(data_dir, exist_ok=True)
+
+  names = sorted(os.listdir(image_dir))
+  images = open_memmap(os.path.join(data_dir, 'images.npy'), mode='w+', dtype=np.uint8, shape=(len(names), size, size, 3))
+  for k, name in enumerate(tqdm.tqdm(names, disable=not verbose)):
+    images[k] = _load_image(os.path.join(image_dir, name), size)
+  images.flush()
+  del images
+
+  rng = np.random.RandomState(seed)
+  order = rng.permutation(len(names))
+  n_val = int(val_fraction * len(names))
+  np.savez(os.path.join(data_dir, 'splits.npz'), train=np.sort(order[n_val:]), val=np.sort(order[:n_val]))
+
+  generate_mask = load_script('pconv').generate_mask
+  np.random.seed(seed)
+  masks = open_memmap(os.path.join(data_dir, 'masks.npy'), mode='w+', dtype=bool, shape=(n_masks, size, size))
+  for k in tqdm.tqdm(range(n_masks), disable=not verbose):
+    masks[k] = generate_mask(size)
+  masks.flush()
+  del masks
+
+  # written last, its presence marks a complete data_dir
+  with open(meta_path, 'w') as f:
+    json.dump({'names':names, 'size':size, 'n_masks':n_masks, 'val_fraction':val_fraction, 'seed':seed}, f)
+
+
+def load_meta(data_dir):
+  with open(os.path.join(data_dir, 'meta.json')) as f:
+    return json.load(f)
+
+
+def load_splits(data_dir):
+  splits = np.load(os.path.join(data_dir, 'splits.npz'))
+  return splits['train'], splits['val']
+
+
+def load_mask_bank(data_dir):
+  '''
+  Return the mask bank in the format of CONFIG['masks'] in the training scripts : a list of (size, size, 3) bool tensors.
+
+  The array is mapped copy-on-write and the list items are views of it, so the bank costs no private memory.
+  '''
+  import torch
+
+  bank = torch.from_numpy(np.load(os.path.join(data_dir, 'masks.npy'), mmap_mode='c'))
+  return list(bank.unsqueeze(-1).expand(-1, -1, -1, 3))
+
+
+class MemmapDataset:
+  '''
+  Map style dataset over images.npy, items are (image, index) with image a float (3, size, size) tensor in [0, 1]
+  exactly like transforms.ToTensor() on the jpg. The index takes the place of the ImageFolder label so the scripts'
+  loops, which only use batch[0], work unchanged while the image id stays available through meta.json.
+
+  data_dir : directory written by prepare_shared_data()
+  indices : subset of images to expose, e.g. one of load_splits()
+  '''
+  def __init__(self, data_dir, indices=None):
+    self.data_dir = data_dir
+    self.images = np.load(os.path.join(data_dir, 'images.npy'), mmap_mode='r')
+    self.indices = np.arange(len(self.images)) if indices is None else np.asarray(indices)
+
+  def __len__(self):
+    return len(self.indices)
+
+  def __getitem__(self, i):
+    import torch
+
+    index = int(self.indices[i])
+    image = torch.from_numpy(np.array(self.images[index])).permute(2, 0, 1)
+    return image.float().div_(255), index
+
+
+def make_dataloaders(data_dir, batch_size_train, batch_size_eval, num_workers=0):
+  '''
+  Training and validation dataloaders over the shared data, with the options of the training scripts.
+  '''
+  from torch.utils.data import DataLoader
+
+  train_indices, val_indices = load_splits(data_dir)
+  train_dataloader = DataLoader(MemmapDataset(data_dir, train_indices), shuffle=True, batch_size=batch_size_train,
+                                drop_last=True, num_workers=num_workers)
+  val_dataloader = DataLoader(MemmapDataset(data_dir, val_indices), shuffle=False, batch_size=batch_size_eval,
+                              drop_last=True, num_workers=num_workers)
+  return train_dataloader, val_dataloader
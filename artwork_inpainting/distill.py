@@ -0,0 +1,326 @@
+'''
+Knowledge distillation of a trained full width model (PartialConvUNet or UNet) into the small UNet configuration.
+
+The teacher runs once per (image, mask) pair : build_teacher_cache() assigns CONFIG['masks_per_image'] masks of the
+mask bank to every training image (seeded) and stores memory mapped in the cache directory
+
+  mask_ids.npy            (N, K) int32 mask bank indices of every image
+  outputs.npy             (N, K, 3, size, size) teacher outputs, float16
+  skip_{1,2,3}.npy        (N, K, ch, h / p, w / p) teacher skip features x1, x2, x3 average pooled by
+                          p = CONFIG['feature_pool'], float16 (at full resolution x1 alone is 2 MB per pair)
+  meta.json               teacher, image ids, shapes, checked when the cache is opened, written last
+
+distill() then trains the student on these pairs with
+
+  output_weight * MSE(student, teacher) + target_weight * MSE(student, ground truth)
+  + sum_i feature_weights[i] * MSE(pool(adapter_i(student x_i)), teacher x_i)
+
+the adapters being 1x1 convolutions from the student to the teacher skip widths, trained with the student and
+dropped afterwards. The student checkpoint is a plain state_dict of MODEL_SPECS[student]. evaluate_distillation()
+compares teacher and student quality and latency on the fixed validation subset.
+
+  python -m artwork_inpainting.distill --data-dir /content/shared --teacher pconv_unet --teacher-checkpoint model.pth
+'''
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+from artwork_inpainting.loader import MODEL_SPECS, build_model
+
+CONFIG = {'teacher':'pconv_unet',
+          'student':'unet_small',
+          'masks_per_image':2,
+          'feature_pool':2,
+          'cache_dtype':'float16',
+          'output_weight':1.0,
+          'target_weight':1.0,
+          'feature_weights':[0.1, 0.1, 0.1], # x1, x2, x3
+          'epochs':30,
+          'lr':5e-4,
+          'weight_decay':1e-5,
+          'batch_size':64,
+          'eval_images':256,
+          'device':'cpu',
+          'seed':1}
+
+# modules whose outputs are the skip features x1, x2, x3 of every architecture
+SKIP_MODULES = {'unet':['down_conv1', 'down_conv2', 'down_conv3'],
+                'unet_inception':['inception_module_1', 'inception_module_2', 'inception_module_3'],
+                'unet_small':['down_conv1', 'down_conv2', 'down_conv3'],
+                'unet_bottleneck_inception':['down_conv1', 'down_conv2', 'down_conv3'],
+                'pconv_unet':['encoder.down_conv1', 'encoder.down_conv2', 'encoder.down_conv3']}
+
+
+class SkipFeatures:
+  '''
+  Context manager recording the skip features of a model during its forward passes in self.features.
+  '''
+  def __init__(self, model, name):
+    if name not in SKIP_MODULES:
+      raise ValueError(f'no skip features known for {name}, one of {list(SKIP_MODULES)} is needed')
+    self.modules = [model.get_submodule(path) for path in SKIP_MODULES[name]]
+    self.features = [None] * len(self.modules)
+    self.handles = []
+
+  def _hook(self, i):
+    def hook(module, args, output):
+      self.features[i] = output[0] if isinstance(output, tuple) else output # DoublePConv returns (x, mask)
+    return hook
+
+  def __enter__(self):
+    self.handles = [module.register_forward_hook(self._hook(i)) for i, module in enumerate(self.modules)]
+    return self
+
+  def __exit__(self, *exc):
+    for handle in self.handles:
+      handle.remove()
+
+
+def _model_inputs(name, image, valid):
+  from artwork_inpainting.inference import model_inputs
+
+  return model_inputs(MODEL_SPECS[name]['inputs'], image, valid)
+
+
+def _load(name, checkpoint=None, device='cpu'):
+  import torch
+
+  model = build_model(name)
+  if checkpoint is not None:
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+  return model.to(device)
+
+
+def build_teacher_cache(teacher_name, teacher_checkpoint, data_dir, cache_dir=None,
+                        masks_per_image=CONFIG['masks_per_image'], feature_pool=CONFIG['feature_pool'],
+                        dtype=CONFIG['cache_dtype'], batch_size=CONFIG['batch_size'], device=CONFIG['device'],
+                        seed=CONFIG['seed'], verbose=True):
+  '''
+  Run the teacher once on every (training image, mask) pair and store its outputs and pooled skip features, return
+  the cache directory (data_dir/teacher_cache_{teacher} by default).
+  '''
+  import tqdm
+  import torch
+  import torch.nn.functional as F
+  from numpy.lib.format import open_memmap
+  from artwork_inpainting.data import load_splits
+
+  cache_dir = cache_dir or os.path.join(data_dir, f'teacher_cache_{teacher_name}')
+  os.makedirs(cache_dir, exist_ok=True)
+  teacher = _load(teacher_name, teacher_checkpoint, device).eval()
+  images = np.load(os.path.join(data_dir, 'images.npy'), mmap_mode='r')
+  bank = np.load(os.path.join(data_dir, 'masks.npy'), mmap_mode='r')
+  image_ids = load_splits(data_dir)[0]
+  mask_ids = np.random.default_rng(seed).integers(len(bank), size=(len(image_ids), masks_per_image), dtype=np.int32)
+  np.save(os.path.join(cache_dir, 'mask_ids.npy'), mask_ids)
+
+  def batch(rows, k):
+    image = torch.from_numpy(images[image_ids[rows]]).permute(0, 3, 1, 2).float().div_(255).to(device)
+    valid = torch.from_numpy(bank[mask_ids[rows, k]][:, None]).float().to(device)
+    return image, valid
+
+  with torch.no_grad(), SkipFeatures(teacher, teacher_name) as skips:
+    teacher(*_model_inputs(teacher_name, *batch(np.arange(1), 0)))
+    shapes = [(f.shape[1], f.shape[2] // feature_pool, f.shape[3] // feature_pool) for f in skips.features]
+    size = images.shape[1]
+    outputs = open_memmap(os.path.join(cache_dir, 'outputs.npy'), mode='w+', dtype=dtype,
+                          shape=(len(image_ids), masks_per_image, 3, size, size))
+    features = [open_memmap(os.path.join(cache_dir, f'skip_{i+1}.npy'), mode='w+', dtype=dtype,
+                            shape=(len(image_ids), masks_per_image) + shape) for i, shape in enumerate(shapes)]
+    if verbose:
+      total = sum(a.nbytes for a in [outputs] + features) / 1024**3
+      print(f'teacher cache : {len(image_ids)} images x {masks_per_image} masks, {total:.1f} GB in {cache_dir}')
+
+    for start in tqdm.tqdm(range(0, len(image_ids), batch_size), disable=not verbose):
+      rows = np.arange(start, min(start + batch_size, len(image_ids)))
+      for k in range(masks_per_image):
+        outputs[rows, k] = teacher(*_model_inputs(teacher_name, *batch(rows, k))).cpu().numpy()
+        for i, feat in enumerate(skips.features):
+          features[i][rows, k] = F.avg_pool2d(feat, feature_pool).cpu().numpy()
+
+  for array in [outputs] + features:
+    array.flush()
+  with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+    json.dump({'teacher':teacher_name, 'checkpoint':teacher_checkpoint, 'image_ids':image_ids.tolist(),
+               'masks_per_image':masks_per_image, 'feature_pool':feature_pool, 'shapes':shapes, 'dtype':dtype}, f)
+  return cache_dir
+
+
+class TeacherCacheDataset:
+  '''
+  Map style dataset over the (image, mask) pairs of a teacher cache, items are (image, valid mask, teacher output,
+  teacher skip features) as float tensors, the mask (1, size, size) with 1 for valid pixels.
+  '''
+  def __init__(self, data_dir, cache_dir):
+    from artwork_inpainting.data import load_splits
+
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+      self.meta = json.load(f)
+    self.image_ids = np.asarray(self.meta['image_ids'])
+    if not np.array_equal(self.image_ids, load_splits(data_dir)[0]):
+      raise ValueError(f'teacher cache {cache_dir} was built for another training split than the one of {data_dir}')
+    self.images = np.load(os.path.join(data_dir, 'images.npy'), mmap_mode='r')
+    self.bank = np.load(os.path.join(data_dir, 'masks.npy'), mmap_mode='r')
+    self.mask_ids = np.load(os.path.join(cache_dir, 'mask_ids.npy'))
+    self.outputs = np.load(os.path.join(cache_dir, 'outputs.npy'), mmap_mode='r')
+    self.features = [np.load(os.path.join(cache_dir, f'skip_{i+1}.npy'), mmap_mode='r')
+                     for i in range(len(self.meta['shapes']))]
+    self.k = self.meta['masks_per_image']
+
+  def __len__(self):
+    return len(self.image_ids) * self.k
+
+  def __getitem__(self, i):
+    import torch
+
+    row, k = divmod(i, self.k)
+    image = torch.from_numpy(np.array(self.images[self.image_ids[row]])).permute(2, 0, 1).float().div_(255)
+    valid = torch.from_numpy(np.array(self.bank[self.mask_ids[row, k]])[None]).float()
+    output = torch.from_numpy(self.outputs[row, k].astype(np.float32))
+    features = [torch.from_numpy(feat[row, k].astype(np.float32)) for feat in self.features]
+    return image, valid, output, features
+
+
+def feature_adapters(student, student_name, teacher_shapes, device='cpu'):
+  '''
+  1x1 convolutions from the student skip widths to the teacher ones.
+  '''
+  import torch
+  from torch import nn
+
+  with torch.no_grad(), SkipFeatures(student, student_name) as skips:
+    student.eval()(*_model_inputs(student_name, torch.zeros(1, 3, 64, 64, device=device),
+                                  torch.ones(1, 1, 64, 64, device=device)))
+  return nn.ModuleList([nn.Conv2d(feat.shape[1], shape[0], 1) for feat, shape in zip(skips.features, teacher_shapes)]).to(device)
+
+
+def distill(data_dir, cache_dir, student_name=CONFIG['student'], epochs=CONFIG['epochs'], lr=CONFIG['lr'],
+            weight_decay=CONFIG['weight_decay'], batch_size=CONFIG['batch_size'], output_weight=CONFIG['output_weight'],
+            target_weight=CONFIG['target_weight'], feature_weights=CONFIG['feature_weights'], device=CONFIG['device'],
+            checkpoint_prefix=None, num_workers=0, seed=CONFIG['seed']):
+  '''
+  Train the student on a teacher cache and return it with the per epoch mean of every loss term.
+  '''
+  import tqdm
+  import torch
+  import torch.nn.functional as F
+  from torch.utils.data import DataLoader
+
+  torch.manual_seed(seed)
+  dataset = TeacherCacheDataset(data_dir, cache_dir)
+  dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=num_workers)
+  pool = dataset.meta['feature_pool']
+  student = build_model(student_name).to(device)
+  adapters = feature_adapters(student, student_name, dataset.meta['shapes'], device)
+  optimizer = torch.optim.AdamW(list(student.parameters()) + list(adapters.parameters()), lr=lr,
+                                weight_decay=weight_decay)
+
+  history = []
+  for epoch in range(epochs):
+    student.train()
+    totals = {'output':0.0, 'target':0.0, 'features':0.0}
+    bar = tqdm.tqdm(dataloader)
+    for image, valid, teacher_output, teacher_features in bar:
+      image, valid, teacher_output = image.to(device), valid.to(device), teacher_output.to(device)
+      with SkipFeatures(student, student_name) as skips:
+        prediction = student(*_model_inputs(student_name, image, valid))
+      losses = {'output':F.mse_loss(prediction, teacher_output), 'target':F.mse_loss(prediction, image),
+                'features':sum(w * F.mse_loss(F.avg_pool2d(adapter(feat), pool), target.to(device))
+                               for w, adapter, feat, target in zip(feature_weights, adapters, skips.features,
+                                                                   teacher_features))}
+      loss = output_weight * losses['output'] + target_weight * losses['target'] + losses['features']
+      loss.backward()
+      optimizer.step()
+      optimizer.zero_grad(set_to_none=True)
+      for term, value in losses.items():
+        totals[term] += value.item()
+      bar.set_postfix(Epoch=epoch, Output=losses['output'].item(), Features=losses['features'].item())
+    history.append({term:total / len(dataloader) for term, total in totals.items()})
+    if checkpoint_prefix:
+      torch.save(student.state_dict(), f'{checkpoint_prefix}_epoch_{epoch}.pth')
+  return student, history
+
+
+def evaluate_distillation(teacher_name, teacher, student_name, student, data_dir, n_images=CONFIG['eval_images'],
+                          batch_size=CONFIG['batch_size'], iters=10):
+  '''
+  MSE and hole L1 against the ground truth of teacher and student on the fixed validation subset, the MSE between
+  them, and their forward latency.
+  '''
+  import torch
+  from artwork_inpainting.benchmark import measure
+  from artwork_inpainting.quantize import _masked_set
+
+  teacher.eval()
+  student.eval()
+  targets, masks = _masked_set(data_dir, 'val', n_images, batch_size, 0)
+  sums = {'teacher_mse':0.0, 'student_mse':0.0, 'teacher_hole_l1':0.0, 'student_hole_l1':0.0, 'student_teacher_mse':0.0}
+  pixels, hole_pixels = 0, 0
+  with torch.no_grad():
+    for start in range(0, len(targets), batch_size):
+      gt = targets[start:start + batch_size].float()
+      valid = masks[start:start + batch_size, :1].float()
+      out_teacher = teacher(*_model_inputs(teacher_name, gt, valid)).clamp(0, 1)
+      out_student = student(*_model_inputs(student_name, gt, valid)).clamp(0, 1)
+      holes = 1 - valid
+      for who, out in [('teacher', out_teacher), ('student', out_student)]:
+        sums[f'{who}_mse'] += torch.sum((out - gt) ** 2).item()
+        sums[f'{who}_hole_l1'] += torch.sum(holes * torch.abs(out - gt)).item()
+      sums['student_teacher_mse'] += torch.sum((out_student - out_teacher) ** 2).item()
+      pixels += gt.numel()
+      hole_pixels += 3 * holes.sum().item()
+
+    report = {k:v / (max(hole_pixels, 1) if 'hole' in k else pixels) for k, v in sums.items()}
+    gt, valid = targets[:batch_size].float(), masks[:batch_size, :1].float()
+    for who, name, model in [('teacher', teacher_name, teacher), ('student', student_name, student)]:
+      inputs = _model_inputs(name, gt, valid)
+      report[f'{who}_latency_ms'] = measure(lambda: model(*inputs), warmup=2, iters=iters, items=len(gt))['latency_mean_ms']
+      report[f'{who}_params'] = sum(p.numel() for p in model.parameters())
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--data-dir', required=True)
+  parser.add_argument('--teacher', default=CONFIG['teacher'], choices=list(SKIP_MODULES))
+  parser.add_argument('--teacher-checkpoint', required=True)
+  parser.add_argument('--student', default=CONFIG['student'], choices=list(SKIP_MODULES))
+  parser.add_argument('--cache-dir')
+  parser.add_argument('--masks-per-image', type=int, default=CONFIG['masks_per_image'])
+  parser.add_argument('--epochs', type=int, default=CONFIG['epochs'])
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--lr', type=float, default=CONFIG['lr'])
+  parser.add_argument('--feature-weights', nargs=3, type=float, default=CONFIG['feature_weights'])
+  parser.add_argument('--output', default=None, help='student state_dict path, {student}_distilled.pth by default')
+  parser.add_argument('--device', default=CONFIG['device'])
+  args = parser.parse_args(argv)
+
+  import torch
+
+  cache_dir = args.cache_dir or os.path.join(args.data_dir, f'teacher_cache_{args.teacher}')
+  if not os.path.exists(os.path.join(cache_dir, 'meta.json')):
+    build_teacher_cache(args.teacher, args.teacher_checkpoint, args.data_dir, cache_dir, args.masks_per_image,
+                        batch_size=args.batch_size, device=args.device)
+  output = args.output or f'{args.student}_distilled.pth'
+  student, history = distill(args.data_dir, cache_dir, args.student, args.epochs, args.lr, batch_size=args.batch_size,
+                             feature_weights=args.feature_weights, device=args.device,
+                             checkpoint_prefix=os.path.splitext(output)[0])
+  torch.save(student.state_dict(), output)
+  for epoch, losses in enumerate(history):
+    print(f'epoch {epoch:3d} : ' + '  '.join(f'{term} {value:.5f}' for term, value in losses.items()))
+
+  student = student.cpu()
+  teacher = _load(args.teacher, args.teacher_checkpoint)
+  r = evaluate_distillation(args.teacher, teacher, args.student, student, args.data_dir, batch_size=args.batch_size)
+  print(f"teacher : MSE {r['teacher_mse']:.5f}  hole L1 {r['teacher_hole_l1']:.5f}  {r['teacher_params'] / 1e6:.2f} M "
+        f"parameters  {r['teacher_latency_ms']:.1f} ms")
+  print(f"student : MSE {r['student_mse']:.5f}  hole L1 {r['student_hole_l1']:.5f}  {r['student_params'] / 1e6:.2f} M "
+        f"parameters  {r['student_latency_ms']:.1f} ms  (MSE to the teacher {r['student_teacher_mse']:.5f}, "
+        f"x{r['teacher_latency_ms'] / r['student_latency_ms']:.1f} faster)")
+
+
+if __name__ == '__main__':
+  main()
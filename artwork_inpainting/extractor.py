@@ -0,0 +1,243 @@
+'''
+Perceptual-loss backbone : compact offline VGG16 slice and optional distilled lightweight extractor.
+
+VGG16FeatureExtractor only uses models.vgg16().features[:17] (enc_1..enc_3, 1.7M of the 138M parameters).
+export_vgg_slice() saves just these weights once, on a machine with internet access, to the file named by
+CONFIG['vgg_weights_path'] of the partial convolution script (relative to the repo directory); the extractor then
+builds the three blocks directly and memory maps that file instead of downloading / instantiating the full network. It
+raises FileNotFoundError when the file is missing, unless CONFIG['vgg_download'] of the script allows the download.
+
+LightFeatureExtractor is a thinner network with the same three outputs (same channels and resolutions), trained by
+distill_extractor() to regress the VGG features, so it can be given to InpaintingLoss in place of VGG16FeatureExtractor.
+evaluate_extractors() reports its speed against the VGG slice and how far its features and loss terms are from VGG's.
+
+  python -m artwork_inpainting.extractor export --output vgg16_enc_1_3.pth
+  python -m artwork_inpainting.extractor distill --data-dir /content/shared --output light_extractor.pth
+  python -m artwork_inpainting.extractor evaluate --data-dir /content/shared --light light_extractor.pth
+'''
+
+import os
+import argparse
+
+from torch import nn
+
+from artwork_inpainting.loader import load_script
+
+CONFIG = {'light_width':0.25, # channels of the light extractor relative to VGG
+          'distill_epochs':5,
+          'distill_lr':1e-3,
+          'batch_size':32,
+          'eval_images':256,
+          'device':'cpu'}
+
+
+def export_vgg_slice(path=None, half=False):
+  '''
+  Save the enc_1..enc_3 weights of the pretrained torchvision VGG16 (needs the torchvision weights, so internet access
+  or the torch hub cache, only this once).
+
+  path : the file VGG16FeatureExtractor loads by default (CONFIG['vgg_weights_path'] of the script) if None
+  half : store the weights in float16 (about 3.5 MB instead of 7 MB), they are cast back to float32 on load
+  '''
+  import torch
+
+  script = load_script('pconv')
+  path = path or script.vgg_weights_file()
+  extractor = script.VGG16FeatureExtractor(weights_path=None)
+  state_dict = {k:(v.half() if half else v) for k, v in extractor.state_dict().items()}
+  torch.save(state_dict, path)
+  return path
+
+
+class LightFeatureExtractor(nn.Module):
+  '''
+  Distilled replacement of VGG16FeatureExtractor. Every stage works with `width` times the VGG channels and a 1x1
+  projection maps its output to the VGG channel count, so the outputs have exactly the shapes of enc_1..enc_3.
+
+  width : channel multiplier of the internal stages
+  '''
+  def __init__(self, width=CONFIG['light_width']):
+    super().__init__()
+    self.width = width
+
+    channels = [64, 128, 256]
+    thin = [max(8, int(width * c)) for c in channels]
+    stages = []
+    projections = []
+    in_channels = 3
+    for c, t in zip(channels, thin):
+      stages.append(nn.Sequential(nn.Conv2d(in_channels, t, 3, padding=1), nn.ReLU(inplace=True),
+                                  nn.Conv2d(t, t, 3, padding=1), nn.ReLU(inplace=True),
+                                  nn.MaxPool2d(kernel_size=2, stride=2)))
+      # VGG features are post ReLU, so are the projections
+      projections.append(nn.Sequential(nn.Conv2d(t, c, 1), nn.ReLU()))
+      in_channels = t
+    self.stages = nn.ModuleList(stages)
+    self.projections = nn.ModuleList(projections)
+
+  def forward(self, image):
+    results = []
+    x = image
+    for stage, projection in zip(self.stages, self.projections):
+      x = stage(x)
+      results.append(projection(x))
+    return results
+
+  def freeze(self):
+    for param in self.parameters():
+      param.requires_grad = False
+    return self.eval()
+
+
+def load_light_extractor(path, device='cpu'):
+  '''
+  Load a LightFeatureExtractor saved by distill_extractor(), frozen like VGG16FeatureExtractor.
+  '''
+  import torch
+
+  checkpoint = torch.load(path, map_location='cpu')
+  extractor = LightFeatureExtractor(checkpoint['width'])
+  extractor.load_state_dict(checkpoint['state_dict'])
+  return extractor.freeze().to(device)
+
+
+def _masked_batch(images, masks_buffer):
+  '''
+  Half of the batch is masked (holes set to 1 like get_masked_inputs), the extractor sees both kinds of images during
+  training : ground truth crops and composites with hole artifacts.
+  '''
+  import torch
+
+  idx = torch.randint(len(masks_buffer), (len(images),)).tolist()
+  masks = torch.permute(torch.stack([masks_buffer[j] for j in idx]), (0, 3, 1, 2))
+  masked = torch.where(masks, images, 1.0)
+  half = len(images) // 2
+  return torch.cat([images[:half], masked[half:]], 0)
+
+
+def distill_extractor(data_dir, output=None, width=CONFIG['light_width'], epochs=CONFIG['distill_epochs'],
+                      lr=CONFIG['distill_lr'], batch_size=CONFIG['batch_size'], device=CONFIG['device'], verbose=True):
+  '''
+  Train a LightFeatureExtractor to regress the VGG16 slice features on the training split of data_dir.
+  The loss is the L1 distance of every level, normalised by the mean magnitude of the VGG features of that level.
+  '''
+  import tqdm
+  import torch
+  from artwork_inpainting.data import MemmapDataset, load_splits, load_mask_bank
+
+  teacher = load_script('pconv').VGG16FeatureExtractor().to(device).eval()
+  student = LightFeatureExtractor(width).to(device)
+  optimizer = torch.optim.AdamW(student.parameters(), lr=lr)
+
+  train_indices, _ = load_splits(data_dir)
+  dataloader = torch.utils.data.DataLoader(MemmapDataset(data_dir, train_indices), batch_size=batch_size, shuffle=True,
+                                           drop_last=True)
+  masks_buffer = load_mask_bank(data_dir)
+
+  for epoch in range(epochs):
+    student.train()
+    bar = tqdm.tqdm(dataloader, disable=not verbose)
+    for images, _ in bar:
+      images = _masked_batch(images, masks_buffer).to(device)
+      with torch.no_grad():
+        targets = teacher(images)
+      preds = student(images)
+      loss = sum(torch.mean(torch.abs(p - t)) / (t.abs().mean() + 1e-8) for p, t in zip(preds, targets))
+
+      loss.backward()
+      optimizer.step()
+      optimizer.zero_grad()
+      bar.set_postfix(Epoch=epoch+1, Distill_loss=loss.item())
+
+  if output is not None:
+    torch.save({'width':width, 'state_dict':student.state_dict()}, output)
+  return student.freeze()
+
+
+def evaluate_extractors(data_dir, light, n_images=CONFIG['eval_images'], batch_size=CONFIG['batch_size'], iters=10,
+                        device=CONFIG['device']):
+  '''
+  Speed / accuracy trade off of a light extractor against the VGG16 slice on a fixed validation subset.
+
+  Returns, for both extractors, the latency per batch, and for the light one the relative L1 error of every feature
+  level and the relative error of the perceptual and style terms of InpaintingLoss (the quantities the training
+  actually uses), computed with a fixed mask per image and the masked input as the output.
+  '''
+  import torch
+  from artwork_inpainting.benchmark import measure
+  from artwork_inpainting.data import MemmapDataset, load_splits, load_mask_bank
+
+  script = load_script('pconv')
+  vgg = script.VGG16FeatureExtractor().to(device).eval()
+  light = light.to(device).eval()
+
+  _, val_indices = load_splits(data_dir)
+  targets, masks = script.make_fast_val_set(MemmapDataset(data_dir, val_indices), load_mask_bank(data_dir), n_images,
+                                            batch_size)
+
+  report = {}
+  with torch.no_grad():
+    batch = targets[:batch_size].to(device)
+    for name, extractor in [('vgg16_slice', vgg), ('light', light)]:
+      stats = measure(lambda: extractor(batch), warmup=2, iters=iters, items=len(batch))
+      report[name] = {'latency_ms':stats['latency_mean_ms'], 'images_per_sec':stats['images_per_sec'],
+                      'params':sum(p.numel() for p in extractor.parameters())}
+
+    feature_errors = [0.0, 0.0, 0.0]
+    loss_errors = {'prc':0.0, 'style':0.0}
+    n_batches = 0
+    for start in range(0, len(targets), batch_size):
+      gt = targets[start:start+batch_size].to(device)
+      mask = masks[start:start+batch_size].to(device)
+      input = torch.where(mask, gt, 1.0)
+      mask = mask.float()
+
+      for i, (f_light, f_vgg) in enumerate(zip(light(gt), vgg(gt))):
+        feature_errors[i] += (torch.mean(torch.abs(f_light - f_vgg)) / f_vgg.abs().mean()).item()
+
+      loss_vgg = script.InpaintingLoss(vgg)(input, mask, input, gt)
+      loss_light = script.InpaintingLoss(light)(input, mask, input, gt)
+      for name in loss_errors:
+        loss_errors[name] += abs(loss_light[name].item() - loss_vgg[name].item()) / abs(loss_vgg[name].item())
+      n_batches += 1
+
+  report['light'].update({f'feature_{i+1}_rel_l1':e / n_batches for i, e in enumerate(feature_errors)})
+  report['light'].update({f'{name}_rel_error':e / n_batches for name, e in loss_errors.items()})
+  report['speedup'] = report['vgg16_slice']['latency_ms'] / report['light']['latency_ms']
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  export = subparsers.add_parser('export', help='save the truncated VGG16 weights')
+  export.add_argument('--output', help='vgg_weights_path of the partial convolution script by default')
+  export.add_argument('--half', action='store_true')
+
+  distill = subparsers.add_parser('distill', help='train a light extractor on the VGG16 features')
+  distill.add_argument('--data-dir', required=True)
+  distill.add_argument('--output', default='light_extractor.pth')
+  distill.add_argument('--width', type=float, default=CONFIG['light_width'])
+  distill.add_argument('--epochs', type=int, default=CONFIG['distill_epochs'])
+  distill.add_argument('--device', default=CONFIG['device'])
+
+  evaluate = subparsers.add_parser('evaluate', help='speed / accuracy of a light extractor against VGG16')
+  evaluate.add_argument('--data-dir', required=True)
+  evaluate.add_argument('--light', required=True)
+  evaluate.add_argument('--device', default=CONFIG['device'])
+  args = parser.parse_args(argv)
+
+  if args.command == 'export':
+    path = export_vgg_slice(args.output, args.half)
+    print(f'{path} : {os.path.getsize(path) / 1024**2:.1f} MB')
+  elif args.command == 'distill':
+    distill_extractor(args.data_dir, args.output, args.width, args.epochs, device=args.device)
+  else:
+    report = evaluate_extractors(args.data_dir, load_light_extractor(args.light), device=args.device)
+    for name, values in report.items():
+      print(name, values)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,157 @@
+'''
+Persistent cache of the ground truth VGG features used by InpaintingLoss.
+
+The training targets are the fixed 128x128 crops of images.npy (artwork_inpainting.data), so the enc_1..enc_3
+activations of VGG16FeatureExtractor and their gram matrices are the same at every epoch. build_feature_cache()
+computes them once per image id and stores them memory mapped in the cache directory :
+
+  grams_{1,2,3}.npy      (N, ch*(ch+1)/2) upper triangles of the gram matrices (they are symmetric), float32
+  features_{1,2,3}.npy   (N, ch, h, w) feature maps, optional, float16 by default
+  meta.json              image names, shapes and dtypes, checked against the dataset when the cache is opened
+
+With the features cached, InpaintingLoss does not run the extractor on the ground truth at all; with only the gram
+matrices cached it still runs it for the perceptual term but skips the gram products.
+
+  python -m artwork_inpainting.feature_cache --data-dir /content/shared --features
+'''
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+CONFIG = {'gram_dtype':'float32',
+          'feature_dtype':'float16',
+          'batch_size':64,
+          'device':'cpu'}
+
+
+def build_feature_cache(data_dir, cache_dir=None, store_features=False, gram_dtype=CONFIG['gram_dtype'],
+                        feature_dtype=CONFIG['feature_dtype'], batch_size=CONFIG['batch_size'], device=CONFIG['device'],
+                        extractor=None, verbose=True):
+  '''
+  Precompute the ground truth gram matrices (and optionally the feature maps) of every image of data_dir.
+
+  data_dir : directory written by artwork_inpainting.data.prepare_shared_data()
+  cache_dir : output directory, data_dir/feature_cache by default
+  store_features : also store the enc_1..enc_3 feature maps, in feature_dtype
+  extractor : feature extractor to use, VGG16FeatureExtractor of the partial convolution script by default. The cache
+              is only valid for the extractor weights it was built with.
+  '''
+  import tqdm
+  import torch
+  from numpy.lib.format import open_memmap
+  from artwork_inpainting.data import MemmapDataset, load_meta
+  from artwork_inpainting.loader import load_script
+
+  cache_dir = cache_dir or os.path.join(data_dir, 'feature_cache')
+  os.makedirs(cache_dir, exist_ok=True)
+
+  script = load_script('pconv')
+  extractor = (extractor or script.VGG16FeatureExtractor()).to(device).eval()
+  dataset = MemmapDataset(data_dir)
+  dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+  with torch.no_grad():
+    shapes = [tuple(feat.shape[1:]) for feat in extractor(dataset[0][0][None].to(device))]
+
+  grams = [open_memmap(os.path.join(cache_dir, f'grams_{i+1}.npy'), mode='w+', dtype=gram_dtype,
+                       shape=(len(dataset), shape[0] * (shape[0] + 1) // 2)) for i, shape in enumerate(shapes)]
+  features = [open_memmap(os.path.join(cache_dir, f'features_{i+1}.npy'), mode='w+', dtype=feature_dtype,
+                          shape=(len(dataset),) + shape) for i, shape in enumerate(shapes)] if store_features else []
+  triu = [np.triu_indices(shape[0]) for shape in shapes]
+
+  with torch.no_grad():
+    for images, ids in tqdm.tqdm(dataloader, disable=not verbose):
+      ids = ids.numpy()
+      for i, feat in enumerate(extractor(images.to(device))):
+        gram = script.gram_matrix(feat)
+        grams[i][ids] = gram[:, triu[i][0], triu[i][1]].cpu().numpy()
+        if store_features:
+          features[i][ids] = feat.cpu().numpy()
+
+  for array in grams + features:
+    array.flush()
+
+  # written last, its presence marks a complete cache
+  with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+    json.dump({'names':load_meta(data_dir)['names'], 'shapes':shapes, 'gram_dtype':gram_dtype,
+               'feature_dtype':feature_dtype if store_features else None}, f)
+  return cache_dir
+
+
+class FeatureCache:
+  '''
+  Read side of the cache, lookup() returns the keyword arguments gt_feats / gt_grams of InpaintingLoss.forward for a
+  batch of image ids.
+
+  cache_dir : directory written by build_feature_cache()
+  data_dir : if given, the cache is checked to have been built for the same images
+  use_features : use the cached feature maps if they were stored
+  '''
+  def __init__(self, cache_dir, data_dir=None, use_features=True):
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+      self.meta = json.load(f)
+
+    if data_dir is not None:
+      from artwork_inpainting.data import load_meta
+      if load_meta(data_dir)['names'] != self.meta['names']:
+        raise ValueError(f'feature cache {cache_dir} was built for a different set of images than {data_dir}')
+
+    self.shapes = [tuple(shape) for shape in self.meta['shapes']]
+    self.grams = [np.load(os.path.join(cache_dir, f'grams_{i+1}.npy'), mmap_mode='r') for i in range(len(self.shapes))]
+    self.features = None
+    if use_features and self.meta['feature_dtype'] is not None:
+      self.features = [np.load(os.path.join(cache_dir, f'features_{i+1}.npy'), mmap_mode='r')
+                       for i in range(len(self.shapes))]
+    self.triu = [np.triu_indices(shape[0]) for shape in self.shapes]
+
+  def gram_matrices(self, ids, device='cpu'):
+    import torch
+
+    ids = np.asarray(ids)
+    grams = []
+    for i, (rows, cols) in enumerate(self.triu):
+      upper = torch.from_numpy(self.grams[i][ids].astype(np.float32)).to(device)
+      ch = self.shapes[i][0]
+      gram = torch.zeros(len(ids), ch, ch, device=device)
+      gram[:, rows, cols] = upper
+      gram[:, cols, rows] = upper # mirror the upper triangle, the diagonal is written twice with the same value
+      grams.append(gram)
+    return grams
+
+  def feature_maps(self, ids, device='cpu'):
+    import torch
+
+    ids = np.asarray(ids)
+    return [torch.from_numpy(features[ids].astype(np.float32)).to(device) for features in self.features]
+
+  def lookup(self, ids, device='cpu'):
+    '''
+    ids : image ids of the batch (the second item of the MemmapDataset batches), tensor or array
+    '''
+    ids = ids.cpu().numpy() if hasattr(ids, 'cpu') else np.asarray(ids)
+    cached = {'gt_grams':self.gram_matrices(ids, device)}
+    if self.features is not None:
+      cached['gt_feats'] = self.feature_maps(ids, device)
+    return cached
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--data-dir', required=True)
+  parser.add_argument('--cache-dir')
+  parser.add_argument('--features', action='store_true', help='also store the feature maps')
+  parser.add_argument('--feature-dtype', default=CONFIG['feature_dtype'])
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--device', default=CONFIG['device'])
+  args = parser.parse_args(argv)
+
+  cache_dir = build_feature_cache(args.data_dir, args.cache_dir, args.features, feature_dtype=args.feature_dtype,
+                                  batch_size=args.batch_size, device=args.device)
+  print(f'feature cache written to {cache_dir}')
+
+
+if __name__ == '__main__':
+  main()
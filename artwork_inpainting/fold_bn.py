@@ -0,0 +1,149 @@
+'''
+Inference preparation : BatchNorm folded into the preceding convolution.
+
+In eval mode BatchNorm2d is the per channel affine map y = s * (x - mean) + beta with s = gamma / sqrt(var + eps), so a
+convolution followed by it is the convolution with weights W * s and bias s * (b - mean) + beta, one memory pass less.
+fold_batchnorm() does it on a copy of the model for every conv / BatchNorm pair of the repo's blocks :
+
+  nn.Sequential        double_conv_layers() and the ResidualUnit conv1 / conv2 / skipconv, the BatchNorm becomes nn.Identity
+  DoubleConv           (conv1, bn1) and (conv2, bn2)
+  DoublePConv          (pconv1, bn1) and (pconv2, bn2), folded into PartialConv.input_conv
+
+PartialConv sets the windows without any valid pixel to 0 after the convolution, which the BatchNorm then maps to
+s * (0 - mean) + beta, not to 0. The renormalisation of the other windows is the identity (see PartialConv.forward), so
+with the bias folded the only difference is that constant, which is given to PartialConv.hole_fill.
+
+  python -m artwork_inpainting.fold_bn --models pconv_unet resnet_unet --batch-size 8
+'''
+
+import copy
+import argparse
+
+import torch
+from torch import nn
+
+from artwork_inpainting.benchmark import run_config, run_isolated
+from artwork_inpainting.loader import MODEL_SPECS, build_model, make_inputs
+
+CONFIG = {'models':['unet', 'unet_inception', 'unet_small', 'unet_bottleneck_inception', 'pconv_unet', 'resnet_unet'],
+          'batch_size':8,
+          'resolution':128,
+          'threads':4,
+          'warmup':2,
+          'iters':10}
+
+
+def _scale_shift(bn):
+  scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) if bn.affine else 1 / torch.sqrt(bn.running_var + bn.eps)
+  shift = bn.bias - scale * bn.running_mean if bn.affine else -scale * bn.running_mean
+  return scale, shift
+
+
+@torch.no_grad()
+def fold_conv_bn(conv, bn):
+  '''
+  Return a new Conv2d equal to bn(conv(x)) with bn in eval mode.
+  '''
+  scale, shift = _scale_shift(bn)
+  folded = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                     conv.groups, True, conv.padding_mode).to(conv.weight.device, conv.weight.dtype)
+  folded.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+  bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+  folded.bias.copy_(scale * bias + shift)
+  return folded
+
+
+def _is_bn(module):
+  return isinstance(module, nn.BatchNorm2d) and module.track_running_stats
+
+
+@torch.no_grad()
+def fold_batchnorm(model):
+  '''
+  Return an eval mode copy of model with every BatchNorm2d that follows a convolution folded into it. The copy is
+  meant for inference only : its outputs match model.eval() but it cannot be trained as before.
+  '''
+  model = copy.deepcopy(model).eval()
+
+  for module in list(model.modules()):
+    if isinstance(module, nn.Sequential):
+      for i in range(len(module) - 1):
+        if isinstance(module[i], nn.Conv2d) and _is_bn(module[i + 1]):
+          module[i] = fold_conv_bn(module[i], module[i + 1])
+          module[i + 1] = nn.Identity()
+
+    for conv_name, bn_name in [('conv1', 'bn1'), ('conv2', 'bn2'), ('pconv1', 'bn1'), ('pconv2', 'bn2')]:
+      conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+      if conv is None or not _is_bn(bn):
+        continue
+      if isinstance(conv, nn.Conv2d):
+        setattr(module, conv_name, fold_conv_bn(conv, bn))
+      elif hasattr(conv, 'input_conv') and hasattr(conv, 'hole_fill'): # PartialConv
+        conv.input_conv = fold_conv_bn(conv.input_conv, bn)
+        conv.hole_fill = _scale_shift(bn)[1].clone()
+      else:
+        continue
+      setattr(module, bn_name, nn.Identity())
+
+  return model
+
+
+def randomize_batchnorm(model, seed=0):
+  '''
+  Give every BatchNorm2d non trivial statistics and affine parameters, freshly built models have mean 0 / var 1 /
+  gamma 1 / beta 0 which would make the parity check pass trivially.
+  '''
+  generator = torch.Generator().manual_seed(seed)
+  with torch.no_grad():
+    for module in model.modules():
+      if isinstance(module, nn.BatchNorm2d):
+        module.running_mean.copy_(torch.randn(module.num_features, generator=generator) * 0.1)
+        module.running_var.copy_(torch.rand(module.num_features, generator=generator) + 0.5)
+        if module.affine:
+          module.weight.copy_(torch.rand(module.num_features, generator=generator) + 0.5)
+          module.bias.copy_(torch.randn(module.num_features, generator=generator) * 0.1)
+  return model
+
+
+def check_parity(model_name, batch_size, resolution):
+  '''
+  Maximum absolute difference between the eval mode outputs of the model and of its folded copy, and the number of
+  BatchNorm2d layers left in the folded model.
+  '''
+  torch.manual_seed(0)
+  model = randomize_batchnorm(build_model(model_name)).eval()
+  folded = fold_batchnorm(model)
+  inputs = make_inputs(model_name, batch_size, resolution)
+  with torch.no_grad():
+    diff = (model(*inputs) - folded(*inputs)).abs().max().item()
+  remaining = sum(isinstance(m, nn.BatchNorm2d) for m in folded.modules())
+  return {'max_abs_diff':diff, 'batchnorm_left':remaining}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--models', nargs='+', default=CONFIG['models'], choices=list(MODEL_SPECS))
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--resolution', type=int, default=CONFIG['resolution'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  parser.add_argument('--warmup', type=int, default=CONFIG['warmup'])
+  parser.add_argument('--iters', type=int, default=CONFIG['iters'])
+  args = parser.parse_args(argv)
+
+  for name in args.models:
+    parity = run_isolated(check_parity, name, args.batch_size, args.resolution)
+    timings = {}
+    for variant, prepare in [('batchnorm', None), ('folded', fold_batchnorm)]:
+      r = run_isolated(run_config, name, args.batch_size, args.resolution, args.threads, ['forward'], args.warmup,
+                       args.iters, prepare)
+      timings[variant] = r if 'error' in r else r[0]
+    if 'error' in parity or any('error' in r for r in timings.values()):
+      print(f"{name:>26} : ERROR {parity.get('error') or [r['error'] for r in timings.values() if 'error' in r][0]}")
+      continue
+    base, folded = timings['batchnorm']['latency_mean_ms'], timings['folded']['latency_mean_ms']
+    print(f"{name:>26} : forward {base:8.1f} -> {folded:8.1f} ms (x{base / folded:.2f})  "
+          f"max abs diff {parity['max_abs_diff']:.2e}  BatchNorm left {parity['batchnorm_left']}")
+
+
+if __name__ == '__main__':
+  main()
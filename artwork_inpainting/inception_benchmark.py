@@ -0,0 +1,107 @@
+'''
+Separate against merged 1x1 projections of InceptionModule, at every inception size of the models.
+
+With CONFIG['merge_inception_projections'] the 1x1 convolutions of channel_1, channel_2[0] and channel_3[0], which all
+read the module input, run as a single convolution split between the branches : one kernel and one pass over the input
+instead of three. Both layouts load the checkpoints of the other (InceptionModule._load_from_state_dict), which is also
+how the merged modules are built here, so the two are compared on the same weights.
+
+The input shapes of the InceptionModules are taken from a forward of every model using them, then every module size is
+timed on its own (forward and forward+backward) in a fresh process.
+
+  python -m artwork_inpainting.inception_benchmark --models pconv_unet --batch-size 8
+'''
+
+import argparse
+
+from artwork_inpainting.benchmark import measure, run_isolated
+from artwork_inpainting.loader import MODEL_SPECS, build_model, load_script, make_inputs
+
+CONFIG = {'models':['unet_inception', 'unet_bottleneck_inception', 'pconv_unet'],
+          'batch_size':8,
+          'resolution':128,
+          'threads':4,
+          'warmup':3,
+          'iters':20}
+
+
+def inception_shapes(model_name, resolution=CONFIG['resolution']):
+  '''
+  [(module name, (channels, height, width))] of the inputs of the InceptionModules of a model, in forward order.
+  '''
+  import torch
+
+  script = load_script(MODEL_SPECS[model_name]['script'])
+  model = build_model(model_name).eval()
+  shapes = []
+  handles = [module.register_forward_pre_hook(lambda m, args, name=name: shapes.append((name, tuple(args[0].shape[1:]))))
+             for name, module in model.named_modules() if isinstance(module, script.InceptionModule)]
+  with torch.no_grad():
+    model(*make_inputs(model_name, 1, resolution))
+  for handle in handles:
+    handle.remove()
+  return shapes
+
+
+def run_module(script_name, channels, height, width, batch_size, threads, warmup, iters):
+  '''
+  Time one InceptionModule size with separate and merged projections, same weights, and return the latencies and the
+  maximum absolute difference of the outputs.
+  '''
+  import torch
+
+  torch.set_num_threads(threads)
+  torch.manual_seed(0)
+  script = load_script(script_name)
+  separate = script.InceptionModule(channels, merge_projections=False)
+  merged = script.InceptionModule(channels, merge_projections=True)
+  merged.load_state_dict(separate.state_dict())
+  input = torch.rand(batch_size, channels, height, width)
+
+  report = {'channels':channels, 'height':height, 'width':width}
+  with torch.no_grad():
+    report['max_abs_diff'] = (separate(input) - merged(input)).abs().max().item()
+
+  for variant, module in [('separate', separate), ('merged', merged)]:
+    with torch.no_grad():
+      report[f'{variant}_forward_ms'] = measure(lambda: module(input), warmup, iters, batch_size)['latency_mean_ms']
+
+    def step():
+      module(input).mean().backward()
+      module.zero_grad(set_to_none=True)
+
+    report[f'{variant}_forward_backward_ms'] = measure(step, warmup, iters, batch_size)['latency_mean_ms']
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--models', nargs='+', default=CONFIG['models'], choices=list(MODEL_SPECS))
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--resolution', type=int, default=CONFIG['resolution'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  parser.add_argument('--warmup', type=int, default=CONFIG['warmup'])
+  parser.add_argument('--iters', type=int, default=CONFIG['iters'])
+  args = parser.parse_args(argv)
+
+  for model_name in args.models:
+    shapes = run_isolated(inception_shapes, model_name, args.resolution)
+    if 'error' in shapes:
+      print(f"{model_name} : ERROR {shapes['error']}")
+      continue
+    for name, (channels, height, width) in shapes:
+      r = run_isolated(run_module, MODEL_SPECS[model_name]['script'], channels, height, width, args.batch_size,
+                       args.threads, args.warmup, args.iters)
+      head = f'{model_name:>26} {name:<28} {channels:5d}x{height}x{width}'
+      if 'error' in r:
+        print(f"{head} : ERROR {r['error']}")
+        continue
+      print(f"{head} : forward {r['separate_forward_ms']:8.2f} -> {r['merged_forward_ms']:8.2f} ms "
+            f"(x{r['separate_forward_ms'] / r['merged_forward_ms']:.2f})  forward+backward "
+            f"{r['separate_forward_backward_ms']:8.2f} -> {r['merged_forward_backward_ms']:8.2f} ms "
+            f"(x{r['separate_forward_backward_ms'] / r['merged_forward_backward_ms']:.2f})  "
+            f"max abs diff {r['max_abs_diff']:.1e}")
+
+
+if __name__ == '__main__':
+  main()
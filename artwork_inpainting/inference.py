@@ -0,0 +1,562 @@
+'''
+Inference on full size artwork scans.
+
+The models are trained on 128x128 crops. tiled_inpaint() runs them over an image of any size : the image is cut into
+tile x tile crops overlapping by `overlap` pixels, the crops go through the model in batches and the predictions are
+blended with feathered weights (linear ramps over the overlap), so the seams between tiles do not show. Only the
+holes are taken from the model, so the tiles without any hole do not go through it.
+
+Memory does not grow with the image height : tiles are processed one row of tiles (a band) at a time and the
+accumulators only cover the current band, the rows no later band overlaps are written out as soon as the band is done.
+The image and mask are read lazily (slices of a numpy array or memory map) by a reader thread that prepares the next
+batches while the model runs, and a writer thread composites and stores the finished rows, so the I/O overlaps with
+the model (torch releases the GIL in its kernels).
+
+Conventions of the repo : images are float in [0, 1] (uint8 accepted), masks are True for valid pixels and False for
+holes, holes are set to 1 in the model input, and only the holes are replaced in the result (output_comp of
+InpaintingLoss). Mask image files are the other way round, non zero pixels mark the damage.
+
+Damage usually covers a small part of a scan : crop_inpaint() only runs the model around it. hole_regions() labels the
+connected damaged regions of the mask (on a coarse grid, with array operations only) and merges the close ones, every
+region is then inpainted from a window with some valid context around it, the small ones batched together.
+
+A 128x128 window does not see the structure of a hole larger than itself : pyramid_inpaint() inpaints a downscaled
+image first, then refines level by level up to the full resolution, only around the hole borders, with the upsampled
+result of the previous level as the fill of the holes.
+
+  python -m artwork_inpainting.inference --model pconv_unet --checkpoint model.pth --image scan.png --mask damage.png \\
+    --output restored.png [--mode crop|pyramid]
+'''
+
+import time
+import queue
+import argparse
+import threading
+
+import numpy as np
+
+from artwork_inpainting.loader import MODEL_SPECS, build_model
+
+CONFIG = {'tile':128,
+          'overlap':32,
+          'batch_size':16,
+          'prefetch':4, # batches prepared ahead by the reader thread
+          'context':32, # crop_inpaint : valid pixels kept around every damaged region
+          'cell':16, # crop_inpaint : damaged regions are found on a grid of cell x cell pixels
+          'merge_distance':32, # crop_inpaint : regions closer than this are inpainted together
+          'pyramid_scale':2, # pyramid_inpaint : size ratio between two levels
+          'band':32, # pyramid_inpaint : hole pixels closer than this to valid ones are refined at every level
+          'device':'cpu'}
+
+
+def load_inpainting_model(name, checkpoint=None, device=CONFIG['device']):
+  import torch
+
+  model = build_model(name)
+  if checkpoint is not None:
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+  return model.to(device).eval()
+
+
+def open_image(path):
+  '''
+  Image as an (H, W, 3) uint8 array : memory mapped for .npy files, decoded with PIL otherwise.
+  '''
+  if path.endswith('.npy'):
+    return np.load(path, mmap_mode='r')
+  from PIL import Image
+
+  Image.MAX_IMAGE_PIXELS = None # scans are legitimately larger than the decompression bomb limit
+  return np.asarray(Image.open(path).convert('RGB'))
+
+
+def open_mask(path):
+  '''
+  Valid pixel mask (True for valid) from a .npy bool array or a damage image (non zero pixels are holes).
+  '''
+  if path.endswith('.npy'):
+    return np.load(path, mmap_mode='r')
+  from PIL import Image
+
+  Image.MAX_IMAGE_PIXELS = None
+  return np.asarray(Image.open(path).convert('L')) == 0
+
+
+def save_image(array, path):
+  if path.endswith('.npy'):
+    np.save(path, array)
+    return
+  from PIL import Image
+
+  Image.fromarray(to_uint8(array)).save(path)
+
+
+def to_uint8(array):
+  return array if array.dtype == np.uint8 else (np.clip(array, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+
+def to_float(array):
+  return array.astype(np.float32) / 255 if array.dtype == np.uint8 else array.astype(np.float32)
+
+
+def tile_positions(size, tile, overlap):
+  '''
+  Start offsets of the tiles along one axis : every `tile - overlap` pixels, the last tile aligned on the end.
+  '''
+  if size <= tile:
+    return [0]
+  stride = tile - overlap
+  positions = list(range(0, size - tile, stride))
+  return positions + [size - tile]
+
+
+def feather_window(tile, overlap):
+  '''
+  (tile, tile) blending weights, 1 in the centre and decreasing linearly to 1 / (overlap + 1) on the borders over
+  `overlap` pixels. The weights never reach 0, so image borders (covered by a single tile) are still normalised.
+  '''
+  ramp = np.minimum(1.0, (np.arange(tile) + 1) / (overlap + 1))
+  ramp = np.minimum(ramp, ramp[::-1])
+  return np.outer(ramp, ramp).astype(np.float32)
+
+
+def model_inputs(kind, image, mask):
+  '''
+  Positional inputs of a model from a float image batch (N, 3, h, w) and a float valid mask batch (N, 1, h, w).
+  '''
+  image = image * mask + (1 - mask) # holes set to 1 like get_masked_inputs
+  return (image,) if kind == 'image' else (image, mask.expand(-1, 3, -1, -1).contiguous())
+
+
+def _pad(array, height, width):
+  pad = [(0, height - array.shape[0]), (0, width - array.shape[1])] + [(0, 0)] * (array.ndim - 2)
+  return np.pad(array, pad, mode='edge') if any(p[1] for p in pad) else array
+
+
+def _reader(image, mask, bands, xs, tile, batch_size, skip_valid, batches, stop):
+  try:
+    for band, y in enumerate(bands):
+      band_mask = np.asarray(mask[y:y + tile])
+      band_xs = [x for x in xs if not (skip_valid and band_mask[:, x:x + tile].all())]
+      for start in range(0, len(band_xs), batch_size):
+        tiles, masks = [], []
+        for x in band_xs[start:start + batch_size]:
+          tiles.append(_pad(to_float(np.asarray(image[y:y + tile, x:x + tile])), tile, tile))
+          masks.append(_pad(band_mask[:, x:x + tile], tile, tile))
+        if stop.is_set():
+          return
+        batches.put((band, band_xs[start:start + batch_size], np.stack(tiles), np.stack(masks)))
+    batches.put(None)
+  except Exception as e:
+    batches.put(e)
+
+
+def _writer(image, mask, output, composite, rows, errors):
+  while True:
+    item = rows.get()
+    if item is None:
+      return
+    y0, prediction = item
+    try:
+      y1 = y0 + len(prediction)
+      if composite:
+        valid = np.asarray(mask[y0:y1])[..., None]
+        prediction = np.where(valid, to_float(np.asarray(image[y0:y1])), prediction)
+      output[y0:y1] = to_uint8(prediction) if output.dtype == np.uint8 else prediction
+    except Exception as e:
+      errors.append(e)
+
+
+def tiled_inpaint(model, image, mask, inputs='image_mask', tile=CONFIG['tile'], overlap=CONFIG['overlap'],
+                  batch_size=CONFIG['batch_size'], device=CONFIG['device'], output=None, composite=True,
+                  prefetch=CONFIG['prefetch']):
+  '''
+  Inpaint an image of any size tile by tile and return the result.
+
+  model : inpainting model in eval mode
+  image : (H, W, 3) uint8 or float array, or memory map
+  mask : (H, W) bool array, True for valid pixels
+  inputs : 'image' or 'image_mask', what the model forward takes (MODEL_SPECS[name]['inputs'])
+  output : (H, W, 3) array (e.g. np.lib.format.open_memmap) written in place, a float32 array by default
+  composite : keep the valid pixels of the image and only take the holes from the model, the tiles without holes
+    (whose prediction would only cover valid pixels) then do not go through the model
+  '''
+  import torch
+
+  if not 0 <= overlap < tile:
+    raise ValueError(f'overlap must be in [0, tile), got {overlap} for tiles of {tile}')
+  height, width = image.shape[:2]
+  if output is None:
+    output = np.empty((height, width, 3), dtype=np.float32)
+  bands, xs = tile_positions(height, tile, overlap), tile_positions(width, tile, overlap)
+  window = feather_window(tile, overlap)
+  # accumulators of one band, padded to whole tiles for the images smaller than a tile
+  padded_width = max(width, tile)
+  accumulator = np.zeros((tile, padded_width, 3), dtype=np.float32)
+  weights = np.zeros((tile, padded_width), dtype=np.float32)
+
+  batches, rows = queue.Queue(maxsize=prefetch), queue.Queue(maxsize=prefetch)
+  stop, errors = threading.Event(), []
+  reader = threading.Thread(target=_reader, args=(image, mask, bands, xs, tile, batch_size, composite, batches,
+                                                           stop), daemon=True)
+  writer = threading.Thread(target=_writer, args=(image, mask, output, composite, rows, errors), daemon=True)
+  reader.start()
+  writer.start()
+
+  def flush(band, end):
+    # rows [bands[band], end) are final, the following ones are shifted to the top of the accumulators
+    y0 = bands[band]
+    n = min(end, height) - y0
+    # the pixels of skipped tiles only (valid ones, replaced by the composite) have no weight
+    rows.put((y0, accumulator[:n, :width] / np.maximum(weights[:n, :width, None], 1e-12)))
+    accumulator[:tile - (end - y0)] = accumulator[end - y0:].copy()
+    accumulator[tile - (end - y0):] = 0
+    weights[:tile - (end - y0)] = weights[end - y0:].copy()
+    weights[tile - (end - y0):] = 0
+
+  current = 0
+  try:
+    with torch.no_grad():
+      while True:
+        item = batches.get()
+        if isinstance(item, Exception):
+          raise item
+        band = item[0] if item is not None else len(bands)
+        while current < band: # every tile of the previous bands went through the model
+          flush(current, bands[current + 1] if current + 1 < len(bands) else bands[current] + tile)
+          current += 1
+        if item is None:
+          break
+
+        _, batch_xs, tiles, masks = item
+        image_batch = torch.from_numpy(tiles).permute(0, 3, 1, 2).to(device)
+        mask_batch = torch.from_numpy(masks[:, None].astype(np.float32)).to(device)
+        prediction = model(*model_inputs(inputs, image_batch, mask_batch)).permute(0, 2, 3, 1).float().cpu().numpy()
+        for x, pred in zip(batch_xs, prediction):
+          accumulator[:, x:x + tile] += pred * window[..., None]
+          weights[:, x:x + tile] += window
+  finally:
+    stop.set()
+    rows.put(None)
+    writer.join()
+  if errors:
+    raise errors[0]
+  return output
+
+
+def _dilate(grid, radius):
+  # square (2 radius + 1) dilation of a bool grid, separable into a row and a column pass of shifted ors
+  for axis in (0, 1):
+    padded = np.pad(grid, [(radius, radius) if a == axis else (0, 0) for a in (0, 1)])
+    length = grid.shape[axis]
+    grid = np.logical_or.reduce([padded.take(np.arange(shift, shift + length), axis=axis)
+                                 for shift in range(2 * radius + 1)])
+  return grid
+
+
+def label_components(grid):
+  '''
+  8-connected component labels of a bool grid : 0 for background, 1..n for the components, and n.
+
+  Every foreground cell starts labelled with its own flat index, then the labels are propagated as the minimum over the
+  3x3 neighbourhood followed by pointer jumping (label = label of the cell the label points to) until nothing changes,
+  whole array operations only, in a number of iterations logarithmic rather than linear in the component size.
+  '''
+  height, width = grid.shape
+  background = height * width
+  labels = np.where(grid, np.arange(background).reshape(height, width), background)
+  while True:
+    padded = np.pad(labels, 1, constant_values=background)
+    neighbours = np.minimum.reduce([padded[dy:dy + height, dx:dx + width] for dy in range(3) for dx in range(3)])
+    new = np.where(grid, neighbours, background).ravel()
+    foreground = new < background
+    new[foreground] = new[new[foreground]] # pointer jumping
+    new = new.reshape(height, width)
+    if np.array_equal(new, labels):
+      break
+    labels = new
+  roots, inverse = np.unique(labels, return_inverse=True)
+  inverse = inverse.reshape(height, width) + 1
+  n = len(roots) - (roots[-1] == background)
+  return np.where(grid, inverse, 0), int(n)
+
+
+def hole_regions(mask, cell=CONFIG['cell'], merge_distance=CONFIG['merge_distance'], chunk_rows=4096):
+  '''
+  Bounding boxes [(y0, y1, x0, x1)] of the damaged regions of a valid pixel mask.
+
+  The mask is reduced to a grid of cell x cell cells (a cell is damaged if it has any hole pixel), read by chunks of
+  rows so a memory mapped mask is never loaded whole. Damaged cells closer than merge_distance pixels are merged into
+  one region by labelling the dilated grid, the boxes are those of the damaged cells of every region.
+  '''
+  height, width = mask.shape
+  grid_height, grid_width = -(-height // cell), -(-width // cell)
+  grid = np.zeros((grid_height, grid_width), dtype=bool)
+  chunk_rows = max(cell, chunk_rows // cell * cell)
+  for y in range(0, height, chunk_rows):
+    holes = ~np.asarray(mask[y:y + chunk_rows])
+    holes = np.pad(holes, [(0, -(-len(holes) // cell) * cell - len(holes)), (0, grid_width * cell - width)])
+    grid[y // cell:y // cell + len(holes) // cell] = holes.reshape(len(holes) // cell, cell, grid_width, cell).any((1, 3))
+
+  radius = -(-merge_distance // (2 * cell)) # two regions grown by half the distance each touch
+  labels, n = label_components(_dilate(grid, radius) if radius else grid)
+  ys, xs = np.nonzero(grid)
+  ids = labels[ys, xs] - 1
+  boxes = np.stack([np.full(n, grid_height), np.zeros(n, int), np.full(n, grid_width), np.zeros(n, int)], 1)
+  np.minimum.at(boxes[:, 0], ids, ys)
+  np.maximum.at(boxes[:, 1], ids, ys + 1)
+  np.minimum.at(boxes[:, 2], ids, xs)
+  np.maximum.at(boxes[:, 3], ids, xs + 1)
+  boxes = boxes[boxes[:, 1] > 0] * cell
+  return [(y0, min(y1, height), x0, min(x1, width)) for y0, y1, x0, x1 in boxes.tolist()]
+
+
+def _window(start, stop, crop, size):
+  # crop long window centred on [start, stop), kept inside the image when it fits
+  return min(max(0, (start + stop) // 2 - crop // 2), max(0, size - crop))
+
+
+def _copy_rows(source, destination, chunk_rows=4096):
+  for y in range(0, len(source), chunk_rows):
+    rows = np.asarray(source[y:y + chunk_rows])
+    destination[y:y + chunk_rows] = to_uint8(rows) if destination.dtype == np.uint8 else to_float(rows)
+
+
+def crop_inpaint(model, image, mask, inputs='image_mask', crop=CONFIG['tile'], context=CONFIG['context'],
+                 cell=CONFIG['cell'], merge_distance=CONFIG['merge_distance'], batch_size=CONFIG['batch_size'],
+                 device=CONFIG['device'], output=None, overlap=CONFIG['overlap']):
+  '''
+  Inpaint only around the damaged regions of an image and return the result (the image with its holes filled).
+
+  Every region of hole_regions() grown by `context` pixels of valid surroundings that fits in a crop x crop window is
+  inpainted from a window centred on it, these windows go through the model in batches; larger regions are inpainted
+  with tiled_inpaint() on their padded box. Only the hole pixels inside the region box are written back, like
+  output_comp of InpaintingLoss. Apart from one pass over the mask, the cost scales with the damaged area.
+
+  output : (H, W, 3) array written in place, a float32 copy of the image by default
+  '''
+  import torch
+
+  height, width = image.shape[:2]
+  if output is None:
+    output = np.empty((height, width, 3), dtype=np.float32)
+  _copy_rows(image, output)
+
+  def write(box, window_y, window_x, prediction):
+    y0, y1, x0, x1 = box
+    holes = ~np.asarray(mask[y0:y1, x0:x1])
+    values = prediction[y0 - window_y:y1 - window_y, x0 - window_x:x1 - window_x][holes]
+    region = output[y0:y1, x0:x1]
+    region[holes] = to_uint8(values) if output.dtype == np.uint8 else values
+    output[y0:y1, x0:x1] = region
+
+  windows, large = [], []
+  for box in hole_regions(mask, cell, merge_distance):
+    y0, y1, x0, x1 = box
+    if y1 - y0 + 2 * context <= crop and x1 - x0 + 2 * context <= crop:
+      windows.append((box, _window(y0, y1, crop, height), _window(x0, x1, crop, width)))
+    else:
+      large.append(box)
+
+  with torch.no_grad():
+    for start in range(0, len(windows), batch_size):
+      batch = windows[start:start + batch_size]
+      tiles = np.stack([_pad(to_float(np.asarray(image[wy:wy + crop, wx:wx + crop])), crop, crop) for _, wy, wx in batch])
+      masks = np.stack([_pad(np.asarray(mask[wy:wy + crop, wx:wx + crop]), crop, crop) for _, wy, wx in batch])
+      image_batch = torch.from_numpy(tiles).permute(0, 3, 1, 2).to(device)
+      mask_batch = torch.from_numpy(masks[:, None].astype(np.float32)).to(device)
+      prediction = model(*model_inputs(inputs, image_batch, mask_batch)).permute(0, 2, 3, 1).float().cpu().numpy()
+      for (box, wy, wx), pred in zip(batch, prediction):
+        write(box, wy, wx, pred)
+
+  for box in large:
+    y0, y1, x0, x1 = box
+    py0, py1 = max(0, y0 - context), min(height, y1 + context)
+    px0, px1 = max(0, x0 - context), min(width, x1 + context)
+    prediction = tiled_inpaint(model, image[py0:py1, px0:px1], mask[py0:py1, px0:px1], inputs, crop, overlap,
+                               batch_size, device)
+    write(box, py0, px0, prediction)
+  return output
+
+
+class _CountingModel:
+  # model wrapper counting the pixels that go through the model, the cost measure of pyramid_inpaint
+  def __init__(self, model):
+    self.model = model
+    self.pixels = 0
+
+  def __call__(self, image, *inputs):
+    self.pixels += image.shape[0] * image.shape[2] * image.shape[3]
+    return self.model(image, *inputs)
+
+
+def build_pyramid(image, mask, tile=CONFIG['tile'], scale=CONFIG['pyramid_scale']):
+  '''
+  [(image, mask)] from the coarsest level to the full resolution, (h, w, 3) float32 and (h, w) bool arrays. Every level
+  is `scale` times smaller than the next one (area downscaling), down to the first one that fits in a tile. A coarse
+  pixel is valid only if all the pixels it covers are.
+  '''
+  import torch
+  import torch.nn.functional as F
+
+  levels = [(torch.from_numpy(to_float(np.asarray(image))).permute(2, 0, 1)[None],
+             torch.from_numpy(np.asarray(mask, dtype=np.float32))[None, None])]
+  while max(levels[-1][1].shape[-2:]) > tile:
+    image_level, valid = levels[-1]
+    size = tuple(max(1, round(s / scale)) for s in valid.shape[-2:])
+    levels.append((F.interpolate(image_level, size, mode='area'), (F.interpolate(valid, size, mode='area') > 1 - 1e-6).float()))
+  return [(image_level[0].permute(1, 2, 0).numpy(), valid[0, 0].numpy() > 0) for image_level, valid in levels[::-1]]
+
+
+def pyramid_inpaint(model, image, mask, inputs='image_mask', tile=CONFIG['tile'], overlap=CONFIG['overlap'],
+                    band=CONFIG['band'], scale=CONFIG['pyramid_scale'], context=CONFIG['context'],
+                    cell=CONFIG['cell'], merge_distance=CONFIG['merge_distance'], batch_size=CONFIG['batch_size'],
+                    device=CONFIG['device']):
+  '''
+  Coarse to fine inpainting : return the (H, W, 3) float32 result and the cost of every level, a list of
+  {'height', 'width', 'refined_pixels', 'model_pixels', 'seconds'} from the coarsest level.
+
+  The coarsest level of build_pyramid() (the whole image in about one tile, where the model sees the structure of the
+  large holes) is inpainted with tiled_inpaint(). At every finer level the previous result is upsampled as the initial
+  fill of the holes, and the hole pixels within `band` pixels of valid ones are inpainted again with crop_inpaint(),
+  the fill of the deeper ones being taken as valid context. Every hole pixel thus gets its detail from the finest
+  level where it is close enough to the valid pixels, and the work at full resolution is limited to the hole borders.
+  The whole image is held in memory, unlike tiled_inpaint() and crop_inpaint().
+  '''
+  import torch
+  import torch.nn.functional as F
+
+  result, stats = None, []
+  for image_level, valid in build_pyramid(image, mask, tile, scale):
+    height, width = valid.shape
+    counter = _CountingModel(model)
+    start = time.perf_counter()
+    if result is None:
+      refine = ~valid
+      result = tiled_inpaint(counter, image_level, valid, inputs, tile, overlap, batch_size, device)
+    else:
+      fill = F.interpolate(torch.from_numpy(result).permute(2, 0, 1)[None], (height, width), mode='bilinear',
+                           align_corners=False)[0].permute(1, 2, 0).numpy()
+      near_valid = F.max_pool2d(torch.from_numpy(valid[None, None].astype(np.float32)), 2 * band + 1, 1, band)
+      refine = ~valid & (near_valid[0, 0].numpy() > 0)
+      result = crop_inpaint(counter, np.where(valid[..., None], image_level, fill), ~refine, inputs, tile, context,
+                            cell, merge_distance, batch_size, device, overlap=overlap)
+    stats.append({'height':height, 'width':width, 'refined_pixels':int(refine.sum()), 'model_pixels':counter.pixels,
+                  'seconds':time.perf_counter() - start})
+  return result, stats
+
+
+def tiled_cost(height, width, tile=CONFIG['tile'], overlap=CONFIG['overlap'], mask=None):
+  '''
+  Pixels that go through the model with tiled_inpaint() on a height x width image : every tile, or with the (H, W)
+  valid mask of a composited result, the tiles with holes only.
+  '''
+  ys, xs = tile_positions(height, tile, overlap), tile_positions(width, tile, overlap)
+  if mask is None:
+    return len(ys) * len(xs) * tile * tile
+  return sum(not np.asarray(mask[y:y + tile, x:x + tile]).all() for y in ys for x in xs) * tile * tile
+
+
+_models = {}
+
+
+def inpaint(image, mask, model='pconv_unet', checkpoint=None, mode='tiled', device=CONFIG['device'], **kwargs):
+  '''
+  Inpaint an image and return the (H, W, 3) uint8 result, the entry point of the package (artwork_inpainting.inpaint).
+
+  image : (H, W, 3) uint8 or float array, or path of an image file or .npy
+  mask : (H, W) bool array (True for valid pixels), or path of a damage image (non zero = hole) or .npy
+  model : key of MODEL_SPECS, or an already built model in eval mode taking an image and a mask
+  checkpoint : state_dict of the model, loaded models are kept for the next calls
+  mode : 'tiled', 'crop' or 'pyramid' (tiled_inpaint, crop_inpaint, pyramid_inpaint), kwargs are passed to it
+  '''
+  inputs = 'image_mask'
+  if isinstance(model, str):
+    inputs = MODEL_SPECS[model]['inputs']
+    key = (model, checkpoint, device)
+    if key not in _models:
+      _models[key] = load_inpainting_model(model, checkpoint, device)
+    model = _models[key]
+  image = open_image(image) if isinstance(image, str) else image
+  mask = open_mask(mask) if isinstance(mask, str) else mask
+
+  if mode == 'tiled':
+    result = tiled_inpaint(model, image, mask, inputs, device=device, **kwargs)
+  elif mode == 'crop':
+    result = crop_inpaint(model, image, mask, inputs, device=device, **kwargs)
+  elif mode == 'pyramid':
+    result = pyramid_inpaint(model, image, mask, inputs, device=device, **kwargs)[0]
+  else:
+    raise ValueError(f"mode must be 'tiled', 'crop' or 'pyramid', got {mode!r}")
+  return to_uint8(result)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--model', default='pconv_unet', choices=list(MODEL_SPECS))
+  parser.add_argument('--checkpoint')
+  parser.add_argument('--image', required=True, help='image file or (H, W, 3) uint8 .npy')
+  parser.add_argument('--mask', required=True, help='damage image (non zero = hole) or (H, W) bool .npy (True = valid)')
+  parser.add_argument('--output', required=True, help='image file or .npy (written as a memory map)')
+  parser.add_argument('--mode', default='tiled', choices=['tiled', 'crop', 'pyramid'],
+                      help='tiled : the whole image, crop : only windows around the damaged regions, '
+                           'pyramid : coarse to fine')
+  parser.add_argument('--tile', type=int, default=CONFIG['tile'])
+  parser.add_argument('--overlap', type=int, default=CONFIG['overlap'])
+  parser.add_argument('--context', type=int, default=CONFIG['context'])
+  parser.add_argument('--merge-distance', type=int, default=CONFIG['merge_distance'])
+  parser.add_argument('--band', type=int, default=CONFIG['band'])
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--device', default=CONFIG['device'])
+  parser.add_argument('--compare', action='store_true', help='pyramid mode : also time flat tiling')
+  args = parser.parse_args(argv)
+
+  from artwork_inpainting.benchmark import peak_rss_mb
+
+  model = load_inpainting_model(args.model, args.checkpoint, args.device)
+  image, mask = open_image(args.image), open_mask(args.mask)
+  output = None
+  if args.output.endswith('.npy'):
+    output = np.lib.format.open_memmap(args.output, mode='w+', dtype=np.uint8, shape=image.shape[:2] + (3,))
+
+  start = time.perf_counter()
+  if args.mode == 'tiled':
+    result = tiled_inpaint(model, image, mask, MODEL_SPECS[args.model]['inputs'], args.tile, args.overlap,
+                           args.batch_size, args.device, output)
+  elif args.mode == 'crop':
+    regions = hole_regions(mask, CONFIG['cell'], args.merge_distance)
+    area = sum((y1 - y0 + 2 * args.context) * (x1 - x0 + 2 * args.context) for y0, y1, x0, x1 in regions)
+    print(f'{len(regions)} damaged regions, about {min(1.0, area / mask.size):.1%} of the image processed')
+    result = crop_inpaint(model, image, mask, MODEL_SPECS[args.model]['inputs'], args.tile, args.context,
+                          merge_distance=args.merge_distance, batch_size=args.batch_size, device=args.device,
+                          output=output, overlap=args.overlap)
+  elif args.mode == 'pyramid':
+    result, stats = pyramid_inpaint(model, image, mask, MODEL_SPECS[args.model]['inputs'], args.tile, args.overlap,
+                                    args.band, context=args.context, merge_distance=args.merge_distance,
+                                    batch_size=args.batch_size, device=args.device)
+    if output is not None:
+      _copy_rows(result, output)
+  elapsed = time.perf_counter() - start
+
+  if args.mode == 'pyramid':
+    flat = tiled_cost(*image.shape[:2], args.tile, args.overlap, mask)
+    for level in stats:
+      print(f"{level['width']:6d}x{level['height']:<6d} : {level['refined_pixels']:10d} pixels refined, "
+            f"{level['model_pixels']:10d} through the model, {level['seconds']:.2f} s")
+    total = sum(level['model_pixels'] for level in stats)
+    print(f'pyramid : {total} pixels through the model in {elapsed:.1f} s, flat tiling : {flat} pixels '
+          f'({flat / max(total, 1):.1f}x the pyramid)')
+    if args.compare:
+      start = time.perf_counter()
+      tiled_inpaint(model, image, mask, MODEL_SPECS[args.model]['inputs'], args.tile, args.overlap, args.batch_size,
+                    args.device)
+      print(f'flat tiling : {time.perf_counter() - start:.1f} s')
+  if output is None:
+    save_image(result, args.output)
+  else:
+    output.flush()
+  print(f'{image.shape[1]}x{image.shape[0]} inpainted in {elapsed:.1f} s, peak memory {peak_rss_mb():.0f} MB')
+
+
+if __name__ == '__main__':
+  main()
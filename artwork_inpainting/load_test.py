@@ -0,0 +1,127 @@
+'''
+Load generator for the inpainting service (artwork_inpainting.serve).
+
+`concurrency` client threads, each with its own keep alive connection, send random image / mask pairs (rectangular
+holes) back to back until `requests` have been answered. Client side throughput and latency percentiles are printed
+with the server metrics (batch size histogram, queue depth), to tune --max-batch-size / --max-delay-ms of the server.
+
+  python -m artwork_inpainting.serve --port 8080 &
+  python -m artwork_inpainting.load_test --port 8080 --concurrency 1 4 16 --requests 200
+'''
+
+import json
+import time
+import argparse
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from artwork_inpainting.benchmark import percentile
+from artwork_inpainting.serve import CONFIG as SERVE_CONFIG, decode_arrays, encode_arrays
+
+CONFIG = {'host':SERVE_CONFIG['host'],
+          'port':SERVE_CONFIG['port'],
+          'concurrency':[1, 4, 16],
+          'requests':200,
+          'resolution':128,
+          'payloads':16, # distinct random requests, cycled through
+          'seed':0}
+
+
+def random_payloads(n, resolution, seed=CONFIG['seed']):
+  '''
+  n encoded requests : random uint8 images with 1 to 4 rectangular holes each.
+  '''
+  rng = np.random.default_rng(seed)
+  payloads = []
+  for _ in range(n):
+    image = rng.integers(0, 256, (resolution, resolution, 3), dtype=np.uint8)
+    mask = np.ones((resolution, resolution), dtype=bool)
+    for _ in range(rng.integers(1, 5)):
+      h, w = rng.integers(resolution // 16, resolution // 3, 2)
+      y, x = rng.integers(0, resolution - h), rng.integers(0, resolution - w)
+      mask[y:y + h, x:x + w] = False
+    payloads.append(encode_arrays(image=image, mask=mask))
+  return payloads
+
+
+def _request(connection, method, path, body=None):
+  headers = {'Content-Type':'application/octet-stream'} if body is not None else {}
+  connection.request(method, path, body, headers)
+  response = connection.getresponse()
+  data = response.read()
+  if response.status != 200:
+    raise RuntimeError(f'{method} {path} : {response.status} {data.decode(errors="replace")}')
+  return data
+
+
+def get_metrics(host=CONFIG['host'], port=CONFIG['port']):
+  connection = http.client.HTTPConnection(host, port)
+  try:
+    return json.loads(_request(connection, 'GET', '/metrics'))
+  finally:
+    connection.close()
+
+
+def _client(host, port, payloads, count, offset):
+  connection = http.client.HTTPConnection(host, port)
+  latencies, errors = [], 0
+  try:
+    for i in range(count):
+      start = time.perf_counter()
+      try:
+        decode_arrays(_request(connection, 'POST', '/inpaint', payloads[(offset + i) % len(payloads)]))
+        latencies.append(time.perf_counter() - start)
+      except (RuntimeError, OSError, http.client.HTTPException):
+        errors += 1
+        connection.close()
+        connection = http.client.HTTPConnection(host, port)
+  finally:
+    connection.close()
+  return latencies, errors
+
+
+def run_load(host, port, concurrency, n_requests, payloads):
+  '''
+  Send n_requests from `concurrency` clients and return the client side throughput and latency statistics.
+  '''
+  counts = [n_requests // concurrency + (i < n_requests % concurrency) for i in range(concurrency)]
+  start = time.perf_counter()
+  with ThreadPoolExecutor(concurrency) as pool:
+    results = list(pool.map(_client, [host] * concurrency, [port] * concurrency, [payloads] * concurrency, counts,
+                            range(concurrency)))
+  elapsed = time.perf_counter() - start
+  latencies = [1000 * l for r in results for l in r[0]]
+  report = {'concurrency':concurrency, 'requests':len(latencies), 'errors':sum(r[1] for r in results),
+            'seconds':elapsed, 'throughput':len(latencies) / elapsed}
+  if latencies:
+    report.update({f'latency_p{q}_ms':percentile(latencies, q) for q in (50, 95, 99)})
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--host', default=CONFIG['host'])
+  parser.add_argument('--port', type=int, default=CONFIG['port'])
+  parser.add_argument('--concurrency', nargs='+', type=int, default=CONFIG['concurrency'])
+  parser.add_argument('--requests', type=int, default=CONFIG['requests'])
+  parser.add_argument('--resolution', type=int, default=CONFIG['resolution'])
+  args = parser.parse_args(argv)
+
+  payloads = random_payloads(CONFIG['payloads'], args.resolution)
+  for concurrency in args.concurrency:
+    before = get_metrics(args.host, args.port)
+    r = run_load(args.host, args.port, concurrency, args.requests, payloads)
+    after = get_metrics(args.host, args.port)
+    batches = after['batches'] - before['batches']
+    mean_batch = (after['completed'] - before['completed']) / batches if batches else 0.0
+    latency = (f"p50 {r['latency_p50_ms']:.1f} p95 {r['latency_p95_ms']:.1f} p99 {r['latency_p99_ms']:.1f} ms"
+               if r['requests'] else 'no successful request')
+    print(f"concurrency {concurrency:3d} : {r['throughput']:7.1f} images/s  {latency}  mean batch {mean_batch:.1f}  "
+          f"errors {r['errors']}")
+  print(f"server : {json.dumps(get_metrics(args.host, args.port))}")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,210 @@
+'''
+Load the model definitions out of the Colab exported training scripts.
+
+The scripts in the repository root were exported from notebooks, so they contain `!unzip` shell lines, demo forward
+passes, mask generation and dataset copying at top level. load_script() only executes the parts needed to use the
+classes and functions defined in a script : the `CONFIG` dictionary, the function and class definitions and the
+imports these definitions actually reference.
+
+The heavy optional imports of the scripts (LAZY_IMPORTS : torchvision, matplotlib, sklearn, ...) which are only read
+inside function bodies are not executed either : the names are bound to stand-ins that run the import on first use,
+so loading a script to build a model only imports torch.
+'''
+
+import os
+import ast
+import types
+import importlib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# short names for the scripts containing model definitions
+SCRIPTS = {'unet':'training_loop_without_contrastive_learning.py',
+           'unet_inception':'unet_with_inception_modules.py',
+           'pconv':'pcinception_training_loop_without_contrastive_learning.py',
+           'resnet':'resnet_encoder.py',
+           'simclr':'training_code_simclr_first_draft.py'}
+
+# every architecture we compare, 'inputs' tells if forward takes (image) or (image, mask)
+MODEL_SPECS = {'unet':{'script':'unet', 'class':'UNet', 'kwargs':{}, 'inputs':'image'},
+               'unet_inception':{'script':'unet', 'class':'UNet', 'kwargs':{'add_inception':True}, 'inputs':'image'},
+               'unet_small':{'script':'unet', 'class':'UNet',
+                             'kwargs':{'down_conv_out':[16, 32, 64, 128], 'up_conv_out':[64, 32, 16]}, 'inputs':'image'},
+               'unet_bottleneck_inception':{'script':'unet_inception', 'class':'UNet', 'kwargs':{'add_inception':True},
+                                            'inputs':'image'},
+               'pconv_unet':{'script':'pconv', 'class':'PartialConvUNet', 'kwargs':{}, 'inputs':'image_mask'},
+               'resnet_unet':{'script':'resnet', 'class':'ResNetUNet', 'kwargs':{}, 'inputs':'image'}}
+
+# top level packages imported on first use when no definition needs them at definition time
+LAZY_IMPORTS = ('torchvision', 'torchsummary', 'matplotlib', 'sklearn', 'pandas', 'tqdm', 'PIL')
+
+_cache = {}
+
+
+def _script_path(script):
+  return script if os.path.isabs(script) else os.path.join(REPO_DIR, SCRIPTS.get(script, script))
+
+
+def _bound_names(node):
+  '''
+  Names bound by an import statement, "import torch.nn.functional as F" binds F and "import torch.nn" binds torch.
+  '''
+  return [alias.asname or alias.name.split('.')[0] for alias in node.names]
+
+
+def _names(nodes):
+  return {n.id for node in nodes for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+def _definition_time_names(node):
+  '''
+  Names read when a top level node is executed, as opposed to the ones only read when a function it defines is called.
+  '''
+  if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+    args = node.args
+    annotations = [a.annotation for a in args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg]
+                   if a is not None and a.annotation is not None]
+    return _names(node.decorator_list + args.defaults + [d for d in args.kw_defaults if d is not None] + annotations
+                  + ([node.returns] if node.returns else []))
+  if isinstance(node, ast.ClassDef):
+    names = _names(node.decorator_list + node.bases + [k.value for k in node.keywords])
+    return names.union(*[_definition_time_names(child) for child in node.body])
+  return _names([node])
+
+
+class _LazyImport:
+  '''
+  Stand-in bound to an imported name of a loaded script : the import runs on first attribute access or call, and the
+  real object then replaces the stand-in in the script namespace.
+  '''
+  def __init__(self, namespace, name, module, attr=None):
+    self._namespace, self._name, self._module, self._attr = namespace, name, module, attr
+
+  def _resolve(self):
+    module = importlib.import_module(self._module)
+    if self._attr is None: # "import a.b" binds a, "import a.b as c" binds a.b
+      obj = module if self._name != self._module.split('.')[0] else importlib.import_module(self._name)
+    elif hasattr(module, self._attr):
+      obj = getattr(module, self._attr)
+    else: # "from a import b" with b a submodule not imported by a
+      obj = importlib.import_module(f'{self._module}.{self._attr}')
+    self._namespace[self._name] = obj
+    return obj
+
+  def __getattr__(self, name):
+    return getattr(self._resolve(), name)
+
+  def __call__(self, *args, **kwargs):
+    return self._resolve()(*args, **kwargs)
+
+  def __repr__(self):
+    return f'<lazy import of {self._module}{"." + self._attr if self._attr else ""}>'
+
+
+def _lazy_bindings(node, namespace):
+  if isinstance(node, ast.Import):
+    return {alias.asname or alias.name.split('.')[0]:
+            _LazyImport(namespace, alias.asname or alias.name.split('.')[0], alias.name) for alias in node.names}
+  return {alias.asname or alias.name:_LazyImport(namespace, alias.asname or alias.name, node.module, alias.name)
+          for alias in node.names}
+
+
+def _is_lazy_import(node, eager_names):
+  if isinstance(node, ast.ImportFrom) and node.level:
+    return False
+  modules = [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module]
+  return (all(m.split('.')[0] in LAZY_IMPORTS for m in modules)
+          and not any(name in eager_names for name in _bound_names(node)))
+
+
+def _is_config_assign(node):
+  return isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == 'CONFIG' for t in node.targets)
+
+
+def _definition_nodes(source):
+  '''
+  Parse the script source and return the top level nodes which need to be executed, in their original order.
+
+  source : source code of a Colab exported script, lines starting with "!" are shell commands and get commented out.
+  '''
+  lines = ['#' + line if line.lstrip().startswith('!') else line for line in source.splitlines()]
+  tree = ast.parse('\n'.join(lines))
+
+  kept = [node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef)) or _is_config_assign(node)]
+
+  # names referenced anywhere inside the kept definitions
+  used = _names(kept)
+
+  nodes = []
+  for node in tree.body:
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+      if any(name in used for name in _bound_names(node)):
+        nodes.append(node)
+    elif node in kept:
+      nodes.append(node)
+  return nodes
+
+
+def load_script(script, config=None):
+  '''
+  Execute the definitions of a training script and return them as a module object.
+
+  script : short name from SCRIPTS or path to a script
+  config : dictionary of CONFIG overrides, applied right after CONFIG is created so that default arguments and class
+           constructors reading CONFIG (e.g. 'inception_out_multiplier', 'down_conv_out') see the overridden values.
+  '''
+  path = _script_path(script)
+  key = (path, repr(sorted((config or {}).items())))
+  if key in _cache:
+    return _cache[key]
+
+  with open(path) as f:
+    nodes = _definition_nodes(f.read())
+  eager_names = set().union(*[_definition_time_names(node) for node in nodes
+                              if not isinstance(node, (ast.Import, ast.ImportFrom))])
+
+  name = os.path.splitext(os.path.basename(path))[0]
+  module = types.ModuleType(name)
+  module.__file__ = path
+  for node in nodes:
+    if isinstance(node, (ast.Import, ast.ImportFrom)) and _is_lazy_import(node, eager_names):
+      module.__dict__.update(_lazy_bindings(node, module.__dict__))
+      continue
+    code = compile(ast.Module(body=[node], type_ignores=[]), path, 'exec')
+    exec(code, module.__dict__)
+    if _is_config_assign(node) and config:
+      module.CONFIG.update(config)
+
+  _cache[key] = module
+  return module
+
+
+def build_model(name, config=None, **kwargs):
+  '''
+  Instantiate one of the architectures of MODEL_SPECS.
+
+  name : key of MODEL_SPECS
+  config : CONFIG overrides passed to load_script()
+  kwargs : extra constructor arguments, they override the ones of the spec
+  '''
+  spec = MODEL_SPECS[name]
+  module = load_script(spec['script'], config)
+  return getattr(module, spec['class'])(**{**spec['kwargs'], **kwargs})
+
+
+def make_inputs(name, batch_size, resolution, device='cpu', channels_last=False):
+  '''
+  Return the positional inputs for the forward pass of the architecture `name` : (image,) or (image, mask).
+  The mask is a random free-form like binary mask with 1 for valid pixels and 0 for holes.
+
+  channels_last : return the inputs in torch.channels_last memory format
+  '''
+  import torch
+
+  memory_format = torch.channels_last if channels_last else torch.contiguous_format
+  image = torch.rand(batch_size, 3, resolution, resolution, device=device)
+  if MODEL_SPECS[name]['inputs'] == 'image':
+    return (image.contiguous(memory_format=memory_format),)
+  mask = (torch.rand(batch_size, 1, resolution, resolution, device=device) > 0.1).float().expand(-1, 3, -1, -1)
+  image = image * mask + (1 - mask)
+  return (image.contiguous(memory_format=memory_format), mask.contiguous(memory_format=memory_format))
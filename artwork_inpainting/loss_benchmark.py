@@ -0,0 +1,119 @@
+'''
+Step time and peak memory of InpaintingLoss, compared with the former three pass implementation.
+
+The former InpaintingLoss.forward ran the VGG extractor separately on output_comp, output and gt (the gt pass tracked
+by autograd) and computed the gt gram matrices twice. three_pass_loss() reproduces it so both versions can be timed
+on the same training step (PartialConvUNet forward + loss + backward), each in its own process for the peak memory.
+
+  python -m artwork_inpainting.loss_benchmark --batch-size 16 --iters 10
+'''
+
+import argparse
+
+from artwork_inpainting.benchmark import measure, peak_rss_mb, run_isolated
+from artwork_inpainting.loader import load_script, build_model, make_inputs
+
+CONFIG = {'batch_size':16,
+          'resolution':128,
+          'threads':None,
+          'warmup':2,
+          'iters':10}
+
+
+def three_pass_loss(criterion, input, mask, output, gt):
+  '''
+  InpaintingLoss.forward as it was before the batched extractor pass, kept as the benchmark reference.
+  '''
+  script = load_script('pconv')
+  l1, extractor, gram_matrix = criterion.l1, criterion.extractor, script.gram_matrix
+
+  loss_dict = {}
+  output_comp = mask * input + (1 - mask) * output
+  loss_dict['hole'] = l1((1 - mask) * output, (1 - mask) * gt)
+  loss_dict['valid'] = l1(mask * output, mask * gt)
+
+  feat_output_comp = extractor(output_comp)
+  feat_output = extractor(output)
+  feat_gt = extractor(gt)
+
+  loss_dict['prc'] = 0.0
+  loss_dict['style'] = 0.0
+  for i in range(3):
+    loss_dict['prc'] += l1(feat_output[i], feat_gt[i]) + l1(feat_output_comp[i], feat_gt[i])
+    loss_dict['style'] += l1(gram_matrix(feat_output[i]), gram_matrix(feat_gt[i]))
+    loss_dict['style'] += l1(gram_matrix(feat_output_comp[i]), gram_matrix(feat_gt[i]))
+  loss_dict['tv'] = script.total_variation_loss(output_comp)
+  return loss_dict
+
+
+def _setup(batch_size, resolution, threads):
+  import torch
+
+  if threads:
+    torch.set_num_threads(threads)
+  torch.manual_seed(0)
+  script = load_script('pconv')
+  model = build_model('pconv_unet')
+  criterion = script.InpaintingLoss(script.VGG16FeatureExtractor())
+  inputs, masks = make_inputs('pconv_unet', batch_size, resolution)
+  targets = torch.rand_like(inputs)
+  return script, model, criterion, inputs, masks, targets
+
+
+def run_variant(variant, batch_size, resolution, threads, warmup, iters):
+  '''
+  Time a full training step with the 'batched' (current) or 'three_pass' (former) loss, run it in a fresh process.
+  '''
+  script, model, criterion, inputs, masks, targets = _setup(batch_size, resolution, threads)
+  loss_fn = criterion if variant == 'batched' else lambda *args: three_pass_loss(criterion, *args)
+  rss_before = peak_rss_mb()
+
+  def step():
+    preds = model(inputs, masks)
+    loss_dict = loss_fn(inputs, masks, preds, targets)
+    loss = (script.CONFIG['hole_coef'] * loss_dict['hole'] + script.CONFIG['valid_coef'] * loss_dict['valid'] +
+            script.CONFIG['prc_coef'] * loss_dict['prc'] + script.CONFIG['style_coef'] * loss_dict['style'] +
+            script.CONFIG['tv_coef'] * loss_dict['tv'])
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+  stats = measure(step, warmup, iters, items=batch_size)
+  stats.update({'variant':variant, 'peak_rss_mb':peak_rss_mb(), 'step_peak_mb':peak_rss_mb() - rss_before})
+  return stats
+
+
+def check_parity(batch_size, resolution, threads):
+  '''
+  Maximum absolute difference of every loss term between the two implementations.
+  '''
+  import torch
+
+  script, model, criterion, inputs, masks, targets = _setup(batch_size, resolution, threads)
+  with torch.no_grad():
+    preds = model(inputs, masks)
+    new = criterion(inputs, masks, preds, targets)
+    old = three_pass_loss(criterion, inputs, masks, preds, targets)
+  return {name:abs(float(new[name]) - float(old[name])) for name in old}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--resolution', type=int, default=CONFIG['resolution'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  parser.add_argument('--warmup', type=int, default=CONFIG['warmup'])
+  parser.add_argument('--iters', type=int, default=CONFIG['iters'])
+  args = parser.parse_args(argv)
+
+  print('max abs difference per term :', run_isolated(check_parity, args.batch_size, args.resolution, args.threads))
+  for variant in ['three_pass', 'batched']:
+    r = run_isolated(run_variant, variant, args.batch_size, args.resolution, args.threads, args.warmup, args.iters)
+    if 'error' in r:
+      print(f"{variant:>10} : ERROR {r['error']}")
+      continue
+    print(f"{variant:>10} : step {r['latency_mean_ms']:9.1f} ms (p90 {r['latency_p90_ms']:9.1f} ms)  "
+          f"{r['images_per_sec']:7.2f} img/s  step peak +{r['step_peak_mb']:8.1f} MB  process peak {r['peak_rss_mb']:8.1f} MB")
+
+
+if __name__ == '__main__':
+  main()
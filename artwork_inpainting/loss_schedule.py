@@ -0,0 +1,116 @@
+'''
+Wall-clock time to a target validation loss for different LossScheduler settings.
+
+Each schedule (a dict of the LossScheduler CONFIG keys of the partial convolution script) trains the same model from the
+same seed on the shared dataset (artwork_inpainting.data) with the script's train_one_epoch. Every `eval_every` steps the
+fixed fast validation set is evaluated, outside of the measured time, until the validation metric reaches the target.
+Schedules run one after the other, each in its own process, so they do not compete for the cpu.
+
+  python -m artwork_inpainting.loss_schedule --data-dir /content/shared --target 0.05 --max-steps 3000
+'''
+
+import json
+import time
+import argparse
+
+from artwork_inpainting.benchmark import run_isolated
+
+CONFIG = {'schedules':{'every_step':{},
+                       'every_4':{'perceptual_every':4},
+                       'subbatch_quarter':{'perceptual_subbatch':0.25},
+                       'warmup_every_4':{'perceptual_warmup_steps':500, 'perceptual_every':4}},
+          'metric':'hole',
+          'max_steps':3000,
+          'eval_every':100,
+          'seed':42,
+          'output':'loss_schedule_results.json'}
+
+
+def time_to_target(schedule, data_dir, target, metric=CONFIG['metric'], max_steps=CONFIG['max_steps'],
+                   eval_every=CONFIG['eval_every'], seed=CONFIG['seed'], cache_dir=None):
+  '''
+  Train with one schedule until the fast validation `metric` is <= target or max_steps, and return the training time
+  (evaluation excluded) it took together with the validation history [(step, seconds, metric)].
+  '''
+  import torch
+  from artwork_inpainting.loader import load_script
+  from artwork_inpainting.data import load_mask_bank, make_dataloaders
+  from artwork_inpainting.feature_cache import FeatureCache
+  from artwork_inpainting.sweep import validation_score
+
+  script = load_script('pconv', schedule)
+  script.seed_everything(seed)
+  device = script.CONFIG['device']
+
+  train_dataloader, val_dataloader = make_dataloaders(data_dir, script.CONFIG['batch_size_train'],
+                                                      script.CONFIG['batch_size_eval'])
+  masks = load_mask_bank(data_dir)
+  feature_cache = FeatureCache(cache_dir, data_dir) if cache_dir else None
+  fast_val_set = script.make_fast_val_set(val_dataloader.dataset, masks)
+
+  model = script.PartialConvUNet().to(device=device)
+  criterion = script.InpaintingLoss(script.VGG16FeatureExtractor().to(device))
+  optimizer = torch.optim.AdamW(model.parameters(), lr=script.CONFIG['lr'], weight_decay=script.CONFIG['weight_decay'])
+  loss_scheduler = script.LossScheduler()
+
+  state = {'steps':0, 'train_time':0.0, 'start':time.perf_counter(), 'history':[], 'reached':False}
+
+  def step_callback(step):
+    state['steps'] += 1
+    if state['steps'] % eval_every != 0 and state['steps'] < max_steps:
+      return False
+    state['train_time'] += time.perf_counter() - state['start']
+
+    val_results = script.fast_val_one_epoch(model, fast_val_set, epoch, criterion)
+    model.train() # fast_val_one_epoch leaves the model in eval mode
+    score = validation_score({name:mean for name, (mean, ci) in val_results.items()}, metric)
+    state['history'].append((state['steps'], state['train_time'], score))
+    state['reached'] = score <= target
+
+    state['start'] = time.perf_counter()
+    return state['reached'] or state['steps'] >= max_steps
+
+  epoch = 0
+  while not state['reached'] and state['steps'] < max_steps:
+    script.train_one_epoch(model, train_dataloader, epoch, masks, optimizer, criterion, feature_cache, loss_scheduler,
+                           step_callback)
+    epoch += 1
+
+  return {'schedule':schedule, 'reached':state['reached'], 'steps':state['steps'],
+          'time_to_target_s':state['train_time'] if state['reached'] else None,
+          'final_metric':state['history'][-1][2], 'history':state['history']}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--data-dir', required=True)
+  parser.add_argument('--target', type=float, required=True, help='fast validation value of --metric to reach')
+  parser.add_argument('--metric', default=CONFIG['metric'], choices=['hole', 'valid', 'prc', 'style', 'tv', 'total'])
+  parser.add_argument('--schedules', type=json.loads, default=CONFIG['schedules'],
+                      help='json {name: LossScheduler CONFIG overrides}, the first one is the reference')
+  parser.add_argument('--max-steps', type=int, default=CONFIG['max_steps'])
+  parser.add_argument('--eval-every', type=int, default=CONFIG['eval_every'])
+  parser.add_argument('--feature-cache')
+  parser.add_argument('--output', default=CONFIG['output'])
+  args = parser.parse_args(argv)
+
+  results = {}
+  for name, schedule in args.schedules.items():
+    results[name] = run_isolated(time_to_target, schedule, args.data_dir, args.target, args.metric, args.max_steps,
+                                 args.eval_every, CONFIG['seed'], args.feature_cache)
+  with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
+
+  reference = results[next(iter(results))].get('time_to_target_s')
+  for name, r in results.items():
+    if 'error' in r:
+      print(f"{name:>20} : ERROR {r['error']}")
+    elif not r['reached']:
+      print(f"{name:>20} : target not reached in {r['steps']} steps, final {args.metric} {r['final_metric']:.5f}")
+    else:
+      speedup = f'  x{reference / r["time_to_target_s"]:.2f} vs {next(iter(results))}' if reference else ''
+      print(f"{name:>20} : {r['time_to_target_s']:9.1f} s to target ({r['steps']} steps){speedup}")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,172 @@
+'''
+ONNX export of the inpainting models and a CPU inference runner on ONNX Runtime.
+
+export_onnx() writes a model (BatchNorm folded by default, artwork_inpainting.fold_bn) to an ONNX file with dynamic
+batch, height and width axes : (image) -> output, or (image, mask) -> output for PartialConvUNet, the mask having 1 for
+valid pixels with the image channels like make_inputs(). OnnxRunner only needs numpy and onnxruntime, neither torch
+nor the training scripts, to run a forward pass. The parity check compares the runner with the eager model at another
+size than the export one (which also checks the dynamic axes), and the benchmark times both on CPU per thread count.
+
+  python -m artwork_inpainting.onnx_export --models unet pconv_unet resnet_unet --checkpoint-dir checkpoints
+'''
+
+import os
+import argparse
+
+import numpy as np
+
+from artwork_inpainting.benchmark import measure, run_isolated
+from artwork_inpainting.loader import MODEL_SPECS, build_model, make_inputs
+
+CONFIG = {'models':['unet', 'pconv_unet', 'resnet_unet'],
+          'opset':17,
+          'export_resolution':128,
+          'resolution':256, # parity check and benchmark, a different size than the export one
+          'batch_size':4,
+          'threads':[1, os.cpu_count()],
+          'warmup':3,
+          'iters':20,
+          'tolerance':1e-4, # maximum absolute difference accepted by the parity check
+          'output_dir':'onnx'}
+
+
+def input_names(name):
+  return ['image'] if MODEL_SPECS[name]['inputs'] == 'image' else ['image', 'mask']
+
+
+def _load_model(name, checkpoint=None):
+  import torch
+
+  torch.manual_seed(0) # without checkpoint, the same random weights in the export, parity and benchmark processes
+  model = build_model(name)
+  if checkpoint is not None:
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+  return model.eval()
+
+
+def export_onnx(name, path, checkpoint=None, opset=CONFIG['opset'], resolution=CONFIG['export_resolution'], fold=True):
+  '''
+  Export the architecture `name` (random weights without checkpoint) to `path` and return the path.
+
+  fold : fold BatchNorm into the convolutions first, ONNX Runtime cannot fuse the ones following a partial convolution
+  '''
+  import torch
+  from artwork_inpainting.fold_bn import fold_batchnorm
+
+  model = _load_model(name, checkpoint)
+  if fold:
+    model = fold_batchnorm(model)
+  names = input_names(name)
+  axes = {0:'batch', 2:'height', 3:'width'}
+  with torch.no_grad():
+    torch.onnx.export(model, make_inputs(name, 1, resolution), path, input_names=names, output_names=['output'],
+                      dynamic_axes={n:axes for n in names + ['output']}, opset_version=opset, dynamo=False)
+  return path
+
+
+class OnnxRunner:
+  '''
+  Forward pass of an exported model on the ONNX Runtime CPU provider.
+
+  threads : intra op threads, all the cores by default
+  inter_op_threads : threads running independent graph nodes in parallel, the models are chains of convolutions so
+                     one (sequential execution) is the right default
+  '''
+  def __init__(self, path, threads=None, inter_op_threads=1):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = threads or 0 # 0 : onnxruntime default, one per physical core
+    options.inter_op_num_threads = inter_op_threads
+    if inter_op_threads == 1:
+      options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    self.input_names = [i.name for i in self.session.get_inputs()]
+
+  def __call__(self, *inputs):
+    '''
+    inputs : float32 (N, 3, H, W) arrays in the order of input_names(), returns the (N, 3, H, W) output
+    '''
+    feed = {n:np.ascontiguousarray(x, dtype=np.float32) for n, x in zip(self.input_names, inputs)}
+    return self.session.run(None, feed)[0]
+
+
+def check_parity(name, path, checkpoint=None, batch_size=CONFIG['batch_size'], resolution=CONFIG['resolution']):
+  '''
+  Maximum and mean absolute difference between the eager model and the runner on random inputs.
+  '''
+  import torch
+
+  torch.manual_seed(0)
+  model = _load_model(name, checkpoint)
+  inputs = make_inputs(name, batch_size, resolution)
+  with torch.no_grad():
+    expected = model(*inputs).numpy()
+  diff = np.abs(OnnxRunner(path)(*[x.numpy() for x in inputs]) - expected)
+  return {'max_abs_diff':float(diff.max()), 'mean_abs_diff':float(diff.mean())}
+
+
+def benchmark_onnx(name, path, checkpoint, batch_size, resolution, threads, warmup, iters):
+  '''
+  Forward latency of the eager model and of the runner with `threads` threads, run it in its own process.
+  '''
+  import torch
+
+  torch.set_num_threads(threads)
+  torch.manual_seed(0)
+  model = _load_model(name, checkpoint)
+  inputs = make_inputs(name, batch_size, resolution)
+  arrays = [x.numpy() for x in inputs]
+  runner = OnnxRunner(path, threads)
+  report = {}
+  with torch.no_grad():
+    report['eager'] = measure(lambda: model(*inputs), warmup, iters, batch_size)
+  report['onnxruntime'] = measure(lambda: runner(*arrays), warmup, iters, batch_size)
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--models', nargs='+', default=CONFIG['models'], choices=list(MODEL_SPECS))
+  parser.add_argument('--checkpoint-dir', help='directory of {model}.pth state_dicts, random weights otherwise')
+  parser.add_argument('--output-dir', default=CONFIG['output_dir'])
+  parser.add_argument('--opset', type=int, default=CONFIG['opset'])
+  parser.add_argument('--no-fold', action='store_true', help='keep BatchNorm in the exported graph')
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--resolution', type=int, default=CONFIG['resolution'])
+  parser.add_argument('--threads', nargs='+', type=int, default=CONFIG['threads'])
+  parser.add_argument('--warmup', type=int, default=CONFIG['warmup'])
+  parser.add_argument('--iters', type=int, default=CONFIG['iters'])
+  args = parser.parse_args(argv)
+
+  os.makedirs(args.output_dir, exist_ok=True)
+  for name in args.models:
+    checkpoint = None
+    if args.checkpoint_dir:
+      checkpoint = os.path.join(args.checkpoint_dir, f'{name}.pth')
+    path = os.path.join(args.output_dir, f'{name}.onnx')
+    exported = run_isolated(export_onnx, name, path, checkpoint, args.opset, CONFIG['export_resolution'],
+                            not args.no_fold)
+    if isinstance(exported, dict):
+      print(f"{name} export : ERROR {exported['error']}")
+      continue
+    parity = run_isolated(check_parity, name, path, checkpoint, 2, args.resolution)
+    if 'error' in parity:
+      print(f"{name} parity : ERROR {parity['error']}")
+      continue
+    status = 'ok' if parity['max_abs_diff'] <= CONFIG['tolerance'] else 'MISMATCH'
+    print(f"{name} -> {path} ({os.path.getsize(path) / 1024**2:.1f} MB), parity {status} : max abs diff "
+          f"{parity['max_abs_diff']:.1e}, mean {parity['mean_abs_diff']:.1e}")
+    for threads in args.threads:
+      r = run_isolated(benchmark_onnx, name, path, checkpoint, args.batch_size, args.resolution, threads,
+                       args.warmup, args.iters)
+      if 'error' in r:
+        print(f"{name:>12} {threads:3d} threads : ERROR {r['error']}")
+        continue
+      eager, ort = r['eager']['latency_mean_ms'], r['onnxruntime']['latency_mean_ms']
+      print(f'{name:>12} {threads:3d} threads : eager {eager:8.1f} ms  onnxruntime {ort:8.1f} ms  (x{eager / ort:.2f})')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,196 @@
+'''
+Latency against quality of trained checkpoints, on the same fixed masked set, and their Pareto front.
+
+Every checkpoint (name=path, name a key of MODEL_SPECS, the same architecture may appear several times) is evaluated
+in its own process :
+
+  quality    PSNR and SSIM of the composited output (valid pixels from the input, holes from the model, output_comp of
+             InpaintingLoss) and L1 on the holes, against the ground truth of the fixed validation subset of
+             artwork_inpainting.data (seeded images and masks, the same for every model)
+  cost       batch 1 latency and batch `--batch-size` throughput on CPU with `--threads` threads, and the analytic
+             GFLOPs per image (artwork_inpainting.cost_model)
+
+A checkpoint is on the Pareto front when no other one is both faster (batch 1 latency) and better (the
+--quality-metric). The table is printed front first, the rows (with a 'pareto' flag) are written to --output (json) and
+--csv for plotting, and --min-quality prints the fastest checkpoint reaching a quality level.
+
+  python -m artwork_inpainting.pareto --data-dir /content/shared --checkpoints unet=unet.pth \\
+    unet_inception=unet_inception.pth pconv_unet=pconv.pth resnet_unet=resnet.pth --min-quality 28
+'''
+
+import os
+import csv
+import json
+import math
+import argparse
+
+from artwork_inpainting.benchmark import measure, run_isolated
+from artwork_inpainting.loader import MODEL_SPECS
+
+CONFIG = {'eval_images':512,
+          'batch_size':16,
+          'threads':4,
+          'warmup':3,
+          'iters':20,
+          'quality_metric':'psnr', # psnr, ssim (higher is better) or hole_l1 (lower is better)
+          'seed':0,
+          'output':'pareto.json'}
+
+_LOWER_IS_BETTER = {'hole_l1'}
+
+
+def ssim(x, y, window_size=11, sigma=1.5):
+  '''
+  Mean SSIM of two (N, C, H, W) image batches in [0, 1], gaussian window, per channel.
+  '''
+  import torch
+  import torch.nn.functional as F
+
+  coords = torch.arange(window_size, dtype=x.dtype) - window_size // 2
+  g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+  g = g / g.sum()
+  channels = x.shape[1]
+  window = (g[:, None] * g[None, :]).expand(channels, 1, window_size, window_size).to(x.device)
+
+  def blur(t):
+    return F.conv2d(t, window, padding=window_size // 2, groups=channels)
+
+  c1, c2 = 0.01 ** 2, 0.03 ** 2
+  mu_x, mu_y = blur(x), blur(y)
+  var_x, var_y = blur(x * x) - mu_x ** 2, blur(y * y) - mu_y ** 2
+  cov = blur(x * y) - mu_x * mu_y
+  ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+  return ssim_map.mean(dim=(1, 2, 3))
+
+
+def evaluate_checkpoint(name, checkpoint, data_dir, n_images, batch_size, threads, warmup, iters, seed):
+  '''
+  Quality and CPU cost of one checkpoint, run it in its own process (run_isolated).
+  '''
+  import torch
+  from artwork_inpainting.cost_model import model_cost
+  from artwork_inpainting.inference import load_inpainting_model, model_inputs
+  from artwork_inpainting.loader import make_inputs
+  from artwork_inpainting.quantize import _masked_set
+
+  torch.set_num_threads(threads)
+  model = load_inpainting_model(name, checkpoint)
+  kind = MODEL_SPECS[name]['inputs']
+  targets, masks = _masked_set(data_dir, 'val', n_images, batch_size, seed)
+
+  squared_error, hole_l1, ssim_sum, pixels, hole_pixels = 0.0, 0.0, 0.0, 0, 0.0
+  with torch.no_grad():
+    for start in range(0, len(targets), batch_size):
+      gt = targets[start:start + batch_size].float()
+      valid = masks[start:start + batch_size, :1].float()
+      output = model(*model_inputs(kind, gt, valid)).clamp(0, 1)
+      composited = valid * gt + (1 - valid) * output
+      squared_error += torch.sum((composited - gt) ** 2).item()
+      hole_l1 += torch.sum((1 - valid) * torch.abs(output - gt)).item()
+      ssim_sum += ssim(composited, gt).sum().item()
+      pixels += gt.numel()
+      hole_pixels += 3 * (1 - valid).sum().item()
+
+    single = make_inputs(name, 1, targets.shape[-1])
+    batch = make_inputs(name, batch_size, targets.shape[-1])
+    latency = measure(lambda: model(*single), warmup, iters, 1)
+    throughput = measure(lambda: model(*batch), warmup, iters, batch_size)
+
+  mse = squared_error / pixels
+  return {'model':name, 'checkpoint':checkpoint, 'images':len(targets),
+          'psnr':10 * math.log10(1 / mse) if mse > 0 else float('inf'),
+          'ssim':ssim_sum / len(targets),
+          'hole_l1':hole_l1 / max(hole_pixels, 1),
+          'latency_ms':latency['latency_mean_ms'],
+          'latency_p90_ms':latency['latency_p90_ms'],
+          'throughput':throughput['images_per_sec'],
+          'gflops':model_cost(name, targets.shape[-1])['flops'] / 1e9}
+
+
+def pareto_front(rows, metric=CONFIG['quality_metric']):
+  '''
+  Flag every row with 'pareto' : True if no other row has both a lower batch 1 latency and a better quality.
+  '''
+  sign = -1 if metric in _LOWER_IS_BETTER else 1
+  for row in rows:
+    row['pareto'] = not any(other['latency_ms'] <= row['latency_ms'] and sign * other[metric] >= sign * row[metric]
+                            and (other['latency_ms'] < row['latency_ms'] or sign * other[metric] > sign * row[metric])
+                            for other in rows)
+  return rows
+
+
+def fastest_above(rows, min_quality, metric=CONFIG['quality_metric']):
+  '''
+  Fastest row whose quality reaches min_quality (at most for hole_l1), None if no checkpoint does.
+  '''
+  sign = -1 if metric in _LOWER_IS_BETTER else 1
+  good = [row for row in rows if sign * row[metric] >= sign * min_quality]
+  return min(good, key=lambda row: row['latency_ms']) if good else None
+
+
+def format_table(rows):
+  lines = [f"{'':1} {'model':<26} {'checkpoint':<28} {'PSNR':>7} {'SSIM':>7} {'hole L1':>8} {'ms (b=1)':>9} "
+           f"{'img/s':>8} {'GFLOPs':>7}"]
+  for row in sorted(rows, key=lambda r: (not r['pareto'], r['latency_ms'])):
+    lines.append(f"{'*' if row['pareto'] else ' '} {row['model']:<26} {os.path.basename(row['checkpoint'] or '-'):<28} "
+                 f"{row['psnr']:7.2f} {row['ssim']:7.4f} {row['hole_l1']:8.5f} {row['latency_ms']:9.2f} "
+                 f"{row['throughput']:8.1f} {row['gflops']:7.2f}")
+  return '\n'.join(lines)
+
+
+def _checkpoint_arg(value):
+  name, sep, path = value.partition('=')
+  if not sep or name not in MODEL_SPECS:
+    raise argparse.ArgumentTypeError(f'expected name=path with name in {list(MODEL_SPECS)}, got {value}')
+  return name, path
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--data-dir', required=True)
+  parser.add_argument('--checkpoints', nargs='+', type=_checkpoint_arg, required=True, help='name=path pairs')
+  parser.add_argument('--eval-images', type=int, default=CONFIG['eval_images'])
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  parser.add_argument('--warmup', type=int, default=CONFIG['warmup'])
+  parser.add_argument('--iters', type=int, default=CONFIG['iters'])
+  parser.add_argument('--quality-metric', default=CONFIG['quality_metric'], choices=['psnr', 'ssim', 'hole_l1'])
+  parser.add_argument('--min-quality', type=float, help='print the fastest checkpoint reaching this quality')
+  parser.add_argument('--output', default=CONFIG['output'])
+  parser.add_argument('--csv')
+  args = parser.parse_args(argv)
+
+  rows = []
+  for name, checkpoint in args.checkpoints:
+    r = run_isolated(evaluate_checkpoint, name, checkpoint, args.data_dir, args.eval_images, args.batch_size,
+                     args.threads, args.warmup, args.iters, CONFIG['seed'])
+    if 'error' in r:
+      print(f"{name} {checkpoint} : ERROR {r['error']}")
+      continue
+    rows.append(r)
+  if not rows:
+    return
+
+  pareto_front(rows, args.quality_metric)
+  print(format_table(rows))
+  with open(args.output, 'w') as f:
+    json.dump({'quality_metric':args.quality_metric, 'threads':args.threads, 'batch_size':args.batch_size,
+               'rows':rows}, f, indent=1)
+  if args.csv:
+    with open(args.csv, 'w', newline='') as f:
+      writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+      writer.writeheader()
+      writer.writerows(rows)
+
+  if args.min_quality is not None:
+    best = fastest_above(rows, args.min_quality, args.quality_metric)
+    if best is None:
+      print(f'no checkpoint reaches {args.quality_metric} {args.min_quality}')
+    else:
+      print(f"fastest with {args.quality_metric} {'<=' if args.quality_metric in _LOWER_IS_BETTER else '>='} "
+            f"{args.min_quality} : {best['model']} {best['checkpoint']} ({best['latency_ms']:.2f} ms, "
+            f"{args.quality_metric} {best[args.quality_metric]:.4f})")
+
+
+if __name__ == '__main__':
+  main()
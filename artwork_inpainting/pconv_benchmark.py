@@ -0,0 +1,241 @@
+'''
+Parity, FLOPs, speed and memory of the PartialConv implementation against the former ones.
+
+  legacy          PartialConv as imported from pytorch-inpainting-with-partial-conv : the valid pixel count came from
+                  `mask_conv`, an all-ones in_channels x out_channels convolution as expensive as the real one
+  window_sum      the same with the count done by a single channel window sum
+  fused           the current PartialConv : in place hole filling, no bias / ones temporaries, single channel new mask
+  fused_recompute the current PartialConv with recompute_masked_input (input * mask recomputed in backward)
+
+swap_partial_convs() rebuilds a PartialConvUNet with any implementation and the same weights, so the variants are
+compared on identical inputs.
+
+  python -m artwork_inpainting.pconv_benchmark --batch-size 8 --iters 10
+'''
+
+import copy
+import argparse
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from artwork_inpainting.benchmark import measure, peak_rss_mb, run_isolated
+from artwork_inpainting.loader import build_model, make_inputs, load_script
+
+CONFIG = {'batch_size':8,
+          'resolution':128,
+          'threads':None,
+          'warmup':2,
+          'iters':10}
+
+
+class LegacyPartialConv(nn.Module):
+  '''
+  The former PartialConv, kept as the reference of the benchmark.
+  '''
+  def __init__(self, input_conv):
+    super().__init__()
+    self.input_conv = input_conv
+    self.mask_conv = nn.Conv2d(input_conv.in_channels, input_conv.out_channels, input_conv.kernel_size,
+                               input_conv.stride, input_conv.padding, input_conv.dilation, input_conv.groups, False)
+    torch.nn.init.constant_(self.mask_conv.weight, 1.0)
+    for param in self.mask_conv.parameters():
+      param.requires_grad = False
+
+  def forward(self, input, mask):
+    output = self.input_conv(input * mask)
+    if self.input_conv.bias is not None:
+      output_bias = self.input_conv.bias.view(1, -1, 1, 1).expand_as(output)
+    else:
+      output_bias = torch.zeros_like(output)
+
+    with torch.no_grad():
+      output_mask = self.mask_conv(mask)
+
+    no_update_holes = output_mask == 0
+    sum_1 = torch.sum(output_mask.masked_fill_(no_update_holes, 1.0))
+    sum_M = torch.sum(output_mask)
+
+    output_pre = ((output - output_bias) * (sum_1 / sum_M)) + output_bias
+    output = output_pre.masked_fill_(no_update_holes, 0.0)
+
+    new_mask = torch.ones_like(output)
+    new_mask = new_mask.masked_fill_(no_update_holes, 0.0)
+
+    return output, new_mask
+
+
+class WindowSumPartialConv(LegacyPartialConv):
+  '''
+  PartialConv with the window sum mask update but before the fused forward, kept as a reference of the benchmark.
+  '''
+  def __init__(self, input_conv):
+    nn.Module.__init__(self)
+    self.input_conv = input_conv
+    self.register_buffer('mask_window', torch.ones(1, 1, *input_conv.kernel_size), persistent=False)
+
+  def forward(self, input, mask):
+    output = self.input_conv(input * mask)
+    if self.input_conv.bias is not None:
+      output_bias = self.input_conv.bias.view(1, -1, 1, 1).expand_as(output)
+    else:
+      output_bias = torch.zeros_like(output)
+
+    with torch.no_grad():
+      conv = self.input_conv
+      output_mask = F.conv2d(mask.amax(dim=1, keepdim=True), self.mask_window, None, conv.stride, conv.padding,
+                             conv.dilation)
+
+    no_update_holes = output_mask == 0
+    sum_1 = torch.sum(output_mask.masked_fill_(no_update_holes, 1.0))
+    sum_M = torch.sum(output_mask)
+
+    output_pre = ((output - output_bias) * (sum_1 / sum_M)) + output_bias
+    output = output_pre.masked_fill_(no_update_holes, 0.0)
+
+    new_mask = torch.ones_like(output)
+    new_mask = new_mask.masked_fill_(no_update_holes, 0.0)
+
+    return output, new_mask
+
+
+def swap_partial_convs(model, make_layer):
+  '''
+  Replace, in place, every PartialConv of model by make_layer(partial_conv) and return the model.
+  '''
+  partial_conv = load_script('pconv').PartialConv
+  for name, module in list(model.named_modules()):
+    for child_name, child in list(module.named_children()):
+      if isinstance(child, partial_conv):
+        setattr(module, child_name, make_layer(child))
+  return model
+
+
+def legacy_model(model):
+  return swap_partial_convs(model, lambda layer: LegacyPartialConv(layer.input_conv))
+
+
+def set_recompute(model, recompute=True):
+  partial_conv = load_script('pconv').PartialConv
+  for module in model.modules():
+    if isinstance(module, partial_conv):
+      module.recompute_masked_input = recompute
+  return model
+
+
+VARIANTS = {'legacy':legacy_model,
+            'window_sum':lambda model: swap_partial_convs(model, lambda layer: WindowSumPartialConv(layer.input_conv)),
+            'fused':lambda model: model,
+            'fused_recompute':set_recompute}
+
+
+def partial_conv_flops(model, input, mask):
+  '''
+  Multiply-accumulates of the partial convolutions of one forward, split between the real convolution and the mask
+  update, counted from the output shapes with forward hooks.
+  '''
+  partial_conv = load_script('pconv').PartialConv
+  counts = {'input_conv':0, 'mask_update':0}
+
+  def hook(module, args, outputs):
+    out = outputs[0]
+    conv = module.input_conv
+    k = conv.kernel_size[0] * conv.kernel_size[1]
+    positions = out.shape[0] * out.shape[2] * out.shape[3]
+    counts['input_conv'] += positions * conv.out_channels * conv.in_channels // conv.groups * k
+    if isinstance(module, LegacyPartialConv) and not isinstance(module, WindowSumPartialConv):
+      counts['mask_update'] += positions * conv.out_channels * conv.in_channels // conv.groups * k
+    else:
+      counts['mask_update'] += positions * k
+
+  handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, (partial_conv, LegacyPartialConv))]
+  with torch.no_grad():
+    model(input, mask)
+  for handle in handles:
+    handle.remove()
+  return counts
+
+
+def _setup(batch_size, resolution, threads, variant):
+  if threads:
+    torch.set_num_threads(threads)
+  torch.manual_seed(0)
+  model = VARIANTS[variant](build_model('pconv_unet'))
+  return model, make_inputs('pconv_unet', batch_size, resolution)
+
+
+def run_variant(variant, batch_size, resolution, threads, warmup, iters):
+  '''
+  Time the encoder forward (inference) and the full model forward+backward of one implementation.
+  '''
+  model, (input, mask) = _setup(batch_size, resolution, threads, variant)
+  flops = partial_conv_flops(model, input, mask)
+  rss_before = peak_rss_mb()
+
+  model.eval()
+  with torch.no_grad():
+    encoder = measure(lambda: model.encoder(input, mask), warmup, iters, items=batch_size)
+
+  model.train()
+
+  def train_step():
+    model(input, mask).mean().backward()
+    model.zero_grad(set_to_none=True)
+
+  train = measure(train_step, warmup, iters, items=batch_size)
+  return {'variant':variant, 'encoder_forward_ms':encoder['latency_mean_ms'],
+          'train_step_ms':train['latency_mean_ms'], 'step_peak_mb':peak_rss_mb() - rss_before, **flops}
+
+
+def check_parity(batch_size, resolution, threads):
+  '''
+  Maximum absolute difference between the output of every variant and the legacy one, same weights and inputs, in
+  inference and for the gradients of a training step.
+  '''
+  reference, (input, mask) = _setup(batch_size, resolution, threads, 'legacy')
+  state_dict = copy.deepcopy(reference.state_dict()) # before the training step updates the BatchNorm statistics
+  reference.eval()
+  with torch.no_grad():
+    expected = reference(input, mask)
+  reference.train()
+  reference(input, mask).mean().backward()
+  expected_grads = [p.grad for p in reference.parameters() if p.requires_grad]
+
+  report = {}
+  for variant in VARIANTS:
+    model, _ = _setup(batch_size, resolution, threads, variant)
+    model.load_state_dict(state_dict, strict=False)
+    model.eval()
+    with torch.no_grad():
+      output_diff = (model(input, mask) - expected).abs().max().item()
+    model.train()
+    model(input, mask).mean().backward()
+    grads = [p.grad for p in model.parameters() if p.requires_grad]
+    grad_diff = max((g - e).abs().max().item() for g, e in zip(grads, expected_grads))
+    report[variant] = {'output_max_abs_diff':output_diff, 'grad_max_abs_diff':grad_diff}
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--resolution', type=int, default=CONFIG['resolution'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  parser.add_argument('--warmup', type=int, default=CONFIG['warmup'])
+  parser.add_argument('--iters', type=int, default=CONFIG['iters'])
+  args = parser.parse_args(argv)
+
+  print('parity :', run_isolated(check_parity, args.batch_size, args.resolution, args.threads))
+  for variant in VARIANTS:
+    r = run_isolated(run_variant, variant, args.batch_size, args.resolution, args.threads, args.warmup, args.iters)
+    if 'error' in r:
+      print(f"{variant:>15} : ERROR {r['error']}")
+      continue
+    print(f"{variant:>15} : encoder forward {r['encoder_forward_ms']:9.1f} ms  train step {r['train_step_ms']:9.1f} ms  "
+          f"step peak +{r['step_peak_mb']:7.1f} MB  partial conv GMACs {r['input_conv'] / 1e9:.2f} conv + "
+          f"{r['mask_update'] / 1e9:.4f} mask")
+
+
+if __name__ == '__main__':
+  main()
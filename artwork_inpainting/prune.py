@@ -0,0 +1,326 @@
+'''
+Structured channel pruning of the inception branches and double conv blocks of PartialConvUNet.
+
+With inception_out_multiplier 1.6 the three stacked InceptionModules of the Encoder bottleneck grow 512 channels to
+2096 before up_transpose1, which makes them and the first transpose convolution the most expensive layers of the model.
+pruning_plan() ranks, without data, the channels of
+
+  inception branches    the channels between the 1x1 and the 3x3 / 5x5 convolutions of channel_2 and channel_3, and
+                        the output channels of every branch channel_1..channel_4 of the bottleneck modules (their
+                        consumers are the next module's branches and up_transpose1)
+  double conv blocks    the channels between the two convolutions of DoublePConv, DoubleConv and double_conv_layers
+
+and keeps the most important ones of every group (every branch, every block), so each keeps the same fraction. The
+importance of a channel is the norm of the filter producing it times the norm of the weights reading it, times the
+BatchNorm scale in between if any. apply_plan() rebuilds the layers with the kept channels only (the plan is saved
+with the weights, load_pruned() rebuilds the model from it), then the model is fine-tuned for a few steps with the
+training loss and FLOPs, latency and fast validation losses are reported against the unpruned model.
+
+  python -m artwork_inpainting.prune --data-dir /content/shared --checkpoint model.pth --amounts 0.25 0.5
+'''
+
+import argparse
+
+import torch
+from torch import nn
+
+from artwork_inpainting.benchmark import measure, run_isolated
+from artwork_inpainting.loader import build_model, load_script, make_inputs
+
+CONFIG = {'amounts':[0.25, 0.5], # fraction of the channels removed in every group
+          'inception_outputs':True, # also prune the outputs of the bottleneck inception modules
+          'fine_tune_steps':500,
+          'fine_tune_lr':1e-4,
+          'batch_size':8,
+          'resolution':128,
+          'threads':None,
+          'iters':10}
+
+_BRANCH_OUTPUTS = ['channel_1', 'channel_2.1', 'channel_3.1', 'channel_4.1']
+_BRANCH_INPUTS = ['channel_1', 'channel_2.0', 'channel_3.0', 'channel_4.1']
+_BOTTLENECK = ['encoder.inception_module_1', 'encoder.inception_module_2', 'encoder.inception_module_3']
+
+
+def _join(*names):
+  return '.'.join(name for name in names if name)
+
+
+def _out_norm(conv):
+  weight = conv.weight.detach()
+  weight = weight.transpose(0, 1) if isinstance(conv, nn.ConvTranspose2d) else weight
+  return weight.flatten(1).norm(dim=1)
+
+
+def _in_norm(conv):
+  weight = conv.weight.detach()
+  weight = weight if isinstance(conv, nn.ConvTranspose2d) else weight.transpose(0, 1)
+  return weight.flatten(1).norm(dim=1)
+
+
+def _bn_scale(bn):
+  scale = 1 / torch.sqrt(bn.running_var + bn.eps)
+  return scale * bn.weight.detach().abs() if bn.affine else scale
+
+
+def _keep(scores, amount):
+  k = max(1, round(len(scores) * (1 - amount)))
+  return sorted(scores.topk(k).indices.tolist())
+
+
+def _double_conv_paths(path, module):
+  '''
+  (first conv, BatchNorm, second conv) paths of a double conv block, None for other modules.
+  '''
+  if all(hasattr(module, name) for name in ('pconv1', 'bn1', 'pconv2')):
+    return _join(path, 'pconv1.input_conv'), _join(path, 'bn1'), _join(path, 'pconv2.input_conv')
+  if all(isinstance(getattr(module, name, None), nn.Conv2d) for name in ('conv1', 'conv2')) and hasattr(module, 'bn1'):
+    return _join(path, 'conv1'), _join(path, 'bn1'), _join(path, 'conv2')
+  if (isinstance(module, nn.Sequential) and len(module) >= 4 and isinstance(module[0], nn.Conv2d)
+      and isinstance(module[1], nn.BatchNorm2d) and isinstance(module[3], nn.Conv2d)): # double_conv_layers
+    return _join(path, '0'), _join(path, '1'), _join(path, '3')
+  return None
+
+
+def pruning_plan(model, inception_amount, double_conv_amount, inception_outputs=CONFIG['inception_outputs']):
+  '''
+  Return {layer path: {'out': kept output channels, 'in': kept input channels}} (channel indices of the unpruned
+  model) for the Conv2d / ConvTranspose2d / BatchNorm2d layers to rebuild.
+  '''
+  plan = {}
+  modules = dict(model.named_modules())
+
+  def add(path, key, kept):
+    plan.setdefault(path, {})[key] = kept
+
+  for path, module in modules.items():
+    paths = _double_conv_paths(path, module) if double_conv_amount else None
+    if paths is not None:
+      first, bn, second = paths
+      scores = _out_norm(modules[first]) * _bn_scale(modules[bn]) * _in_norm(modules[second])
+      kept = _keep(scores, double_conv_amount)
+      add(first, 'out', kept)
+      add(bn, 'out', kept)
+      add(second, 'in', kept)
+
+    if inception_amount and hasattr(module, 'channel_2') and hasattr(module, 'channel_3'): # InceptionModule
+      if getattr(module, 'merge_projections', False):
+        raise ValueError(f'{path} has merged projections, prune the model with merge_inception_projections False')
+      for branch in ['channel_2', 'channel_3']:
+        reduce, conv = _join(path, branch, '0'), _join(path, branch, '1')
+        kept = _keep(_out_norm(modules[reduce]) * _in_norm(modules[conv]), inception_amount)
+        add(reduce, 'out', kept)
+        add(conv, 'in', kept)
+
+  if inception_amount and inception_outputs and getattr(getattr(model, 'encoder', None), 'add_inception', False):
+    for i, path in enumerate(_BOTTLENECK):
+      if i + 1 < len(_BOTTLENECK):
+        consumers = [_join(_BOTTLENECK[i + 1], branch) for branch in _BRANCH_INPUTS]
+      else:
+        consumers = ['decoder.up_transpose1']
+      consumer_norm = sum(_in_norm(modules[c]) for c in consumers)
+
+      kept_all, offset = [], 0
+      for branch in _BRANCH_OUTPUTS:
+        producer = _join(path, branch)
+        scores = _out_norm(modules[producer]) * consumer_norm[offset:offset + modules[producer].out_channels]
+        kept = _keep(scores, inception_amount)
+        add(producer, 'out', kept)
+        kept_all += [offset + j for j in kept]
+        offset += modules[producer].out_channels
+      for consumer in consumers:
+        add(consumer, 'in', kept_all)
+
+  return plan
+
+
+def _sliced_conv(conv, out_idx=None, in_idx=None):
+  transpose = isinstance(conv, nn.ConvTranspose2d)
+  out_dim, in_dim = (1, 0) if transpose else (0, 1)
+  weight = conv.weight.detach()
+  if out_idx is not None:
+    weight = weight.index_select(out_dim, torch.tensor(out_idx))
+  if in_idx is not None:
+    weight = weight.index_select(in_dim, torch.tensor(in_idx))
+  in_channels = conv.in_channels if in_idx is None else len(in_idx)
+  out_channels = conv.out_channels if out_idx is None else len(out_idx)
+
+  if transpose:
+    new = nn.ConvTranspose2d(in_channels, out_channels, conv.kernel_size, conv.stride, conv.padding, conv.output_padding,
+                             conv.groups, conv.bias is not None, conv.dilation, conv.padding_mode)
+  else:
+    new = nn.Conv2d(in_channels, out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation, conv.groups,
+                    conv.bias is not None, conv.padding_mode)
+  new = new.to(conv.weight.device, conv.weight.dtype)
+  new.weight.copy_(weight)
+  if conv.bias is not None:
+    new.bias.copy_(conv.bias if out_idx is None else conv.bias[out_idx])
+  return new
+
+
+def _sliced_bn(bn, idx):
+  new = nn.BatchNorm2d(len(idx), bn.eps, bn.momentum, bn.affine, bn.track_running_stats).to(bn.running_mean.device)
+  if bn.affine:
+    new.weight.copy_(bn.weight[idx])
+    new.bias.copy_(bn.bias[idx])
+  new.running_mean.copy_(bn.running_mean[idx])
+  new.running_var.copy_(bn.running_var[idx])
+  new.num_batches_tracked.copy_(bn.num_batches_tracked)
+  return new
+
+
+@torch.no_grad()
+def apply_plan(model, plan):
+  '''
+  Replace, in place, every layer of the plan by a layer with only the kept channels and return the model.
+  '''
+  for path, kept in plan.items():
+    module = model.get_submodule(path)
+    parent_path, _, name = path.rpartition('.')
+    parent = model.get_submodule(parent_path)
+    if isinstance(module, nn.BatchNorm2d):
+      new = _sliced_bn(module, kept['out'])
+    else:
+      new = _sliced_conv(module, kept.get('out'), kept.get('in'))
+      if name == 'input_conv' and getattr(parent, 'hole_fill', None) is not None and 'out' in kept:
+        parent.hole_fill = parent.hole_fill[kept['out']] # BatchNorm folded PartialConv
+    # new modules start in training mode, a BatchNorm of a pruned eval model would use and update batch statistics
+    setattr(parent, name, new.train(module.training))
+  return model
+
+
+def save_pruned(model, plan, path):
+  torch.save({'plan':plan, 'state_dict':model.state_dict()}, path)
+
+
+def load_pruned(path, name='pconv_unet'):
+  checkpoint = torch.load(path, map_location='cpu')
+  model = apply_plan(build_model(name), checkpoint['plan'])
+  model.load_state_dict(checkpoint['state_dict'])
+  return model
+
+
+def conv_macs(model, inputs):
+  '''
+  Multiply-accumulates of the Conv2d and ConvTranspose2d layers for one forward of inputs, counted with forward hooks.
+  '''
+  total = [0]
+
+  def hook(module, args, output):
+    k = module.kernel_size[0] * module.kernel_size[1]
+    if isinstance(module, nn.ConvTranspose2d): # every input position is scattered to out_channels x k outputs
+      total[0] += args[0].numel() * module.out_channels // module.groups * k
+    else:
+      total[0] += output.numel() * module.in_channels // module.groups * k
+
+  handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d))]
+  with torch.no_grad():
+    model(*inputs)
+  for handle in handles:
+    handle.remove()
+  return total[0]
+
+
+def fine_tune(model, data_dir, steps=CONFIG['fine_tune_steps'], lr=CONFIG['fine_tune_lr'], criterion=None):
+  '''
+  Train the pruned model for `steps` steps with the training loss of the partial convolution script.
+  '''
+  from artwork_inpainting.data import load_mask_bank, make_dataloaders
+
+  script = load_script('pconv')
+  device = script.CONFIG['device']
+  train_dataloader, _ = make_dataloaders(data_dir, script.CONFIG['batch_size_train'], script.CONFIG['batch_size_eval'])
+  masks = load_mask_bank(data_dir)
+  criterion = criterion or script.InpaintingLoss(script.VGG16FeatureExtractor().to(device))
+  optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=script.CONFIG['weight_decay'])
+
+  state = {'steps':0}
+
+  def step_callback(step):
+    state['steps'] += 1
+    return state['steps'] >= steps
+
+  epoch = 0
+  while state['steps'] < steps:
+    script.train_one_epoch(model, train_dataloader, epoch, masks, optimizer, criterion, step_callback=step_callback)
+    epoch += 1
+  return model
+
+
+def prune_and_evaluate(amount, data_dir, checkpoint=None, fine_tune_steps=CONFIG['fine_tune_steps'],
+                       inception_outputs=CONFIG['inception_outputs'], batch_size=CONFIG['batch_size'],
+                       resolution=CONFIG['resolution'], threads=CONFIG['threads'], iters=CONFIG['iters'], output=None):
+  '''
+  Prune PartialConvUNet by `amount` (0 for the reference), fine-tune it and return its parameters, MACs, forward latency
+  and fast validation losses before and after fine-tuning.
+  '''
+  from artwork_inpainting.data import MemmapDataset, load_splits, load_mask_bank
+
+  if threads:
+    torch.set_num_threads(threads)
+  torch.manual_seed(0)
+  script = load_script('pconv')
+  device = script.CONFIG['device']
+
+  model = build_model('pconv_unet')
+  if checkpoint is not None:
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+  plan = pruning_plan(model, amount, amount, inception_outputs) if amount else {}
+  model = apply_plan(model, plan).to(device)
+
+  inputs = make_inputs('pconv_unet', batch_size, resolution, device)
+  model.eval()
+  with torch.no_grad():
+    latency = measure(lambda: model(*inputs), warmup=2, iters=iters, items=batch_size)['latency_mean_ms']
+
+  _, val_indices = load_splits(data_dir)
+  fast_val_set = script.make_fast_val_set(MemmapDataset(data_dir, val_indices), load_mask_bank(data_dir))
+  criterion = script.InpaintingLoss(script.VGG16FeatureExtractor().to(device))
+  before = script.fast_val_one_epoch(model, fast_val_set, 0, criterion)
+  after = before
+  if amount and fine_tune_steps:
+    fine_tune(model, data_dir, fine_tune_steps, criterion=criterion)
+    after = script.fast_val_one_epoch(model, fast_val_set, 0, criterion)
+  if output is not None:
+    save_pruned(model, plan, output)
+
+  return {'amount':amount, 'params':sum(p.numel() for p in model.parameters()),
+          'gmacs':conv_macs(model, inputs) / batch_size / 1e9, 'latency_ms':latency,
+          'val_before_fine_tune':{name:mean for name, (mean, ci) in before.items()},
+          'val':{name:mean for name, (mean, ci) in after.items()}}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--data-dir', required=True)
+  parser.add_argument('--checkpoint', help='trained PartialConvUNet state_dict')
+  parser.add_argument('--amounts', nargs='+', type=float, default=CONFIG['amounts'])
+  parser.add_argument('--fine-tune-steps', type=int, default=CONFIG['fine_tune_steps'])
+  parser.add_argument('--no-inception-outputs', action='store_true', help='only prune inside the branches')
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  parser.add_argument('--output-prefix', default='pconv_unet_pruned')
+  args = parser.parse_args(argv)
+
+  reports = []
+  for amount in [0.0] + args.amounts:
+    output = f'{args.output_prefix}_{amount}.pth' if amount else None
+    r = run_isolated(prune_and_evaluate, amount, args.data_dir, args.checkpoint, args.fine_tune_steps,
+                     not args.no_inception_outputs, args.batch_size, CONFIG['resolution'], args.threads,
+                     CONFIG['iters'], output)
+    if 'error' in r:
+      print(f'amount {amount:.2f} : ERROR {r["error"]}')
+      continue
+    reports.append(r)
+
+  if not reports:
+    return
+  reference = reports[0]
+  for r in reports:
+    print(f"amount {r['amount']:.2f} : {r['params'] / 1e6:6.2f} M params  {r['gmacs']:6.2f} GMACs/image  "
+          f"forward {r['latency_ms']:8.1f} ms (x{reference['latency_ms'] / r['latency_ms']:.2f})  "
+          f"hole {r['val_before_fine_tune']['hole']:.5f} -> {r['val']['hole']:.5f}  "
+          f"total {sum(r['val'].values()):.5f}")
+
+
+if __name__ == '__main__':
+  main()
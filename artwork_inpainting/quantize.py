@@ -0,0 +1,242 @@
+'''
+INT8 post-training static quantization of the inpainting models for CPU inference.
+
+quantize_model() prepares a float model in eager mode : BatchNorm is folded first (artwork_inpainting.fold_bn), then
+every quantizable unit is wrapped in its own QuantWrapper (quantize -> int8 module -> dequantize) :
+
+  nn.Sequential of convs / ReLU / pooling / upsampling   double_conv_layers, the inception branches channel_1..channel_4,
+                                                         the ResidualUnit and upsample_conv blocks, conv + ReLU fused
+  any other Conv2d / ConvTranspose2d                     DoubleConv, the transpose convs and PartialConv.input_conv
+
+Everything else stays float : the partial convolution mask update and hole filling (only the convolution inside
+PartialConv is quantized), the skip connection concatenations and additions, the output convolution (the last
+convolution of the model, CONFIG['keep_float'] adds others by module name) and, with the x86 and fbgemm backends, the
+transpose convolutions (their int8 kernels give wrong outputs, see _FLOAT_TRANSPOSE_BACKENDS). The observers are calibrated on a few
+hundred masked training images of the shared dataset (artwork_inpainting.data) and the int8 model is saved as a
+TorchScript artifact that loads without the training scripts.
+
+  python -m artwork_inpainting.quantize --model pconv_unet --data-dir /content/shared --checkpoint model.pth
+'''
+
+import io
+import math
+import argparse
+
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+
+from artwork_inpainting.fold_bn import fold_batchnorm
+from artwork_inpainting.loader import MODEL_SPECS, build_model, load_script
+
+CONFIG = {'model':'pconv_unet',
+          'backend':'x86', # 'fbgemm' on torch < 2.0
+          'keep_float':[], # module names left in float on top of the output convolution
+          'calibration_images':256,
+          'eval_images':256,
+          'batch_size':32,
+          'threads':None,
+          'iters':10,
+          'seed':1}
+
+_UNIT_LAYERS = (nn.Conv2d, nn.ConvTranspose2d, nn.ReLU, nn.Identity, nn.MaxPool2d, nn.Upsample, nn.BatchNorm2d)
+_CONV_GEOMETRY = ('in_channels', 'out_channels', 'kernel_size', 'stride', 'padding', 'dilation', 'groups')
+# backends whose int8 transposed convolution is wrong when in_channels != out_channels (mean error 1.4x the mean
+# output on a ConvTranspose2d(128, 64, 2, 2), torch 2.14) : the transposed convolutions stay float with them
+_FLOAT_TRANSPOSE_BACKENDS = ('x86', 'fbgemm')
+
+
+def _numeric_padding(model):
+  # quantized convolutions take numeric padding only, 'same' is exact for the odd kernels of the models
+  for module in model.modules():
+    if isinstance(module, nn.Conv2d) and module.padding == 'same':
+      if all(d * (k - 1) % 2 == 0 for k, d in zip(module.kernel_size, module.dilation)):
+        module.padding = tuple(d * (k - 1) // 2 for k, d in zip(module.kernel_size, module.dilation))
+
+
+def _fuse(sequential):
+  layers = [m for m in sequential if not isinstance(m, nn.Identity)] # the folded BatchNorms
+  sequential = nn.Sequential(*layers)
+  pairs = [[str(i), str(i + 1)] for i in range(len(layers) - 1)
+           if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.ReLU)]
+  return tq.fuse_modules(sequential, pairs) if pairs else sequential
+
+
+def _wrap(module, qconfig, transpose_qconfig):
+  if isinstance(module, nn.Sequential):
+    module = _fuse(module)
+  wrapper = tq.QuantWrapper(module)
+  # per channel weight observers are not supported for transposed convolutions
+  has_transpose = any(isinstance(m, nn.ConvTranspose2d) for m in module.modules())
+  wrapper.qconfig = transpose_qconfig if has_transpose else qconfig
+  if isinstance(module, nn.Conv2d): # PartialConv reads the geometry of its input_conv for the mask update
+    for attr in _CONV_GEOMETRY:
+      setattr(wrapper, attr, getattr(module, attr))
+  return wrapper
+
+
+def _wrap_units(module, keep_float, qconfig, transpose_qconfig, prefix=''):
+  for name, child in list(module.named_children()):
+    path = prefix + name
+    if path in keep_float:
+      continue
+    contains_float = any(path + '.' + n in keep_float for n, _ in child.named_modules() if n)
+    if (isinstance(child, nn.Sequential) and not contains_float and all(isinstance(m, _UNIT_LAYERS) for m in child)
+        and any(isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)) for m in child)):
+      setattr(module, name, _wrap(child, qconfig, transpose_qconfig))
+    elif isinstance(child, (nn.Conv2d, nn.ConvTranspose2d)):
+      setattr(module, name, _wrap(child, qconfig, transpose_qconfig))
+    else:
+      _wrap_units(child, keep_float, qconfig, transpose_qconfig, path + '.')
+
+
+def prepare_quantization(model, keep_float=CONFIG['keep_float'], backend=CONFIG['backend']):
+  '''
+  Return an eval copy of model with BatchNorm folded, its quantizable units wrapped and observers inserted, ready for
+  calibration forwards.
+  '''
+  torch.backends.quantized.engine = backend
+  model = fold_batchnorm(model)
+  _numeric_padding(model)
+
+  convs = [name for name, m in model.named_modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d))]
+  keep_float = set(keep_float) | {convs[-1]} # the output convolution
+  if backend in _FLOAT_TRANSPOSE_BACKENDS:
+    keep_float |= {name for name, m in model.named_modules() if isinstance(m, nn.ConvTranspose2d)}
+
+  qconfig = tq.get_default_qconfig(backend)
+  transpose_qconfig = tq.QConfig(activation=qconfig.activation, weight=tq.default_weight_observer)
+  _wrap_units(model, keep_float, qconfig, transpose_qconfig)
+  return tq.prepare(model.eval(), inplace=True)
+
+
+def _masked_batches(targets, masks, batch_size):
+  for start in range(0, len(targets), batch_size):
+    gt = targets[start:start+batch_size].float()
+    mask = masks[start:start+batch_size]
+    # holes set to 1 like get_masked_inputs of the training scripts
+    yield gt, torch.where(mask, gt, 1.0), mask.float()
+
+
+def _model_inputs(name, image, mask):
+  return (image,) if MODEL_SPECS[name]['inputs'] == 'image' else (image, mask)
+
+
+def _masked_set(data_dir, split, n_images, batch_size, seed):
+  from artwork_inpainting.data import MemmapDataset, load_splits, load_mask_bank
+
+  indices = load_splits(data_dir)[0 if split == 'train' else 1]
+  return load_script('pconv').make_fast_val_set(MemmapDataset(data_dir, indices), load_mask_bank(data_dir), n_images,
+                                                batch_size, seed)
+
+
+@torch.no_grad()
+def quantize_model(name, data_dir, checkpoint=None, n_images=CONFIG['calibration_images'],
+                   batch_size=CONFIG['batch_size'], keep_float=CONFIG['keep_float'], backend=CONFIG['backend'],
+                   seed=CONFIG['seed']):
+  '''
+  Return (float model, int8 model) of architecture `name`, the int8 one calibrated on n_images masked training images.
+  '''
+  model = build_model(name)
+  if checkpoint is not None:
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+  model.eval()
+
+  prepared = prepare_quantization(model, keep_float, backend)
+  targets, masks = _masked_set(data_dir, 'train', n_images, batch_size, seed)
+  for _, image, mask in _masked_batches(targets, masks, batch_size):
+    prepared(*_model_inputs(name, image, mask))
+  return model, tq.convert(prepared, inplace=True)
+
+
+def model_size_mb(model):
+  buffer = io.BytesIO()
+  torch.save(model.state_dict(), buffer)
+  return buffer.getbuffer().nbytes / 1024**2
+
+
+def save_quantized(model, name, path, batch_size=1, resolution=128):
+  '''
+  Save the int8 model as TorchScript (traced, the models have no data dependent control flow) and return the path.
+  '''
+  from artwork_inpainting.loader import make_inputs
+
+  with torch.no_grad():
+    traced = torch.jit.trace(model, make_inputs(name, batch_size, resolution), check_trace=False)
+  torch.jit.save(traced, path)
+  return path
+
+
+def load_quantized(path):
+  return torch.jit.load(path, map_location='cpu').eval()
+
+
+@torch.no_grad()
+def evaluate_quantized(name, float_model, int8_model, data_dir, n_images=CONFIG['eval_images'],
+                       batch_size=CONFIG['batch_size'], iters=CONFIG['iters']):
+  '''
+  Latency, model size and quality of the int8 model against the float one on a fixed masked validation subset :
+  PSNR of the int8 output against the float output, mean L1 between them on the holes, and the hole L1 of both
+  against the ground truth.
+  '''
+  from artwork_inpainting.benchmark import measure
+
+  targets, masks = _masked_set(data_dir, 'val', n_images, batch_size, 0)
+  squared_error, hole_l1, hole_l1_float_gt, hole_l1_int8_gt, hole_pixels, pixels = 0.0, 0.0, 0.0, 0.0, 0.0, 0
+  for gt, image, mask in _masked_batches(targets, masks, batch_size):
+    inputs = _model_inputs(name, image, mask)
+    out_float = float_model(*inputs).clamp(0, 1)
+    out_int8 = int8_model(*inputs).clamp(0, 1)
+    holes = 1 - mask
+    squared_error += torch.sum((out_int8 - out_float) ** 2).item()
+    pixels += out_float.numel()
+    hole_l1 += torch.sum(holes * torch.abs(out_int8 - out_float)).item()
+    hole_l1_float_gt += torch.sum(holes * torch.abs(out_float - gt)).item()
+    hole_l1_int8_gt += torch.sum(holes * torch.abs(out_int8 - gt)).item()
+    hole_pixels += holes.sum().item()
+
+  mse = squared_error / pixels
+  gt, image, mask = next(_masked_batches(targets, masks, batch_size))
+  inputs = _model_inputs(name, image, mask)
+  report = {'psnr_vs_float_db':10 * math.log10(1 / mse) if mse > 0 else float('inf'),
+            'hole_l1_vs_float':hole_l1 / max(hole_pixels, 1),
+            'hole_l1_gt_float':hole_l1_float_gt / max(hole_pixels, 1),
+            'hole_l1_gt_int8':hole_l1_int8_gt / max(hole_pixels, 1)}
+  for variant, model in [('float', float_model), ('int8', int8_model)]:
+    stats = measure(lambda: model(*inputs), warmup=2, iters=iters, items=len(image))
+    report[f'{variant}_latency_ms'] = stats['latency_mean_ms']
+    report[f'{variant}_size_mb'] = model_size_mb(model)
+  report['speedup'] = report['float_latency_ms'] / report['int8_latency_ms']
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--model', default=CONFIG['model'], choices=list(MODEL_SPECS))
+  parser.add_argument('--data-dir', required=True)
+  parser.add_argument('--checkpoint', help='float state_dict of the model, random weights otherwise')
+  parser.add_argument('--output', help='TorchScript path of the int8 model, {model}_int8.pt by default')
+  parser.add_argument('--calibration-images', type=int, default=CONFIG['calibration_images'])
+  parser.add_argument('--eval-images', type=int, default=CONFIG['eval_images'])
+  parser.add_argument('--batch-size', type=int, default=CONFIG['batch_size'])
+  parser.add_argument('--keep-float', nargs='*', default=CONFIG['keep_float'])
+  parser.add_argument('--backend', default=CONFIG['backend'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  args = parser.parse_args(argv)
+
+  if args.threads:
+    torch.set_num_threads(args.threads)
+  float_model, int8_model = quantize_model(args.model, args.data_dir, args.checkpoint, args.calibration_images,
+                                           args.batch_size, args.keep_float, args.backend)
+  path = save_quantized(int8_model, args.model, args.output or f'{args.model}_int8.pt')
+  print(f'int8 model written to {path}')
+
+  report = evaluate_quantized(args.model, float_model, int8_model, args.data_dir, args.eval_images, args.batch_size)
+  print(f"latency {report['float_latency_ms']:.1f} -> {report['int8_latency_ms']:.1f} ms (x{report['speedup']:.2f})  "
+        f"size {report['float_size_mb']:.1f} -> {report['int8_size_mb']:.1f} MB")
+  print(f"int8 vs float : PSNR {report['psnr_vs_float_db']:.2f} dB, hole L1 {report['hole_l1_vs_float']:.5f}  "
+        f"hole L1 vs ground truth : float {report['hole_l1_gt_float']:.5f}, int8 {report['hole_l1_gt_int8']:.5f}")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,251 @@
+'''
+Local HTTP inpainting service with dynamic request batching.
+
+A batch 1 forward pass leaves most of the CPU idle, so concurrent requests are collected into batches : the collector
+thread takes the first waiting request, then waits at most CONFIG['max_delay_ms'] after it (or until
+CONFIG['max_batch_size'] requests are there), groups the requests by image size and hands every group to a pool of
+worker threads running the model. Every worker gets its share of the torch threads.
+
+  POST /inpaint   .npz body with 'image' ((H, W, 3) uint8) and 'mask' ((H, W) bool, True for valid pixels),
+                  answers a .npz with 'output' ((H, W, 3) uint8, only the holes replaced)
+  GET /metrics    json : queue depth, requests, batches, batch size histogram, latency percentiles
+  GET /health
+
+Images of any size are accepted, they are edge padded to a multiple of CONFIG['size_multiple'] for the pooling layers.
+artwork_inpainting.load_test sends concurrent requests to a running server.
+
+  python -m artwork_inpainting.serve --model pconv_unet --checkpoint model.pth --port 8080
+'''
+
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from artwork_inpainting.benchmark import percentile
+from artwork_inpainting.inference import _pad, load_inpainting_model, model_inputs, to_float, to_uint8
+from artwork_inpainting.loader import MODEL_SPECS
+
+CONFIG = {'model':'pconv_unet',
+          'host':'127.0.0.1',
+          'port':8080,
+          'max_batch_size':16,
+          'max_delay_ms':10, # longest a request waits for others to share its batch
+          'workers':2, # batches running concurrently, the torch threads are split between them
+          'threads':None, # total torch threads, all the cores by default
+          'size_multiple':16, # the UNets pool 4 times
+          'latency_window':1000} # number of recent requests the latency percentiles are computed on
+
+
+class DynamicBatcher:
+  '''
+  Collect the submitted (image, mask) pairs into batches and run them through the model on a worker pool.
+
+  submit() returns a Future of the (H, W, 3) uint8 output.
+  '''
+  def __init__(self, model, inputs='image_mask', max_batch_size=CONFIG['max_batch_size'],
+               max_delay_ms=CONFIG['max_delay_ms'], workers=CONFIG['workers'], threads=CONFIG['threads'],
+               size_multiple=CONFIG['size_multiple'], device='cpu'):
+    import torch
+
+    self.model, self.inputs, self.device = model, inputs, device
+    self.max_batch_size, self.max_delay, self.size_multiple = max_batch_size, max_delay_ms / 1000, size_multiple
+    self.requests = queue.Queue()
+    # the intra op thread count is process wide, every concurrent batch gets its share
+    torch.set_num_threads(max(1, (threads or torch.get_num_threads()) // workers))
+    self.pool = ThreadPoolExecutor(workers)
+    self.lock = threading.Lock()
+    self.waiting = 0 # requests in batches waiting for a worker
+    self.running = 0 # requests in batches being run
+    self.batch_sizes = Counter()
+    self.latencies = deque(maxlen=CONFIG['latency_window'])
+    self.completed = 0
+    self.errors = 0
+    self.collector = threading.Thread(target=self._collect, daemon=True)
+    self.collector.start()
+
+  def submit(self, image, mask):
+    future = Future()
+    self.requests.put((time.perf_counter(), np.asarray(image), np.asarray(mask, dtype=bool), future))
+    return future
+
+  def close(self):
+    self.requests.put(None)
+    self.collector.join()
+    self.pool.shutdown()
+
+  def _collect(self):
+    while True:
+      first = self.requests.get()
+      if first is None:
+        return
+      batch = [first]
+      deadline = first[0] + self.max_delay
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - time.perf_counter()
+        try:
+          item = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+        except queue.Empty:
+          break
+        if item is None:
+          self.requests.put(None) # stop after this batch
+          break
+        batch.append(item)
+
+      groups = {}
+      for item in batch:
+        groups.setdefault(item[1].shape, []).append(item)
+      for group in groups.values():
+        with self.lock:
+          self.waiting += len(group)
+        self.pool.submit(self._run, group)
+
+  def _run(self, group):
+    import torch
+
+    with self.lock:
+      self.waiting -= len(group)
+      self.running += len(group)
+    height, width = group[0][1].shape[:2]
+    padded_height, padded_width = (-(-s // self.size_multiple) * self.size_multiple for s in (height, width))
+    try:
+      images = np.stack([_pad(to_float(image), padded_height, padded_width) for _, image, _, _ in group])
+      masks = np.stack([_pad(mask, padded_height, padded_width) for _, _, mask, _ in group])
+      with torch.no_grad():
+        image_batch = torch.from_numpy(images).permute(0, 3, 1, 2).to(self.device)
+        mask_batch = torch.from_numpy(masks[:, None].astype(np.float32)).to(self.device)
+        prediction = self.model(*model_inputs(self.inputs, image_batch, mask_batch)).permute(0, 2, 3, 1)
+        prediction = prediction.float().cpu().numpy()[:, :height, :width]
+      outputs = [to_uint8(np.where(mask[..., None], to_float(image), pred))
+                 for (_, image, mask, _), pred in zip(group, prediction)]
+    except Exception as e:
+      for *_, future in group:
+        future.set_exception(e)
+      with self.lock:
+        self.running -= len(group)
+        self.errors += len(group)
+      return
+
+    done = time.perf_counter()
+    with self.lock:
+      self.running -= len(group)
+      self.batch_sizes[len(group)] += 1
+      self.completed += len(group)
+      self.latencies.extend(done - start for start, *_ in group)
+    for (*_, future), output in zip(group, outputs):
+      future.set_result(output)
+
+  def metrics(self):
+    with self.lock:
+      latencies = [1000 * l for l in self.latencies]
+      batches = sum(self.batch_sizes.values())
+      # not yet collected, or collected in a batch all the workers are too busy to start
+      report = {'queue_depth':self.requests.qsize() + self.waiting, 'running':self.running,
+                'completed':self.completed, 'errors':self.errors, 'batches':batches,
+                'mean_batch_size':self.completed / batches if batches else 0.0,
+                'batch_sizes':{str(k):v for k, v in sorted(self.batch_sizes.items())}}
+    if latencies:
+      report.update({f'latency_p{q}_ms':percentile(latencies, q) for q in (50, 95, 99)})
+    return report
+
+
+def encode_arrays(**arrays):
+  buffer = io.BytesIO()
+  np.savez(buffer, **arrays)
+  return buffer.getvalue()
+
+
+def decode_arrays(data):
+  return dict(np.load(io.BytesIO(data), allow_pickle=False))
+
+
+def make_handler(batcher):
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep alive, the load generator reuses its connections
+
+    def _send(self, status, body, content_type):
+      self.send_response(status)
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def _send_json(self, status, obj):
+      self._send(status, json.dumps(obj).encode(), 'application/json')
+
+    def do_GET(self):
+      if self.path == '/metrics':
+        self._send_json(200, batcher.metrics())
+      elif self.path == '/health':
+        self._send_json(200, {'status':'ok'})
+      else:
+        self._send_json(404, {'error':f'unknown path {self.path}'})
+
+    def do_POST(self):
+      if self.path != '/inpaint':
+        self._send_json(404, {'error':f'unknown path {self.path}'})
+        return
+      try:
+        arrays = decode_arrays(self.rfile.read(int(self.headers['Content-Length'])))
+        image, mask = arrays['image'], arrays['mask']
+        if image.ndim != 3 or image.shape[2] != 3 or mask.shape != image.shape[:2]:
+          raise ValueError(f'expected an (H, W, 3) image and an (H, W) mask, got {image.shape} and {mask.shape}')
+      except Exception as e:
+        self._send_json(400, {'error':f'{type(e).__name__}: {e}'})
+        return
+      try:
+        output = batcher.submit(image, mask).result()
+      except Exception as e:
+        self._send_json(500, {'error':f'{type(e).__name__}: {e}'})
+        return
+      self._send(200, encode_arrays(output=output), 'application/octet-stream')
+
+    def log_message(self, format, *args): # one line per request would dominate the load tests
+      pass
+
+  return Handler
+
+
+def serve(model, inputs, host=CONFIG['host'], port=CONFIG['port'], **batcher_kwargs):
+  '''
+  Run the service until interrupted.
+  '''
+  batcher = DynamicBatcher(model, inputs, **batcher_kwargs)
+  server = ThreadingHTTPServer((host, port), make_handler(batcher))
+  server.daemon_threads = True
+  print(f'serving on http://{host}:{port}')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    batcher.close()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--model', default=CONFIG['model'], choices=list(MODEL_SPECS))
+  parser.add_argument('--checkpoint')
+  parser.add_argument('--host', default=CONFIG['host'])
+  parser.add_argument('--port', type=int, default=CONFIG['port'])
+  parser.add_argument('--max-batch-size', type=int, default=CONFIG['max_batch_size'])
+  parser.add_argument('--max-delay-ms', type=float, default=CONFIG['max_delay_ms'])
+  parser.add_argument('--workers', type=int, default=CONFIG['workers'])
+  parser.add_argument('--threads', type=int, default=CONFIG['threads'])
+  args = parser.parse_args(argv)
+
+  model = load_inpainting_model(args.model, args.checkpoint)
+  serve(model, MODEL_SPECS[args.model]['inputs'], args.host, args.port, max_batch_size=args.max_batch_size,
+        max_delay_ms=args.max_delay_ms, workers=args.workers, threads=args.threads)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,85 @@
+'''
+Cold start times of the package against a budget.
+
+Every stage runs in a fresh interpreter (`python -c`), several times, and the median wall time of the stage code is
+compared with its budget in CONFIG['budgets_ms'] :
+
+  import      import artwork_inpainting                          no work at all, a few milliseconds
+  inpaint     from artwork_inpainting import inpaint             numpy and the loader, no torch
+  model       artwork_inpainting.PartialConvUNet                 torch and the script definitions
+  build       artwork_inpainting.build_model('pconv_unet')       a model instance
+
+Together with the times, the heavy modules (loader.LAZY_IMPORTS) found in sys.modules after every stage are listed :
+none of them should be imported before the first call that needs it. The exit status is 1 when a budget is exceeded.
+
+  python -m artwork_inpainting.startup_benchmark --repeats 5
+'''
+
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+from artwork_inpainting.loader import LAZY_IMPORTS, REPO_DIR
+
+CONFIG = {'repeats':5,
+          'budgets_ms':{'import':50, 'inpaint':300, 'model':3000, 'build':3500}}
+
+STAGES = {'import':('', 'import artwork_inpainting'),
+          'inpaint':('', 'from artwork_inpainting import inpaint'),
+          'model':('import artwork_inpainting', 'artwork_inpainting.PartialConvUNet'),
+          'build':('import artwork_inpainting', "artwork_inpainting.build_model('pconv_unet')")}
+
+_TEMPLATE = '''
+import sys, json, time
+{setup}
+start = time.perf_counter()
+{stmt}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'ms':1000 * elapsed, 'modules':sorted({{m.split('.')[0] for m in sys.modules}})}}))
+'''
+
+
+def time_stage(setup, stmt, python=sys.executable):
+  '''
+  Wall time of `stmt` in a fresh interpreter after `setup` (not timed), and the top level modules imported by then.
+  '''
+  out = subprocess.run([python, '-c', _TEMPLATE.format(setup=setup, stmt=stmt)], cwd=REPO_DIR, capture_output=True,
+                       text=True, check=True).stdout
+  return json.loads(out.strip().splitlines()[-1])
+
+
+def run_stages(stages=list(STAGES), repeats=CONFIG['repeats']):
+  '''
+  {stage: {'median_ms', 'min_ms', 'heavy_modules'}} over `repeats` fresh interpreters per stage.
+  '''
+  report = {}
+  for stage in stages:
+    runs = [time_stage(*STAGES[stage]) for _ in range(repeats)]
+    times = [r['ms'] for r in runs]
+    report[stage] = {'median_ms':statistics.median(times), 'min_ms':min(times),
+                     'heavy_modules':[m for m in runs[-1]['modules'] if m in LAZY_IMPORTS]}
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES))
+  parser.add_argument('--repeats', type=int, default=CONFIG['repeats'])
+  args = parser.parse_args(argv)
+
+  over_budget = []
+  for stage, r in run_stages(args.stages, args.repeats).items():
+    budget = CONFIG['budgets_ms'][stage]
+    status = 'ok' if r['median_ms'] <= budget else 'OVER BUDGET'
+    if r['median_ms'] > budget:
+      over_budget.append(stage)
+    heavy = ', '.join(r['heavy_modules']) or 'none'
+    print(f"{stage:>8} : median {r['median_ms']:8.1f} ms  min {r['min_ms']:8.1f} ms  budget {budget:6d} ms  {status:<11}  "
+          f"heavy modules imported : {heavy}")
+  sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+  main()
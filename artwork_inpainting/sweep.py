@@ -0,0 +1,204 @@
+'''
+Hyperparameter sweep of the partial convolution training script with successive halving.
+
+All the trials run as parallel worker processes on one machine and read the same memory mapped dataset and mask bank
+(see artwork_inpainting.data), so images are decoded and masks generated once per sweep instead of once per config.
+
+Successive halving : every trial is first trained for `min_epochs` epochs, then only the best 1/eta trials (on the
+validation `metric`) are trained further, for eta times more epochs, and so on until `max_epochs`.
+
+  python -m artwork_inpainting.sweep --image-dir /content/processed_dataset --data-dir /content/shared \
+      --space space.json --workers 4
+
+with space.json e.g. {"lr": [1e-4, 5e-4], "hole_coef": [6, 10], "style_coef": [60, 120], "inception_out_multiplier": [1.2, 1.6]}
+'''
+
+import os
+import csv
+import json
+import random
+import argparse
+import itertools
+import multiprocessing as mp
+
+CONFIG = {'workers':2,
+          'min_epochs':1,
+          'max_epochs':9,
+          'eta':3,
+          'metric':'hole', # validation term used to rank the trials, or 'total' for the sum of all the terms
+          'n_trials':None, # None runs the whole grid, otherwise a random sample of the grid
+          'seed':42,
+          'out_dir':'sweep'}
+
+
+def grid(space, n_trials=None, seed=CONFIG['seed']):
+  '''
+  Expand a search space {CONFIG key: list of values} into the list of trial configs.
+  '''
+  keys = sorted(space)
+  configs = [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+  if n_trials is not None and n_trials < len(configs):
+    configs = random.Random(seed).sample(configs, n_trials)
+  return configs
+
+
+def rungs(min_epochs, max_epochs, eta):
+  '''
+  Cumulative epoch budgets of the successive halving rungs, e.g. (1, 9, 3) -> [1, 3, 9].
+  '''
+  budgets = [min_epochs]
+  while budgets[-1] * eta <= max_epochs:
+    budgets.append(budgets[-1] * eta)
+  if budgets[-1] < max_epochs:
+    budgets.append(max_epochs)
+  return budgets
+
+
+def validation_score(val_losses, metric):
+  return sum(val_losses.values()) if metric == 'total' else val_losses[metric]
+
+
+def promoted(scores, eta):
+  '''
+  Trials trained in the next rung : the best 1/eta (at least one) of {trial_id: score}, lower scores are better.
+  '''
+  return sorted(scores, key=scores.get)[:max(1, len(scores) // eta)]
+
+
+def train_trial(task):
+  '''
+  Train one trial from `start_epoch` to `end_epoch` in the calling (worker) process and return its validation losses.
+  The model and optimizer state are checkpointed in out_dir between rungs.
+  '''
+  trial_id, config, start_epoch, end_epoch, data_dir, out_dir, threads, cache_dir = task
+
+  os.environ['TQDM_DISABLE'] = '1' # one progress bar per worker is unreadable
+  import torch
+  from artwork_inpainting.loader import load_script
+  from artwork_inpainting.data import load_mask_bank, make_dataloaders
+  from artwork_inpainting.feature_cache import FeatureCache
+
+  torch.set_num_threads(threads)
+  script = load_script('pconv', config)
+  script.seed_everything(CONFIG['seed'] + trial_id)
+  device = script.CONFIG['device']
+
+  train_dataloader, val_dataloader = make_dataloaders(data_dir, script.CONFIG['batch_size_train'],
+                                                      script.CONFIG['batch_size_eval'])
+  masks = load_mask_bank(data_dir)
+  feature_cache = FeatureCache(cache_dir, data_dir) if cache_dir else None
+
+  extractor = script.VGG16FeatureExtractor().to(device)
+  model = script.PartialConvUNet().to(device=device)
+  criterion = script.InpaintingLoss(extractor)
+  optimizer = torch.optim.AdamW(model.parameters(), lr=script.CONFIG['lr'], weight_decay=script.CONFIG['weight_decay'])
+
+  checkpoint_path = os.path.join(out_dir, f'trial_{trial_id}.pth')
+  if start_epoch > 0:
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+
+  # the perceptual_* keys of the trial config apply, the schedule resumes where the previous rung stopped
+  loss_scheduler = script.LossScheduler()
+  loss_scheduler.step = start_epoch * len(train_dataloader)
+
+  for epoch in range(start_epoch, end_epoch):
+    script.train_one_epoch(model, train_dataloader, epoch, masks, optimizer, criterion, feature_cache, loss_scheduler)
+
+  if script.CONFIG.get('fast_val'):
+    # same fixed images and masks for every trial and rung, so the ranking is not affected by mask sampling noise
+    fast_val_set = script.make_fast_val_set(val_dataloader.dataset, masks)
+    val_losses = {name:mean for name, (mean, ci) in script.fast_val_one_epoch(model, fast_val_set, end_epoch - 1,
+                                                                              criterion).items()}
+  else:
+    val_losses = script.val_one_epoch(model, val_dataloader, end_epoch - 1, masks, criterion)
+    val_losses = {name:loss.item() for name, loss in zip(['hole', 'valid', 'prc', 'style', 'tv'], val_losses)}
+  torch.save({'model':model.state_dict(), 'optimizer':optimizer.state_dict()}, checkpoint_path)
+
+  return {'trial':trial_id, 'epochs':end_epoch, **val_losses}
+
+
+def run_sweep(configs, data_dir, out_dir=CONFIG['out_dir'], workers=CONFIG['workers'], min_epochs=CONFIG['min_epochs'],
+              max_epochs=CONFIG['max_epochs'], eta=CONFIG['eta'], metric=CONFIG['metric'], cache_dir=None, verbose=True):
+  '''
+  Run successive halving over the trial configs and return one row per trial for the results table.
+
+  configs : list of CONFIG overrides, one per trial
+  data_dir : directory written by artwork_inpainting.data.prepare_shared_data()
+  workers : number of trials trained at the same time, the cpu threads are split between them
+  cache_dir : optional ground truth feature cache (artwork_inpainting.feature_cache) shared by all the trials
+  '''
+  os.makedirs(out_dir, exist_ok=True)
+  threads = max(1, (os.cpu_count() or 1) // workers)
+
+  rows = {trial_id:{'trial':trial_id, **config, 'epochs':0, 'rung':-1, metric:None} for trial_id, config in enumerate(configs)}
+  active = list(rows)
+  done_epochs = 0
+
+  ctx = mp.get_context('spawn')
+  with ctx.Pool(workers, maxtasksperchild=1) as pool:
+    for rung, budget in enumerate(rungs(min_epochs, max_epochs, eta)):
+      tasks = [(trial_id, configs[trial_id], done_epochs, budget, data_dir, out_dir, threads, cache_dir)
+               for trial_id in active]
+      for result in pool.imap_unordered(train_trial, tasks):
+        score = validation_score({k:result[k] for k in ('hole', 'valid', 'prc', 'style', 'tv')}, metric)
+        rows[result['trial']].update({'epochs':result['epochs'], 'rung':rung, metric:score,
+                                      **{f'val_{k}':result[k] for k in ('hole', 'valid', 'prc', 'style', 'tv')}})
+        if verbose:
+          print(f"rung {rung} trial {result['trial']} epochs {result['epochs']} {metric} {score:.5f}")
+
+      done_epochs = budget
+      active = promoted({trial_id:rows[trial_id][metric] for trial_id in active}, eta)
+
+  return sorted(rows.values(), key=lambda row: (-row['rung'], row[metric]))
+
+
+def write_table(rows, path):
+  columns = list(dict.fromkeys(k for row in rows for k in row))
+  with open(path, 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=columns)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def format_table(rows):
+  columns = list(dict.fromkeys(k for row in rows for k in row))
+  cells = [[f'{row.get(c):.5g}' if isinstance(row.get(c), float) else str(row.get(c, '')) for c in columns] for row in rows]
+  widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+  lines = ['  '.join(c.rjust(w) for c, w in zip(columns, widths))]
+  lines += ['  '.join(v.rjust(w) for v, w in zip(r, widths)) for r in cells]
+  return '\n'.join(lines)
+
+
+def main(argv=None):
+  from artwork_inpainting.data import prepare_shared_data
+
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--image-dir', help='directory of 128x128 images, only needed the first time')
+  parser.add_argument('--data-dir', required=True)
+  parser.add_argument('--space', required=True, help='json file {CONFIG key: list of values}')
+  parser.add_argument('--n-trials', type=int, default=CONFIG['n_trials'])
+  parser.add_argument('--workers', type=int, default=CONFIG['workers'])
+  parser.add_argument('--min-epochs', type=int, default=CONFIG['min_epochs'])
+  parser.add_argument('--max-epochs', type=int, default=CONFIG['max_epochs'])
+  parser.add_argument('--eta', type=int, default=CONFIG['eta'])
+  parser.add_argument('--metric', default=CONFIG['metric'], choices=['hole', 'valid', 'prc', 'style', 'tv', 'total'])
+  parser.add_argument('--out-dir', default=CONFIG['out_dir'])
+  parser.add_argument('--feature-cache', help='ground truth feature cache directory built by artwork_inpainting.feature_cache')
+  args = parser.parse_args(argv)
+
+  if args.image_dir:
+    prepare_shared_data(args.image_dir, args.data_dir)
+
+  with open(args.space) as f:
+    configs = grid(json.load(f), args.n_trials)
+
+  rows = run_sweep(configs, args.data_dir, args.out_dir, args.workers, args.min_epochs, args.max_epochs, args.eta,
+                   args.metric, args.feature_cache)
+  write_table(rows, os.path.join(args.out_dir, 'results.csv'))
+  print(format_table(rows))
+
+
+if __name__ == '__main__':
+  main()
@@ -38,6 +38,7 @@ CONFIG = {'model_type':'Partial_conv_Inception_Inpainting_loss_1.6',
           'batch_size_eval':64,
           'kl_weights':0.02,
           'inception_out_multiplier':1.6, #times input channels count to get output channel count as inception module output
+          'merge_inception_projections':False, # InceptionModule : one 1x1 convolution for the channel_1..channel_3 projections
           'hole_coef':6,
           'valid_coef':1,
           'prc_coef':0.05,
@@ -51,6 +52,18 @@ CONFIG = {'model_type':'Partial_conv_Inception_Inpainting_loss_1.6',
           'up_conv_activation':nn.ReLU,
           'add_inception':True,
           'verbose':False,
+          'fast_val':True, # validate on a fixed seeded subset with fixed masks instead of the full validation split
+          'fast_val_images':256,
+          'fast_val_batch_size':32,
+          'fast_val_seed':0,
+          'val_interval':1, # validate every val_interval epochs
+          'perceptual_every':1, # LossScheduler : compute the prc and style terms every k steps (rescaled by k)
+          'perceptual_subbatch':1.0, # LossScheduler : fraction of the batch the prc and style terms are computed on
+          'perceptual_warmup_steps':0, # LossScheduler : first steps trained on the hole, valid and tv terms only
+          'pconv_recompute_input':False, # PartialConv : recompute input * mask in backward instead of saving it (less memory, a bit more compute)
+          'vgg_weights_path':'vgg16_enc_1_3.pth', # truncated VGG16 weights for the loss (python -m artwork_inpainting.extractor export), relative to the directory of this script
+          'vgg_download':False, # build the loss VGG16 from the pretrained torchvision download when vgg_weights_path is missing
+          'channels_last':False, # train and evaluate the model and the loss extractor in channels last memory format
           'device':"cuda" if torch.cuda.is_available() else 'cpu'}
 
 # seed everything for reproducibility 
@@ -62,6 +75,10 @@ def seed_everything(seed=42):
   torch.backends.cudnn.deterministic = True
   torch.backends.cudnn.benchmark = False
 
+def memory_format():
+  # layout of the model weights and of the batches, channels last (NHWC) lets oneDNN skip its layout reorders on cpu
+  return torch.channels_last if CONFIG['channels_last'] else torch.preserve_format
+
 seed_everything()
 
 """# Inpainting Loss Class"""
@@ -81,13 +98,57 @@ def total_variation_loss(image):
         torch.mean(torch.abs(image[:, :, :-1, :] - image[:, :, 1:, :]))
     return loss
 
+def vgg16_slice_layers():
+    # layers of models.vgg16().features[:17] (up to the third pooling), built
+    # directly so the 138M parameter network does not have to be instantiated
+    layers = []
+    in_channels = 3
+    for v in [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'M']:
+        if v == 'M':
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
+        else:
+            layers += [nn.Conv2d(in_channels, v, kernel_size=3, padding=1), nn.ReLU(inplace=True)]
+            in_channels = v
+    return layers
+
+
+def vgg_weights_file(path=CONFIG['vgg_weights_path']):
+    # relative paths are from the directory of this script (the working
+    # directory when it runs as a notebook), not from the current directory
+    if path is None or os.path.isabs(path):
+        return path
+    base = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+    return os.path.join(base, path)
+
+
+def load_state_dict_file(path):
+    # memory map the weights when torch supports it (>= 2.1)
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+
 class VGG16FeatureExtractor(nn.Module):
-    def __init__(self):
+    def __init__(self, weights_path=CONFIG['vgg_weights_path'], download=CONFIG['vgg_download']):
         super().__init__()
-        vgg16 = models.vgg16(pretrained=True)
-        self.enc_1 = nn.Sequential(*vgg16.features[:5])
-        self.enc_2 = nn.Sequential(*vgg16.features[5:10])
-        self.enc_3 = nn.Sequential(*vgg16.features[10:17])
+        # weights_path : file with only the enc_1..enc_3 weights (see
+        # artwork_inpainting.extractor.export_vgg_slice), so no download and
+        # no full VGG16 is needed, None to always download
+        # download : allow the torchvision download when weights_path is
+        # missing (it fails on machines without internet access)
+        weights_path = vgg_weights_file(weights_path)
+        local = weights_path is not None and os.path.exists(weights_path)
+        if not local and weights_path is not None and not download:
+            raise FileNotFoundError(f'VGG16 loss weights not found at {weights_path} : export them with '
+                                    f'python -m artwork_inpainting.extractor export --output {weights_path} '
+                                    f'on a machine with internet access, or set CONFIG["vgg_download"]')
+        features = vgg16_slice_layers() if local else models.vgg16(pretrained=True).features
+        self.enc_1 = nn.Sequential(*features[:5])
+        self.enc_2 = nn.Sequential(*features[5:10])
+        self.enc_3 = nn.Sequential(*features[10:17])
+        if local:
+            self.load_state_dict(load_state_dict_file(weights_path))
 
         # fix the encoder
         for i in range(3):
@@ -107,37 +168,60 @@ class InpaintingLoss(nn.Module):
         self.l1 = nn.L1Loss()
         self.extractor = extractor
 
-    def forward(self, input, mask, output, gt):
+    def forward(self, input, mask, output, gt, gt_feats=None, gt_grams=None,
+                perceptual=True, perceptual_batch=None):
+        # gt_feats / gt_grams : optional precomputed extractor features and
+        # gram matrices of gt (e.g. from a feature cache), computed if None
+        # perceptual : if False the 'prc' and 'style' terms are skipped (0)
+        # perceptual_batch : compute 'prc' and 'style' on the first
+        # perceptual_batch samples only (an unbiased estimate of the batch
+        # mean as long as the batches are shuffled)
         loss_dict = {}
         output_comp = mask * input + (1 - mask) * output
 
         loss_dict['hole'] = self.l1((1 - mask) * output, (1 - mask) * gt)
         loss_dict['valid'] = self.l1(mask * output, mask * gt)
 
-        if output.shape[1] == 3:
-            feat_output_comp = self.extractor(output_comp)
-            feat_output = self.extractor(output)
-            feat_gt = self.extractor(gt)
-        elif output.shape[1] == 1:
-            feat_output_comp = self.extractor(torch.cat([output_comp]*3, 1))
-            feat_output = self.extractor(torch.cat([output]*3, 1))
-            feat_gt = self.extractor(torch.cat([gt]*3, 1))
-        else:
+        loss_dict['tv'] = total_variation_loss(output_comp)
+
+        if not perceptual:
+            loss_dict['prc'] = torch.zeros((), device=output.device)
+            loss_dict['style'] = torch.zeros((), device=output.device)
+            return loss_dict
+
+        if perceptual_batch is not None and perceptual_batch < output.shape[0]:
+            output, output_comp, gt = output[:perceptual_batch], output_comp[:perceptual_batch], gt[:perceptual_batch]
+            gt_feats = [feat[:perceptual_batch] for feat in gt_feats] if gt_feats is not None else None
+            gt_grams = [gram[:perceptual_batch] for gram in gt_grams] if gt_grams is not None else None
+
+        if output.shape[1] == 1:
+            output, output_comp, gt = [torch.cat([x]*3, 1) for x in (output, output_comp, gt)]
+        elif output.shape[1] != 3:
             raise ValueError('only gray an')
 
+        # one batched extractor pass for output and output_comp, the two
+        # halves of every feature map are sliced back out as views
+        n = output.shape[0]
+        feat_both = self.extractor(torch.cat([output, output_comp], 0))
+        gram_both = [gram_matrix(feat) for feat in feat_both]
+
+        # the ground truth needs no gradient, its gram matrices are shared
+        # by both style terms
+        with torch.no_grad():
+            if gt_feats is None:
+                gt_feats = self.extractor(gt)
+            if gt_grams is None:
+                gt_grams = [gram_matrix(feat) for feat in gt_feats]
+
         loss_dict['prc'] = 0.0
         for i in range(3):
-            loss_dict['prc'] += self.l1(feat_output[i], feat_gt[i])
-            loss_dict['prc'] += self.l1(feat_output_comp[i], feat_gt[i])
+            loss_dict['prc'] += self.l1(feat_both[i][:n], gt_feats[i])
+            loss_dict['prc'] += self.l1(feat_both[i][n:], gt_feats[i])
 
         loss_dict['style'] = 0.0
         for i in range(3):
-            loss_dict['style'] += self.l1(gram_matrix(feat_output[i]),
-                                          gram_matrix(feat_gt[i]))
-            loss_dict['style'] += self.l1(gram_matrix(feat_output_comp[i]),
-                                          gram_matrix(feat_gt[i]))
-
-        loss_dict['tv'] = total_variation_loss(output_comp)
+            loss_dict['style'] += self.l1(gram_both[i][:n], gt_grams[i])
+            loss_dict['style'] += self.l1(gram_both[i][n:], gt_grams[i])
 
         return loss_dict
 
@@ -147,47 +231,98 @@ def print_shape(verbose, to_print):
   if verbose:
     print(to_print)
 
+class MaskedConv2dFunction(torch.autograd.Function):
+    # conv2d(input * mask) which saves input and the (compact) mask for
+    # backward instead of their product: input is kept alive by the previous
+    # activation anyway, so the product is recomputed in backward and one
+    # activation sized tensor per layer is not kept between forward and backward
+    @staticmethod
+    def forward(ctx, input, mask, weight, bias, stride, padding, dilation, groups):
+        ctx.save_for_backward(input, mask, weight)
+        ctx.conv = (bias is not None, stride, padding, dilation, groups)
+        return F.conv2d(input * mask, weight, bias, stride, padding, dilation, groups)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, mask, weight = ctx.saved_tensors
+        has_bias, stride, padding, dilation, groups = ctx.conv
+        grad_masked, grad_weight, grad_bias = torch.ops.aten.convolution_backward(
+            grad_output, input * mask, weight, [weight.shape[0]] if has_bias else None,
+            stride, padding, dilation, False, [0, 0], groups,
+            [ctx.needs_input_grad[0], ctx.needs_input_grad[2], has_bias and ctx.needs_input_grad[3]])
+        grad_input = grad_masked * mask if grad_masked is not None else None
+        return grad_input, None, grad_weight, grad_bias, None, None, None, None
+
 # https://github.com/naoto0804/pytorch-inpainting-with-partial-conv/blob/master/net.py
 class PartialConv(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1,
-                 padding=0, dilation=1, groups=1, bias=True):
+                 padding=0, dilation=1, groups=1, bias=True,
+                 recompute_masked_input=CONFIG['pconv_recompute_input']):
         super().__init__()
         self.input_conv = nn.Conv2d(in_channels, out_channels, kernel_size,
                                     stride, padding, dilation, groups, bias)
-        self.mask_conv = nn.Conv2d(in_channels, out_channels, kernel_size,
-                                   stride, padding, dilation, groups, False)
         #self.input_conv.apply(weights_init('kaiming'))
 
-        torch.nn.init.constant_(self.mask_conv.weight, 1.0)
+        # the mask update only counts the valid pixels under every window, a
+        # single channel box filter does it instead of a full in_channels x
+        # out_channels all-ones convolution (the mask is not updated)
+        self.register_buffer('mask_window', torch.ones(1, 1, *self.input_conv.kernel_size), persistent=False)
+
+        # per channel value of the windows without valid pixels, 0 unless a
+        # following BatchNorm was folded into input_conv (it is then the
+        # folded BatchNorm output for 0)
+        self.register_buffer('hole_fill', None)
+
+        # recompute_masked_input : use MaskedConv2dFunction while training,
+        # it needs numeric padding ('same' is converted for odd windows)
+        self.recompute_masked_input = recompute_masked_input
+        conv = self.input_conv
+        if conv.padding == 'same':
+            pad = [d * (k - 1) // 2 for k, d in zip(conv.kernel_size, conv.dilation)]
+            self.numeric_padding = pad if all(d * (k - 1) % 2 == 0 for k, d in zip(conv.kernel_size, conv.dilation)) else None
+        else:
+            self.numeric_padding = list(conv.padding)
 
-        # mask is not updated
-        for param in self.mask_conv.parameters():
-            param.requires_grad = False
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with the former all-ones mask_conv layer
+        state_dict.pop(prefix + 'mask_conv.weight', None)
+        if prefix + 'hole_fill' in state_dict: # BatchNorm folded checkpoints
+            self.hole_fill = state_dict.pop(prefix + 'hole_fill').clone()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, input, mask):
         # http://masc.cs.gmu.edu/wiki/partialconv
         # C(X) = W^T * X + b, C(0) = b, D(M) = 1 * M + 0 = sum(M)
         # W^T* (M .* X) / sum(M) + b = [C(M .* X) – C(0)] / D(M) + C(0)
 
-        output = self.input_conv(input * mask)
-        if self.input_conv.bias is not None:
-            output_bias = self.input_conv.bias.view(1, -1, 1, 1).expand_as(
-                output)
+        conv = self.input_conv
+        if self.recompute_masked_input and self.numeric_padding is not None and torch.is_grad_enabled():
+            output = MaskedConv2dFunction.apply(input, mask, conv.weight, conv.bias, conv.stride,
+                                                self.numeric_padding, conv.dilation, conv.groups)
         else:
-            output_bias = torch.zeros_like(output)
+            output = conv(input * mask)
 
         with torch.no_grad():
-            output_mask = self.mask_conv(mask)
-
-        no_update_holes = output_mask == 0
-        sum_1 = torch.sum(output_mask.masked_fill_(no_update_holes, 1.0))
-        sum_M = torch.sum(output_mask)
-
-        output_pre = ((output - output_bias) * (sum_1 / sum_M)) + output_bias
-        output = output_pre.masked_fill_(no_update_holes, 0.0)
-
-        new_mask = torch.ones_like(output)
-        new_mask = new_mask.masked_fill_(no_update_holes, 0.0)
+            # a window has no valid pixel iff it has none in any channel, so
+            # the holes are those of the window sum of the channel max
+            output_mask = F.conv2d(mask.amax(dim=1, keepdim=True), self.mask_window, None,
+                                   conv.stride, conv.padding, conv.dilation)
+            no_update_holes = output_mask == 0
+
+        # the renormalisation as written here scales by sum(1) / sum(M) taken
+        # over the whole masked_fill_-ed output_mask, the same tensor for both
+        # sums, i.e. by exactly 1 : (output - bias) * 1 + bias is output. It
+        # reduces to zeroing the windows without valid pixels, done in place
+        # (the convolution backward does not need its output) and the new mask
+        # is returned with a single channel, broadcast by the next layer. It is
+        # a multiplication rather than masked_fill_ : the backward of
+        # masked_fill_ returns NCHW gradients whatever the input layout, the one
+        # of mul_ keeps channels last
+        new_mask = (~no_update_holes).to(output.dtype)
+        if self.hole_fill is None:
+            output = output.mul_(new_mask)
+        else:
+            output = torch.where(no_update_holes, self.hole_fill.view(1, -1, 1, 1), output)
 
         return output, new_mask
 
@@ -274,7 +409,7 @@ class InceptionModule(nn.Module):
   Create a layer of Inception Module which were introduced in GoogLeNet, it is termed as "Convolutional layer on Steroids" by Aurelian geron in his book
   'Hands on ml with scikit learn and tensorflow'
   '''
-  def __init__(self, input_channels, ratios={'c1':0.3, 'c2':0.35, 'c3':0.1, 'c4':0.25}, verbose=False):
+  def __init__(self, input_channels, ratios={'c1':0.3, 'c2':0.35, 'c3':0.1, 'c4':0.25}, verbose=False, merge_projections=CONFIG['merge_inception_projections']):
     super().__init__()
     
     self.verbose = verbose
@@ -316,14 +451,37 @@ class InceptionModule(nn.Module):
     
     self.channel_4 = nn.Sequential(nn.MaxPool2d(kernel_size=3, stride=1, padding=1),
                               nn.Conv2d(in_channels=input_channels, out_channels=c4_out, kernel_size=1, stride=1, padding='same'))
+
+    # merge_projections : the 1x1 convolutions of channel_1, channel_2 and channel_3 all read the input, compute them as
+    # one convolution whose output is split between the branches (checkpoints of both layouts load in both)
+    self.merge_projections = merge_projections
+    self.projection_split = [c1_out, c2_in, c3_in]
+    if merge_projections:
+      self.projection = nn.Conv2d(in_channels=input_channels, out_channels=sum(self.projection_split), kernel_size=1)
+      self.channel_1 = nn.Identity()
+      self.channel_2[0] = nn.Identity()
+      self.channel_3[0] = nn.Identity()
+
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    names = [prefix + 'channel_1.', prefix + 'channel_2.0.', prefix + 'channel_3.0.']
+    if self.merge_projections and names[0] + 'weight' in state_dict:
+      for param in ['weight', 'bias']:
+        state_dict[prefix + 'projection.' + param] = torch.cat([state_dict.pop(name + param) for name in names], 0)
+    elif not self.merge_projections and prefix + 'projection.weight' in state_dict:
+      for param in ['weight', 'bias']:
+        split = torch.split(state_dict.pop(prefix + 'projection.' + param), self.projection_split, 0)
+        for name, value in zip(names, split):
+          state_dict[name + param] = value
+    super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
   def forward(self, input):
     print_shape(self.verbose, f'input shape : {input.shape}')
-    x1 = self.channel_1(input)
+    projected = torch.split(self.projection(input), self.projection_split, 1) if self.merge_projections else [input] * 3
+    x1 = self.channel_1(projected[0])
     print_shape(self.verbose, f'Channel 1 : {x1.shape}')
-    x2 = self.channel_2(input)
+    x2 = self.channel_2(projected[1])
     print_shape(self.verbose, f'Channel 2 : {x2.shape}')
-    x3 = self.channel_3(input)
+    x3 = self.channel_3(projected[2])
     print_shape(self.verbose, f'Channel 3 : {x3.shape}')
     x4 = self.channel_4(input)
     print_shape(self.verbose, f'Channel 4 : {x4.shape}')
@@ -642,8 +800,8 @@ def get_masked_inputs(targets, masks):
   targets : original images which have not been masked
   masks : buffer of masks out of which masks will be samples to mask the original image to create the input masked image
   '''
-  i = [random.choice(range(len(targets))) for i in range(len(targets))]
-  masks = torch.stack(masks)[i]
+  i = [random.choice(range(len(masks))) for i in range(len(targets))]
+  masks = torch.stack([masks[j] for j in i]) # only stack the sampled masks, not the whole buffer
   masks = torch.permute(masks, (0, 3, 1, 2))
   #print(pd.Series(masks.flatten()).value_counts())
   # get masked_inputs
@@ -651,7 +809,39 @@ def get_masked_inputs(targets, masks):
 
   return masked_inputs, torch.where(masks, 1, 0)
 
-def train_one_epoch(model, dataloader, epoch, masks_buffer, optimizer, criterion):
+class LossScheduler:
+  '''
+  Decide at every training step how the expensive 'prc' and 'style' terms of InpaintingLoss (VGG forward and gram
+  products) are computed, the cheap 'hole', 'valid' and 'tv' terms are computed at every step.
+
+  every : compute the perceptual and style terms every `every` steps, multiplied by `every` on these steps so that the
+          expected loss (and gradient) over the steps is the same as computing them at every step
+  subbatch : fraction of the batch the perceptual and style terms are computed on
+  warmup_steps : number of first steps trained on the cheap terms only
+  '''
+  def __init__(self, every=CONFIG['perceptual_every'], subbatch=CONFIG['perceptual_subbatch'], warmup_steps=CONFIG['perceptual_warmup_steps']):
+    self.every = every
+    self.subbatch = subbatch
+    self.warmup_steps = warmup_steps
+    self.step = 0
+
+  def next(self, batch_size):
+    '''
+    Return the keyword arguments of InpaintingLoss.forward and the scale of the perceptual and style terms for the next step.
+    '''
+    step = self.step
+    self.step += 1
+    if step < self.warmup_steps or (step - self.warmup_steps) % self.every != 0:
+      return {'perceptual':False}, 0.0
+    return {'perceptual':True, 'perceptual_batch':max(1, round(self.subbatch * batch_size))}, float(self.every)
+
+def train_one_epoch(model, dataloader, epoch, masks_buffer, optimizer, criterion, feature_cache=None, loss_scheduler=None, step_callback=None):
+  '''
+  feature_cache : optional cache of the ground truth extractor features (artwork_inpainting.feature_cache.FeatureCache),
+                  the dataloader must then yield (image, image id) batches like artwork_inpainting.data.MemmapDataset
+  loss_scheduler : optional LossScheduler, by default every loss term is computed at every step
+  step_callback : optional function called after every optimizer step with the step index, the epoch stops early if it returns True
+  '''
   model.train()
 
   total_loss = 0
@@ -666,16 +856,18 @@ def train_one_epoch(model, dataloader, epoch, masks_buffer, optimizer, criterion
   for step, batch in bar:
     targets = batch[0].to(float)
     inputs, masks = get_masked_inputs(targets, masks_buffer)
-    masks = masks.to(device=CONFIG['device'], dtype=torch.float)
-    inputs = inputs.to(device=CONFIG['device'], dtype=torch.float)
-    targets = torch.tensor(targets, requires_grad=True).to(device=CONFIG['device'], dtype=torch.float)
+    masks = masks.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+    inputs = inputs.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+    targets = torch.tensor(targets, requires_grad=True).to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
     
     preds = model(inputs, masks)
-    loss_dict = criterion(inputs, masks, preds, targets)
+    gt_cached = feature_cache.lookup(batch[1], CONFIG['device']) if feature_cache is not None else {}
+    schedule, perceptual_scale = loss_scheduler.next(len(targets)) if loss_scheduler is not None else ({}, 1.0)
+    loss_dict = criterion(inputs, masks, preds, targets, **gt_cached, **schedule)
     loss_hole = CONFIG['hole_coef'] * loss_dict['hole']
     loss_valid = CONFIG['valid_coef'] * loss_dict['valid']
-    loss_prc = CONFIG['prc_coef'] * loss_dict['prc']
-    loss_style = CONFIG['style_coef'] * loss_dict['style']
+    loss_prc = CONFIG['prc_coef'] * perceptual_scale * loss_dict['prc']
+    loss_style = CONFIG['style_coef'] * perceptual_scale * loss_dict['style']
     loss_tv = CONFIG['tv_coef'] * loss_dict['tv']
     loss = loss_hole+loss_valid+loss_prc+loss_style+loss_tv
       
@@ -704,6 +896,9 @@ def train_one_epoch(model, dataloader, epoch, masks_buffer, optimizer, criterion
 
     gc.collect()
     torch.cuda.empty_cache()
+
+    if step_callback is not None and step_callback(step):
+      break
     
   return epoch_loss_hole, epoch_loss_valid, epoch_loss_prc, epoch_loss_style, epoch_loss_tv
 
@@ -723,9 +918,9 @@ def val_one_epoch(model, dataloader, epoch, masks_buffer, criterion):
   for step, batch in bar:
     targets = batch[0].to(float)
     inputs, masks = get_masked_inputs(targets, masks_buffer)
-    masks = masks.to(device=CONFIG['device'], dtype=torch.float)
-    inputs = inputs.to(device=CONFIG['device'], dtype=torch.float)
-    targets = targets.to(device=CONFIG['device'], dtype=torch.float)
+    masks = masks.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+    inputs = inputs.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+    targets = targets.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
 
     preds = model(inputs, masks)
     loss_dict = criterion(inputs, masks, preds, targets)
@@ -757,15 +952,70 @@ def val_one_epoch(model, dataloader, epoch, masks_buffer, criterion):
 
   return epoch_loss_hole, epoch_loss_valid, epoch_loss_prc, epoch_loss_style, epoch_loss_tv
 
+def make_fast_val_set(dataset, masks_buffer, n_images=CONFIG['fast_val_images'], batch_size=CONFIG['fast_val_batch_size'], seed=CONFIG['fast_val_seed']):
+  '''
+  Build the fixed validation set used by fast_val_one_epoch : a seeded subset of the dataset with a precomputed mask
+  assigned to every image, so that the validation losses of different epochs are computed on exactly the same inputs.
+
+  dataset : validation dataset, items are (image, label)
+  masks_buffer : buffer of masks out of which the masks are drawn
+  n_images : size of the subset, rounded down to a multiple of batch_size so that every batch has the same weight
+  seed : seed of the image and mask draws, independent from the global random state
+  '''
+  generator = torch.Generator().manual_seed(seed)
+  n_images = max(batch_size, (min(n_images, len(dataset)) // batch_size) * batch_size)
+  image_ids = torch.randperm(len(dataset), generator=generator)[:n_images].tolist()
+  mask_ids = torch.randint(len(masks_buffer), (len(image_ids),), generator=generator).tolist()
+
+  targets = torch.stack([dataset[i][0] for i in image_ids])
+  masks = torch.permute(torch.stack([masks_buffer[j] for j in mask_ids]), (0, 3, 1, 2))
+
+  return targets, masks
+
+@torch.no_grad()
+def fast_val_one_epoch(model, fast_val_set, epoch, criterion, batch_size=CONFIG['fast_val_batch_size']):
+  '''
+  Validate on the fixed set of make_fast_val_set and return {loss term: (mean, 95% confidence half width)}.
+  The confidence interval uses the spread of the per batch losses (normal approximation).
+  '''
+  model.eval()
+
+  targets_all, masks_all = fast_val_set
+  batch_losses = {'hole':[], 'valid':[], 'prc':[], 'style':[], 'tv':[]}
+
+  for start in range(0, len(targets_all), batch_size):
+    targets = targets_all[start:start+batch_size].to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+    masks = masks_all[start:start+batch_size].to(device=CONFIG['device'], memory_format=memory_format())
+    inputs = torch.where(masks, targets, 1.0)
+    masks = masks.to(dtype=torch.float)
+
+    preds = model(inputs, masks)
+    loss_dict = criterion(inputs, masks, preds, targets)
+    for name in batch_losses:
+      batch_losses[name].append(loss_dict[name].item())
+
+  results = {}
+  for name, values in batch_losses.items():
+    values = torch.tensor(values, dtype=torch.float64)
+    half_width = 1.96 * values.std().item() / math.sqrt(len(values)) if len(values) > 1 else 0.0
+    results[name] = (values.mean().item(), half_width)
+
+  print(f'Epoch {epoch+1} fast validation : ' + ', '.join(f'{name}={mean:.5f}±{ci:.5f}' for name, (mean, ci) in results.items()))
+
+  gc.collect()
+  torch.cuda.empty_cache()
+
+  return results
+
 @torch.no_grad()
 def test_samples(model, samples, masks_buffer, sparse_encoder=False):
   model.eval()
 
   targets = samples.to(float)
   inputs, masks = get_masked_inputs(targets, masks_buffer)
-  masks = masks.to(device=CONFIG['device'], dtype=torch.float)
-  inputs = inputs.to(device=CONFIG['device'], dtype=torch.float)
-  targets = targets.to(device=CONFIG['device'], dtype=torch.float)
+  masks = masks.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+  inputs = inputs.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+  targets = targets.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
   
   preds = model(inputs, masks)
 
@@ -779,22 +1029,30 @@ def test_samples(model, samples, masks_buffer, sparse_encoder=False):
 
 # Training Loop
 torch.cuda.empty_cache()
-extractor = VGG16FeatureExtractor().to(CONFIG['device'])
-model = PartialConvUNet().to(device=CONFIG['device'])
+extractor = VGG16FeatureExtractor().to(CONFIG['device'], memory_format=memory_format())
+model = PartialConvUNet().to(device=CONFIG['device'], memory_format=memory_format())
 #model.load_state_dict(torch.load('/content/Inception_l1_1.6_epoch_16_batch_size_64.pth'))
 criterion = InpaintingLoss(extractor)
 optimizer = torch.optim.AdamW(model.parameters(), lr=CONFIG['lr'], weight_decay=CONFIG['weight_decay'])
+loss_scheduler = LossScheduler()
 
 train_loss_list = []
 val_loss_list = []
+val_ci_list = []
 
+fast_val_set = make_fast_val_set(val_dataset, CONFIG['masks']) if CONFIG['fast_val'] else None
 
 for epoch in range(CONFIG['epochs']):
-  train_hole, train_valid, train_prc, train_style, train_tv = train_one_epoch(model, train_dataloader, epoch, CONFIG['masks'], optimizer, criterion)
-  
-  val_hole, val_valid, val_prc, val_style, val_tv = val_one_epoch(model, val_dataloader, epoch, CONFIG['masks'], criterion)
-
+  train_hole, train_valid, train_prc, train_style, train_tv = train_one_epoch(model, train_dataloader, epoch, CONFIG['masks'], optimizer, criterion, loss_scheduler=loss_scheduler)
   train_loss_list.append((train_hole, train_valid, train_prc, train_style, train_tv))
-  val_loss_list.append((val_hole, val_valid, val_prc, val_style, val_tv))
+
+  if (epoch + 1) % CONFIG['val_interval'] == 0:
+    if CONFIG['fast_val']:
+      val_results = fast_val_one_epoch(model, fast_val_set, epoch, criterion)
+      val_loss_list.append(tuple(val_results[name][0] for name in ['hole', 'valid', 'prc', 'style', 'tv']))
+      val_ci_list.append(tuple(val_results[name][1] for name in ['hole', 'valid', 'prc', 'style', 'tv']))
+    else:
+      val_hole, val_valid, val_prc, val_style, val_tv = val_one_epoch(model, val_dataloader, epoch, CONFIG['masks'], criterion)
+      val_loss_list.append((val_hole, val_valid, val_prc, val_style, val_tv))
 
   torch.save(model.state_dict(), f'{CONFIG["model_type"]}_epoch_{epoch}_batch_size_{CONFIG["batch_size_train"]}.pth')
\ No newline at end of file
@@ -0,0 +1,65 @@
+'''
+Fixtures shared by the tests : stub inpainting models, a small shared data directory and the inpainting loss with a
+randomly initialised VGG16 slice (the comparisons do not depend on the pretrained weights).
+'''
+
+import pytest
+
+
+class IdentityModel:
+  '''
+  Stub inpainting model returning its image input : the tiles as read, with the holes set to 1.
+  '''
+  def __call__(self, image, mask=None):
+    return image
+
+
+@pytest.fixture
+def identity_model():
+  return IdentityModel()
+
+
+@pytest.fixture(scope='session')
+def shared_data(tmp_path_factory):
+  '''
+  Small prepare_shared_data() directory : 16 random 64x64 images (12 train, 4 val) and a bank of 24 masks.
+  '''
+  np = pytest.importorskip('numpy')
+  Image = pytest.importorskip('PIL.Image')
+  pytest.importorskip('tqdm')
+  from artwork_inpainting.data import prepare_shared_data
+
+  image_dir = tmp_path_factory.mktemp('images')
+  rng = np.random.RandomState(0)
+  for k in range(16):
+    # non square sizes go through the centre crop of prepare_shared_data
+    Image.fromarray(rng.randint(0, 256, (64 + 8 * (k % 3), 64, 3), dtype=np.uint8)).save(image_dir / f'{k:03d}.png')
+  data_dir = tmp_path_factory.mktemp('shared')
+  prepare_shared_data(str(image_dir), str(data_dir), size=64, n_masks=24, val_fraction=0.25, verbose=False)
+  return str(data_dir)
+
+
+@pytest.fixture(scope='session')
+def vgg_weights(tmp_path_factory):
+  '''
+  Path of a randomly initialised VGG16 slice in the format of `python -m artwork_inpainting.extractor export`.
+  '''
+  torch = pytest.importorskip('torch')
+  from torch import nn
+  from artwork_inpainting.loader import load_script
+
+  torch.manual_seed(0)
+  layers = load_script('pconv').vgg16_slice_layers()
+  vgg = nn.Module()
+  vgg.enc_1, vgg.enc_2, vgg.enc_3 = nn.Sequential(*layers[:5]), nn.Sequential(*layers[5:10]), nn.Sequential(*layers[10:17])
+  path = str(tmp_path_factory.mktemp('vgg') / 'vgg16_enc_1_3.pth')
+  torch.save(vgg.state_dict(), path)
+  return path
+
+
+@pytest.fixture(scope='session')
+def criterion(vgg_weights):
+  from artwork_inpainting.loader import load_script
+
+  script = load_script('pconv')
+  return script.InpaintingLoss(script.VGG16FeatureExtractor(weights_path=vgg_weights))
@@ -0,0 +1,63 @@
+'''
+Benchmark command line smoke test : one small configuration run end to end (spawned worker included), the keys of
+the machine readable json output, and the regression comparison against a previous output.
+
+  python -m pytest tests/test_benchmark.py
+'''
+
+import json
+
+import pytest
+
+pytest.importorskip('torch')
+
+from artwork_inpainting.benchmark import main, percentile
+
+ENVIRONMENT_KEYS = {'torch', 'python', 'platform', 'processor', 'cpu_count', 'commit', 'time'}
+RESULT_KEYS = {'model', 'mode', 'batch_size', 'resolution', 'threads', 'channels_last', 'model_rss_mb', 'peak_rss_mb',
+               'latency_mean_ms', 'latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms', 'images_per_sec'}
+
+
+@pytest.fixture(scope='module')
+def report_path(tmp_path_factory):
+  path = str(tmp_path_factory.mktemp('benchmark') / 'bench.json')
+  assert main(['--models', 'unet_small', '--batch-sizes', '2', '--resolutions', '32', '--threads', '1',
+               '--warmup', '0', '--iters', '2', '--output', path]) == 0
+  return path
+
+
+def test_json_output(report_path):
+  with open(report_path) as f:
+    report = json.load(f)
+  assert set(report) == {'environment', 'results'}
+  assert set(report['environment']) == ENVIRONMENT_KEYS
+  assert [r['mode'] for r in report['results']] == ['forward', 'forward_backward']
+  for result in report['results']:
+    assert set(result) == RESULT_KEYS
+    assert (result['model'], result['batch_size'], result['resolution'], result['threads'],
+            result['channels_last']) == ('unet_small', 2, 32, 1, False)
+    assert 0 < result['latency_p50_ms'] <= result['latency_p99_ms']
+    assert result['images_per_sec'] == pytest.approx(2000 / result['latency_mean_ms'])
+
+
+def test_compare(report_path, tmp_path):
+  assert main(['--models', 'unet_small', '--batch-sizes', '2', '--resolutions', '32', '--threads', '1',
+               '--modes', 'forward', '--warmup', '0', '--iters', '2', '--output', str(tmp_path / 'new.json'),
+               '--compare', report_path]) in (0, 1)
+
+  with open(report_path) as f:
+    report = json.load(f)
+  for result in report['results']:
+    result['images_per_sec'] *= 100 # a previous run 100 times faster
+  faster = str(tmp_path / 'faster.json')
+  with open(faster, 'w') as f:
+    json.dump(report, f)
+  assert main(['--models', 'unet_small', '--batch-sizes', '2', '--resolutions', '32', '--threads', '1',
+               '--modes', 'forward', '--warmup', '0', '--iters', '2', '--output', str(tmp_path / 'new.json'),
+               '--compare', faster]) == 1
+
+
+def test_percentile():
+  assert percentile([3, 1, 2], 50) == 2
+  assert percentile([1, 2], 50) == 1.5
+  assert percentile([5], 99) == 5
@@ -0,0 +1,40 @@
+'''
+channels_last.layout_audit : it must not change what the model computes, and must report an op turning channels last
+activations back into NCHW together with the module it ran in.
+
+  python -m pytest tests/test_channels_last.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch import nn
+
+from artwork_inpainting.channels_last import layout_audit, to_channels_last
+from artwork_inpainting.loader import build_model, make_inputs
+
+
+class ToNCHW(nn.Module):
+  def forward(self, x):
+    return x.contiguous()
+
+
+def test_audit_keeps_outputs():
+  torch.manual_seed(0)
+  model = to_channels_last(build_model('pconv_unet')).eval()
+  inputs = make_inputs('pconv_unet', 1, 64, channels_last=True)
+  with torch.no_grad():
+    expected = model(*inputs)
+
+  outputs = []
+  model.register_forward_hook(lambda m, args, output: outputs.append(output.detach()))
+  layout_audit(model, inputs, backward=True)
+  torch.testing.assert_close(outputs[0], expected)
+
+
+def test_audit_reports_conversion():
+  model = to_channels_last(nn.Sequential(nn.Conv2d(3, 8, 3), ToNCHW(), nn.Conv2d(8, 8, 3)))
+  input = torch.rand(2, 3, 16, 16).contiguous(memory_format=torch.channels_last)
+  report = layout_audit(model, (input,), backward=False)
+  assert [(c['module'], c['output_layout']) for c in report['conversions']] == [('1', 'nchw')]
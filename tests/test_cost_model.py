@@ -0,0 +1,30 @@
+'''
+Analytic cost model against torch.utils.flop_counter.FlopCounterMode on a real forward pass : the convolution FLOPs
+(FlopCounterMode counts 2 x MACs per convolution, without the bias, the PartialConv mask update convolution included)
+and the output shape, for every model of MODEL_SPECS.
+
+  python -m pytest tests/test_cost_model.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch.utils.flop_counter import FlopCounterMode
+
+from artwork_inpainting.cost_model import model_cost
+from artwork_inpainting.loader import MODEL_SPECS, build_model, make_inputs
+
+
+@pytest.mark.parametrize('name', list(MODEL_SPECS))
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_macs_match_flop_counter(name, batch_size):
+  torch.manual_seed(0)
+  model = build_model(name).eval()
+  with torch.no_grad(), FlopCounterMode(display=False) as counter:
+    output = model(*make_inputs(name, batch_size, 128))
+
+  cost = model_cost(name, 128, batch_size)
+  assert 2 * cost['macs'] == counter.get_total_flops()
+  assert (batch_size, *cost['output']) == tuple(output.shape)
+  assert cost['flops'] > 2 * cost['macs'] # plus the bias, normalisation, activation and elementwise FLOPs
@@ -0,0 +1,115 @@
+'''
+crop_inpaint and its damaged region search : label_components against scipy.ndimage.label (8-connectivity),
+hole_regions merging by merge_distance, only the hole pixels written back (stub models) and a model cost following
+the damaged area rather than the image size.
+
+  python -m pytest tests/test_crop_inference.py
+'''
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from artwork_inpainting.inference import _CountingModel, crop_inpaint, hole_regions, label_components
+
+
+class ConstantModel:
+  '''
+  Stub inpainting model predicting `value` everywhere.
+  '''
+  def __init__(self, value):
+    self.value = value
+
+  def __call__(self, image, mask=None):
+    return image * 0 + self.value
+
+
+@pytest.mark.parametrize('density', [0.05, 0.3, 0.55, 0.8])
+@pytest.mark.parametrize('shape', [(1, 1), (1, 40), (37, 53), (64, 64)])
+def test_labels_match_scipy(shape, density):
+  ndimage = pytest.importorskip('scipy.ndimage')
+  grid = np.random.RandomState(0).rand(*shape) < density
+  labels, n = label_components(grid)
+  expected, expected_n = ndimage.label(grid, structure=np.ones((3, 3)))
+  assert n == expected_n
+  assert ((labels > 0) == grid).all() and labels.max() == n
+  # same partition : the label pairs of the foreground cells are a one to one mapping
+  pairs = set(zip(labels[grid].tolist(), expected[grid].tolist()))
+  assert len(pairs) == n == len({a for a, _ in pairs}) == len({b for _, b in pairs})
+
+
+def _two_holes(gap_cells, cell=16):
+  # two 1 cell holes on the same row of cells, gap_cells empty cells apart
+  mask = np.ones((128, 256), dtype=bool)
+  mask[40:44, 20:28] = False
+  x = (2 + gap_cells) * cell + 4
+  mask[40:44, x:x + 8] = False
+  return mask
+
+
+def test_regions_merge_by_distance():
+  mask = _two_holes(2)
+  assert hole_regions(mask, cell=16, merge_distance=0) == [(32, 48, 16, 32), (32, 48, 64, 80)]
+  assert hole_regions(mask, cell=16, merge_distance=32) == [(32, 48, 16, 80)]
+  # regions further apart than merge_distance stay separate
+  assert len(hole_regions(_two_holes(6), cell=16, merge_distance=32)) == 2
+
+
+def test_regions_cover_every_hole():
+  rng = np.random.RandomState(0)
+  mask = rng.rand(300, 417) > 0.002
+  covered = np.zeros_like(mask)
+  for y0, y1, x0, x1 in hole_regions(mask, cell=16, merge_distance=32, chunk_rows=64):
+    assert 0 <= y0 < y1 <= 300 and 0 <= x0 < x1 <= 417
+    covered[y0:y1, x0:x1] = True
+  assert covered[~mask].all()
+
+
+def _damaged(height, width, holes):
+  rng = np.random.RandomState(0)
+  image = rng.rand(height, width, 3).astype(np.float32)
+  mask = np.ones((height, width), dtype=bool)
+  for y, x, size in holes:
+    mask[y:y + size, x:x + size] = False
+  return image, mask
+
+
+# small holes inpainted in batched windows, and a hole larger than a crop inpainted with tiled_inpaint
+HOLES = [(10, 10, 6), (200, 40, 12), (100, 300, 20), (260, 330, 3), (40, 150, 170)]
+
+
+@pytest.mark.parametrize('inputs', ['image', 'image_mask'])
+def test_only_holes_are_written(inputs, identity_model):
+  pytest.importorskip('torch')
+  image, mask = _damaged(300, 400, HOLES)
+  result = crop_inpaint(ConstantModel(0.25), image, mask, inputs, crop=64, context=16, batch_size=2)
+  np.testing.assert_array_equal(result[mask], image[mask])
+  np.testing.assert_allclose(result[~mask], 0.25, rtol=0, atol=1e-6)
+
+  result = crop_inpaint(identity_model, image, mask, inputs, crop=64, context=16, batch_size=2)
+  np.testing.assert_array_equal(result, np.where(mask[..., None], image, np.float32(1.0)))
+
+
+def test_uint8_output_in_place(identity_model):
+  pytest.importorskip('torch')
+  image, mask = _damaged(300, 400, HOLES)
+  image = (image * 255).astype(np.uint8)
+  output = np.zeros_like(image)
+  result = crop_inpaint(identity_model, image, mask, crop=64, context=16, output=output)
+  assert result is output
+  np.testing.assert_array_equal(output, np.where(mask[..., None], image, 255))
+
+
+def test_cost_follows_damaged_area(identity_model):
+  pytest.importorskip('torch')
+  holes = [(100, 100, 8), (100, 400, 8), (400, 100, 8)]
+
+  def cost(height, width, holes):
+    image, mask = _damaged(height, width, holes)
+    counter = _CountingModel(identity_model)
+    crop_inpaint(counter, image, mask, crop=64, context=16)
+    return counter.pixels
+
+  # one crop x crop window per isolated small region, whatever the image size
+  assert cost(512, 512, holes) == cost(2048, 1536, holes) == 3 * 64 * 64
+  assert cost(512, 512, holes[:1]) == 64 * 64
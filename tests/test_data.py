@@ -0,0 +1,77 @@
+'''
+Shared data directory of artwork_inpainting.data on the small fixture : the decoded images and their split, the
+MemmapDataset items (ToTensor layout and image ids), the mask bank format of the training scripts and the dataloaders.
+
+  python -m pytest tests/test_data.py
+'''
+
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from artwork_inpainting.data import (MemmapDataset, _load_image, load_mask_bank, load_meta, load_splits,
+                                     make_dataloaders, prepare_shared_data)
+
+
+def test_layout(shared_data):
+  meta = load_meta(shared_data)
+  assert meta['names'] == [f'{k:03d}.png' for k in range(16)] and meta['size'] == 64 and meta['n_masks'] == 24
+  images = np.load(os.path.join(shared_data, 'images.npy'), mmap_mode='r')
+  assert images.shape == (16, 64, 64, 3) and images.dtype == np.uint8
+
+  train, val = load_splits(shared_data)
+  assert len(train) == 12 and len(val) == 4
+  assert sorted(np.concatenate([train, val]).tolist()) == list(range(16))
+  assert list(train) == sorted(train) and list(val) == sorted(val)
+
+
+def test_prepared_once(shared_data, tmp_path):
+  before = {name:os.path.getmtime(os.path.join(shared_data, name)) for name in os.listdir(shared_data)}
+  prepare_shared_data(str(tmp_path / 'no_images_needed'), shared_data, size=64, n_masks=24, verbose=False)
+  assert {name:os.path.getmtime(os.path.join(shared_data, name)) for name in os.listdir(shared_data)} == before
+
+
+def test_centre_crop(tmp_path):
+  Image = pytest.importorskip('PIL.Image')
+  image = np.zeros((96, 64, 3), dtype=np.uint8)
+  image[:16], image[16:80], image[80:] = (255, 0, 0), (0, 255, 0), (0, 0, 255)
+  Image.fromarray(image).save(tmp_path / 'tall.png')
+  loaded = _load_image(str(tmp_path / 'tall.png'), 32)
+  assert loaded.shape == (32, 32, 3)
+  assert (loaded == (0, 255, 0)).all() # the bands above and below the centre square are cropped out
+
+
+def test_dataset_items(shared_data):
+  images = np.load(os.path.join(shared_data, 'images.npy'))
+  _, val = load_splits(shared_data)
+  dataset = MemmapDataset(shared_data, val)
+  assert len(dataset) == 4 and len(MemmapDataset(shared_data)) == 16
+  for i in range(len(dataset)):
+    image, index = dataset[i]
+    assert index == val[i] and image.shape == (3, 64, 64) and image.dtype == torch.float32
+    # transforms.ToTensor() of the decoded image
+    torch.testing.assert_close(image, torch.from_numpy(images[index]).permute(2, 0, 1).float() / 255, rtol=0, atol=0)
+
+
+def test_mask_bank(shared_data):
+  masks = load_mask_bank(shared_data)
+  assert len(masks) == 24
+  for mask in masks:
+    assert mask.shape == (64, 64, 3) and mask.dtype == torch.bool
+    assert torch.equal(mask[..., 0], mask[..., 2]) # the same mask for every channel
+    assert mask.any() and not mask.all() # valid pixels and holes
+  # views of one copy on write mapping, no private copy per mask
+  assert masks[0].untyped_storage().data_ptr() == masks[-1].untyped_storage().data_ptr()
+  assert not torch.equal(masks[0], masks[1])
+
+
+def test_dataloaders(shared_data):
+  train_dataloader, val_dataloader = make_dataloaders(shared_data, 5, 3)
+  assert len(train_dataloader) == 2 and len(val_dataloader) == 1 # last incomplete batches dropped
+  images, indices = next(iter(val_dataloader))
+  assert images.shape == (3, 3, 64, 64) and indices.tolist() == load_splits(shared_data)[1][:3].tolist()
+  seen = [i for _, batch in train_dataloader for i in batch.tolist()]
+  assert len(seen) == 10 and set(seen) <= set(load_splits(shared_data)[0].tolist())
@@ -0,0 +1,120 @@
+'''
+Distillation into the small UNet : SkipFeatures capture of the skip connections of every architecture, the teacher
+cache (shapes, dtype, values against a direct teacher forward), TeacherCacheDataset refusing a cache of another
+training split, and a one epoch distill() / evaluate_distillation() smoke run on the shared data fixture.
+
+  python -m pytest tests/test_distill.py
+'''
+
+import os
+import json
+import shutil
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+import torch.nn.functional as F
+
+from artwork_inpainting.distill import (SKIP_MODULES, SkipFeatures, TeacherCacheDataset, _model_inputs,
+                                        build_teacher_cache, distill, evaluate_distillation)
+from artwork_inpainting.loader import build_model, make_inputs
+
+TEACHER = 'pconv_unet'
+
+
+@pytest.mark.parametrize('name', list(SKIP_MODULES))
+def test_skip_features(name):
+  torch.manual_seed(0)
+  model = build_model(name).eval()
+  inputs = make_inputs(name, 2, 64)
+  outputs = {}
+  handles = [model.get_submodule(path).register_forward_hook(
+               lambda module, args, output, path=path: outputs.__setitem__(path, output) and None)
+             for path in SKIP_MODULES[name]]
+  with torch.no_grad(), SkipFeatures(model, name) as skips:
+    model(*inputs)
+  for handle in handles:
+    handle.remove()
+
+  for path, feature in zip(SKIP_MODULES[name], skips.features):
+    expected = outputs[path][0] if isinstance(outputs[path], tuple) else outputs[path] # DoublePConv : (x, mask)
+    assert feature is expected
+  # x1, x2, x3 at full, half and quarter resolution
+  assert [f.shape[-1] for f in skips.features] == [64, 32, 16]
+  assert all(not module._forward_hooks for module in model.modules()) # hooks removed on exit
+
+
+def test_unknown_model():
+  with pytest.raises(ValueError, match='no skip features'):
+    SkipFeatures(build_model('resnet_unet'), 'resnet_unet')
+
+
+@pytest.fixture(scope='module')
+def teacher_cache(shared_data, tmp_path_factory):
+  directory = tmp_path_factory.mktemp('distill')
+  torch.manual_seed(0)
+  teacher = build_model(TEACHER).eval()
+  checkpoint = str(directory / 'teacher.pth')
+  torch.save(teacher.state_dict(), checkpoint)
+  cache_dir = build_teacher_cache(TEACHER, checkpoint, shared_data, str(directory / 'cache'), masks_per_image=2,
+                                  feature_pool=2, batch_size=5, verbose=False)
+  return teacher, checkpoint, cache_dir
+
+
+def test_cache_layout(shared_data, teacher_cache):
+  teacher, checkpoint, cache_dir = teacher_cache
+  with open(os.path.join(cache_dir, 'meta.json')) as f:
+    meta = json.load(f)
+  assert meta['teacher'] == TEACHER and meta['checkpoint'] == checkpoint and len(meta['image_ids']) == 12
+  assert meta['shapes'] == [[64, 32, 32], [128, 16, 16], [256, 8, 8]] # x1, x2, x3 pooled by 2
+
+  mask_ids = np.load(os.path.join(cache_dir, 'mask_ids.npy'))
+  assert mask_ids.shape == (12, 2) and mask_ids.dtype == np.int32 and 0 <= mask_ids.min() <= mask_ids.max() < 24
+  outputs = np.load(os.path.join(cache_dir, 'outputs.npy'), mmap_mode='r')
+  assert outputs.shape == (12, 2, 3, 64, 64) and outputs.dtype == np.float16
+  for i, shape in enumerate(meta['shapes']):
+    skip = np.load(os.path.join(cache_dir, f'skip_{i+1}.npy'), mmap_mode='r')
+    assert skip.shape == (12, 2, *shape) and skip.dtype == np.float16
+
+
+def test_cache_values(shared_data, teacher_cache):
+  teacher, _, cache_dir = teacher_cache
+  dataset = TeacherCacheDataset(shared_data, cache_dir)
+  assert len(dataset) == 24
+  for i in [0, 5, 23]:
+    image, valid, output, features = dataset[i]
+    assert image.shape == (3, 64, 64) and valid.shape == (1, 64, 64) and output.dtype == torch.float32
+    with torch.no_grad(), SkipFeatures(teacher, TEACHER) as skips:
+      expected = teacher(*_model_inputs(TEACHER, image[None], valid[None]))
+    # stored in float16
+    torch.testing.assert_close(output, expected[0], rtol=1e-3, atol=1e-3)
+    for feature, skip in zip(features, skips.features):
+      torch.testing.assert_close(feature, F.avg_pool2d(skip, 2)[0], rtol=1e-3, atol=1e-3)
+
+
+def test_cache_of_another_split_rejected(shared_data, teacher_cache, tmp_path):
+  other = str(tmp_path / 'shared')
+  shutil.copytree(shared_data, other)
+  train, val = np.load(os.path.join(other, 'splits.npz')).values()
+  np.savez(os.path.join(other, 'splits.npz'), train=np.sort(np.r_[train[1:], val[0]]), val=np.r_[val[1:], train[0]])
+  with pytest.raises(ValueError, match='another training split'):
+    TeacherCacheDataset(other, teacher_cache[2])
+
+
+def test_distill_one_epoch(shared_data, teacher_cache, tmp_path):
+  teacher, _, cache_dir = teacher_cache
+  prefix = str(tmp_path / 'student')
+  student, history = distill(shared_data, cache_dir, 'unet_small', epochs=1, batch_size=8, checkpoint_prefix=prefix)
+  assert len(history) == 1 and set(history[0]) == {'output', 'target', 'features'}
+  assert all(np.isfinite(v) and v > 0 for v in history[0].values())
+
+  # a plain state_dict of the student architecture, without the adapters
+  reloaded = build_model('unet_small')
+  reloaded.load_state_dict(torch.load(f'{prefix}_epoch_0.pth'))
+
+  report = evaluate_distillation(TEACHER, teacher, 'unet_small', student, shared_data, n_images=4, batch_size=2,
+                                 iters=1)
+  assert report['student_params'] < report['teacher_params']
+  assert all(np.isfinite(v) for v in report.values())
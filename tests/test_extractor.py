@@ -0,0 +1,76 @@
+'''
+Offline VGG16 slice of the perceptual loss : an exported slice loads back with the outputs of the torchvision
+features[:17] it was cut from, relative weight paths are resolved against the repo directory and a missing file is a
+FileNotFoundError instead of a download.
+
+torchvision.models.vgg16 is replaced by a randomly initialised VGG16 (no pretrained download here), the export only
+copies its weights.
+
+  python -m pytest tests/test_extractor.py
+'''
+
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+torchvision = pytest.importorskip('torchvision')
+
+from artwork_inpainting.extractor import LightFeatureExtractor, export_vgg_slice
+from artwork_inpainting.loader import REPO_DIR, load_script
+
+
+@pytest.fixture(scope='module')
+def script():
+  return load_script('pconv')
+
+
+@pytest.fixture
+def vgg(monkeypatch):
+  torch.manual_seed(0)
+  vgg = torchvision.models.vgg16(weights=None).eval()
+  monkeypatch.setattr(torchvision.models, 'vgg16', lambda *args, **kwargs: vgg)
+  return vgg
+
+
+def _torchvision_slice(vgg, image):
+  features = vgg.features
+  outputs = [features[:5](image)]
+  outputs.append(features[5:10](outputs[-1]))
+  outputs.append(features[10:17](outputs[-1]))
+  return outputs
+
+
+@pytest.mark.parametrize('half', [False, True])
+def test_exported_slice_matches_torchvision(script, vgg, tmp_path, half):
+  path = export_vgg_slice(str(tmp_path / 'vgg16_enc_1_3.pth'), half)
+  extractor = script.VGG16FeatureExtractor(path).eval()
+  assert not any(p.requires_grad for p in extractor.parameters())
+
+  image = torch.rand(2, 3, 64, 64)
+  with torch.no_grad():
+    for output, expected in zip(extractor(image), _torchvision_slice(vgg, image)):
+      if half: # float16 weights, cast back to float32 on load
+        assert torch.mean(torch.abs(output - expected)) < 1e-3 * torch.mean(torch.abs(expected)) + 1e-6
+      else:
+        torch.testing.assert_close(output, expected, rtol=0, atol=0)
+
+
+def test_relative_path_is_from_the_repo(script, tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  assert script.vgg_weights_file('vgg16_enc_1_3.pth') == os.path.join(REPO_DIR, 'vgg16_enc_1_3.pth')
+  assert script.vgg_weights_file(str(tmp_path / 'w.pth')) == str(tmp_path / 'w.pth')
+
+
+def test_missing_weights_raise(script, vgg):
+  with pytest.raises(FileNotFoundError, match='artwork_inpainting.extractor export'):
+    script.VGG16FeatureExtractor('missing_vgg16_enc_1_3.pth')
+  # the download stays possible when it is asked for
+  extractor = script.VGG16FeatureExtractor('missing_vgg16_enc_1_3.pth', download=True)
+  torch.testing.assert_close(extractor.enc_1[0].weight, vgg.features[0].weight)
+
+
+def test_light_extractor_shapes(vgg):
+  image = torch.rand(2, 3, 64, 64)
+  shapes = [tuple(f.shape) for f in LightFeatureExtractor()(image)]
+  assert shapes == [tuple(f.shape) for f in _torchvision_slice(vgg, image)]
@@ -0,0 +1,95 @@
+'''
+Fast validation of the partial convolution script : make_fast_val_set draws the same images and masks for the same
+seed whatever the global random state, so fast_val_one_epoch values are comparable across epochs, and its 95%
+confidence half width is 1.96 standard errors of the per batch losses.
+
+  python -m pytest tests/test_fast_validation.py
+'''
+
+import math
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch import nn
+
+from artwork_inpainting.data import MemmapDataset, load_mask_bank, load_splits
+from artwork_inpainting.loader import load_script
+
+
+@pytest.fixture(scope='module')
+def script():
+  return load_script('pconv')
+
+
+@pytest.fixture(scope='module')
+def val_data(shared_data):
+  train_indices, _ = load_splits(shared_data)
+  return MemmapDataset(shared_data, train_indices), load_mask_bank(shared_data)
+
+
+class HalfModel(nn.Module):
+  def forward(self, image, mask):
+    return image * 0.5
+
+
+def l1_criterion(input, mask, output, gt):
+  hole = torch.mean((1 - mask) * torch.abs(output - gt))
+  valid = torch.mean(mask * torch.abs(output - gt))
+  return {'hole':hole, 'valid':valid, 'prc':hole * 2, 'style':valid * 0, 'tv':torch.mean(torch.abs(output))}
+
+
+def test_same_seed_same_set(script, val_data):
+  dataset, masks = val_data
+  torch.manual_seed(0)
+  targets, mask_set = script.make_fast_val_set(dataset, masks, 8, 4, seed=3)
+  torch.manual_seed(123) # the global random state does not matter
+  torch.rand(100)
+  targets_again, masks_again = script.make_fast_val_set(dataset, masks, 8, 4, seed=3)
+  assert torch.equal(targets, targets_again) and torch.equal(mask_set, masks_again)
+  assert targets.shape == (8, 3, 64, 64) and mask_set.shape == (8, 3, 64, 64) and mask_set.dtype == torch.bool
+
+  other_targets, other_masks = script.make_fast_val_set(dataset, masks, 8, 4, seed=4)
+  assert not (torch.equal(other_targets, targets) and torch.equal(other_masks, mask_set))
+
+
+def test_size_is_a_multiple_of_the_batch(script, val_data):
+  dataset, masks = val_data
+  assert len(script.make_fast_val_set(dataset, masks, 11, 4)[0]) == 8
+  assert len(script.make_fast_val_set(dataset, masks, 100, 5)[0]) == 10 # 12 images, rounded down
+  assert len(script.make_fast_val_set(dataset, masks, 2, 4)[0]) == 4 # at least one batch
+
+
+def test_values_comparable_across_epochs(script, val_data):
+  dataset, masks = val_data
+  fast_val_set = script.make_fast_val_set(dataset, masks, 12, 4, seed=0)
+  model = HalfModel().train()
+  first = script.fast_val_one_epoch(model, fast_val_set, 0, l1_criterion, batch_size=4)
+  assert not model.training
+  torch.rand(10) # another epoch, another global random state
+  second = script.fast_val_one_epoch(model, script.make_fast_val_set(dataset, masks, 12, 4, seed=0), 1, l1_criterion,
+                                     batch_size=4)
+  assert first == second
+
+
+def test_confidence_interval(script, val_data):
+  dataset, masks = val_data
+  targets, mask_set = script.make_fast_val_set(dataset, masks, 12, 4, seed=0)
+  results = script.fast_val_one_epoch(HalfModel(), (targets, mask_set), 0, l1_criterion, batch_size=4)
+
+  batch_losses = {name:[] for name in results}
+  for start in range(0, 12, 4):
+    gt, mask = targets[start:start + 4], mask_set[start:start + 4]
+    input = torch.where(mask, gt, 1.0)
+    for name, value in l1_criterion(input, mask.float(), input * 0.5, gt).items():
+      batch_losses[name].append(value.item())
+  for name, values in batch_losses.items():
+    mean = sum(values) / len(values)
+    std = math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+    assert results[name][0] == pytest.approx(mean, rel=1e-6)
+    assert results[name][1] == pytest.approx(1.96 * std / math.sqrt(len(values)), rel=1e-6, abs=1e-12)
+  assert results['style'] == (0.0, 0.0) and results['hole'][1] > 0
+
+  single = script.fast_val_one_epoch(HalfModel(), (targets[:4], mask_set[:4]), 0, l1_criterion, batch_size=4)
+  assert all(ci == 0.0 for _, ci in single.values()) # one batch, no spread to estimate
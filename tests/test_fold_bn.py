@@ -0,0 +1,46 @@
+'''
+fold_batchnorm : eval mode outputs of the folded copy against the model, with non trivial BatchNorm statistics
+(randomize_batchnorm). The PartialConvUNet mask has a large hole so that windows without valid pixels, and with them
+PartialConv.hole_fill, are part of the comparison.
+
+  python -m pytest tests/test_fold_bn.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch import nn
+
+from artwork_inpainting.fold_bn import fold_batchnorm, randomize_batchnorm
+from artwork_inpainting.loader import build_model, make_inputs
+
+
+def _inputs(name):
+  torch.manual_seed(0)
+  inputs = make_inputs(name, 2, 64)
+  if len(inputs) == 1:
+    return inputs
+  image, mask = inputs
+  mask = mask.clone()
+  mask[:, :, 8:40, 8:40] = 0
+  return image * mask + (1 - mask), mask
+
+
+@pytest.mark.parametrize('name', ['unet', 'pconv_unet', 'resnet_unet'])
+def test_folded_outputs_match(name):
+  torch.manual_seed(0)
+  model = randomize_batchnorm(build_model(name)).eval()
+  folded = fold_batchnorm(model)
+  inputs = _inputs(name)
+
+  with torch.no_grad():
+    torch.testing.assert_close(folded(*inputs), model(*inputs), rtol=1e-5, atol=1e-5)
+  assert not any(isinstance(m, nn.BatchNorm2d) for m in folded.modules())
+
+
+def test_hole_fill_is_used():
+  model = randomize_batchnorm(build_model('pconv_unet')).eval()
+  folded = fold_batchnorm(model)
+  hole_fills = [m.hole_fill for m in folded.modules() if hasattr(m, 'hole_fill')]
+  assert hole_fills and all(fill is not None for fill in hole_fills)
@@ -0,0 +1,47 @@
+'''
+InceptionModule merged 1x1 projections (CONFIG['merge_inception_projections']) : checkpoints of the separate layout
+load into the merged one and the other way round, with the same outputs, in the three scripts defining the module.
+
+  python -m pytest tests/test_inception_projections.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from artwork_inpainting.loader import build_model, load_script, make_inputs
+
+SCRIPTS = ['unet', 'unet_inception', 'pconv']
+MODELS = ['unet_inception', 'unet_bottleneck_inception', 'pconv_unet']
+
+
+@pytest.mark.parametrize('script', SCRIPTS)
+@pytest.mark.parametrize('merged_source', [False, True])
+def test_module_round_trip(script, merged_source):
+  inception_module = load_script(script).InceptionModule
+  torch.manual_seed(0)
+  source = inception_module(32, merge_projections=merged_source).eval()
+  target = inception_module(32, merge_projections=not merged_source).eval()
+  target.load_state_dict(source.state_dict())
+  back = inception_module(32, merge_projections=merged_source).eval()
+  back.load_state_dict(target.state_dict())
+
+  input = torch.rand(2, 32, 16, 16)
+  with torch.no_grad():
+    expected = source(input)
+    torch.testing.assert_close(target(input), expected, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(back(input), expected, rtol=0, atol=0)
+
+
+@pytest.mark.parametrize('name', MODELS)
+@pytest.mark.parametrize('merged_source', [False, True])
+def test_model_checkpoint_loads_in_other_layout(name, merged_source):
+  torch.manual_seed(0)
+  source = build_model(name, config={'merge_inception_projections':merged_source}).eval()
+  target = build_model(name, config={'merge_inception_projections':not merged_source})
+  target.load_state_dict(source.state_dict())
+  target.eval()
+
+  inputs = make_inputs(name, 2, 64)
+  with torch.no_grad():
+    torch.testing.assert_close(target(*inputs), source(*inputs), rtol=1e-4, atol=1e-5)
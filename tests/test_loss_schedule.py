@@ -0,0 +1,76 @@
+'''
+LossScheduler of the partial convolution script : the every-k rescaling and the perceptual sub-batch keep the expected
+perceptual and style terms equal to the ones computed on the whole batch at every step.
+
+  python -m pytest tests/test_loss_schedule.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from artwork_inpainting.loader import load_script, make_inputs
+
+
+@pytest.fixture(scope='module')
+def script():
+  return load_script('pconv')
+
+
+@pytest.mark.parametrize('every', [1, 3, 4])
+@pytest.mark.parametrize('warmup_steps', [0, 5])
+def test_every_k_scale_averages_to_one(script, every, warmup_steps):
+  scheduler = script.LossScheduler(every=every, subbatch=1.0, warmup_steps=warmup_steps)
+  steps = [scheduler.next(8) for _ in range(warmup_steps + 10 * every)]
+  assert all(not kwargs['perceptual'] and scale == 0.0 for kwargs, scale in steps[:warmup_steps])
+
+  after_warmup = steps[warmup_steps:]
+  # every window of `every` consecutive steps has the perceptual terms exactly once, scaled by every
+  for start in range(0, len(after_warmup), every):
+    window = after_warmup[start:start + every]
+    assert sum(scale for kwargs, scale in window if kwargs['perceptual']) == every
+  assert sum(scale for _, scale in after_warmup) / len(after_warmup) == 1.0
+
+
+@pytest.mark.parametrize('subbatch, batch_size, expected', [(1.0, 8, 8), (0.25, 8, 2), (0.5, 6, 3), (0.01, 8, 1)])
+def test_subbatch_size(script, subbatch, batch_size, expected):
+  kwargs, scale = script.LossScheduler(every=1, subbatch=subbatch).next(batch_size)
+  assert kwargs == {'perceptual':True, 'perceptual_batch':expected} and scale == 1.0
+
+
+@pytest.mark.parametrize('perceptual_batch', [1, 2, 4])
+def test_subbatch_is_unbiased(criterion, perceptual_batch):
+  # the perceptual and style terms are means over the samples : averaged over the sub-batches of a partition of the
+  # batch (which a shuffled loader draws with equal probability), they equal the terms of the whole batch
+  torch.manual_seed(0)
+  input, mask = make_inputs('pconv_unet', 8, 32)
+  output, gt = torch.rand_like(input), torch.rand_like(input)
+  with torch.no_grad():
+    full = criterion(input, mask, output, gt)
+    estimates = []
+    for start in range(0, 8, perceptual_batch):
+      order = torch.roll(torch.arange(8), -start)
+      estimates.append(criterion(input[order], mask[order], output[order], gt[order], perceptual_batch=perceptual_batch))
+
+  for name in ['prc', 'style']:
+    mean = sum(e[name] for e in estimates) / len(estimates)
+    torch.testing.assert_close(mean, full[name], rtol=1e-5, atol=0)
+    if perceptual_batch < 8:
+      assert not all(torch.equal(e[name], full[name]) for e in estimates) # the sub-batches do differ
+  for name in ['hole', 'valid', 'tv']: # always on the whole batch
+    torch.testing.assert_close(estimates[0][name], full[name], rtol=1e-6, atol=0)
+
+
+def test_scaled_loss_expectation(script, criterion):
+  # training loss over a full every-k cycle equals k times the every-step loss
+  torch.manual_seed(0)
+  input, mask = make_inputs('pconv_unet', 4, 32)
+  output, gt = torch.rand_like(input), torch.rand_like(input)
+  scheduler = script.LossScheduler(every=3, subbatch=1.0)
+  with torch.no_grad():
+    full = criterion(input, mask, output, gt)
+    total = 0
+    for _ in range(3):
+      kwargs, scale = scheduler.next(4)
+      total = total + scale * criterion(input, mask, output, gt, **kwargs)['prc']
+  torch.testing.assert_close(total / 3, full['prc'], rtol=1e-6, atol=0)
@@ -0,0 +1,46 @@
+'''
+ONNX export : OnnxRunner against the eager model (BatchNorm folded in the export, not in the eager model) for every
+exported architecture, at two batch sizes and two resolutions other than the export one (the dynamic axes).
+
+  python -m pytest tests/test_onnx_export.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from artwork_inpainting.fold_bn import randomize_batchnorm
+from artwork_inpainting.loader import make_inputs
+from artwork_inpainting.onnx_export import OnnxRunner, _load_model, export_onnx
+
+MODELS = ['unet', 'pconv_unet', 'resnet_unet']
+
+
+@pytest.fixture(scope='module')
+def exported(tmp_path_factory):
+  directory = tmp_path_factory.mktemp('onnx')
+  paths = {}
+  for name in MODELS:
+    # non trivial BatchNorm statistics, so that the folding is part of the comparison
+    model = randomize_batchnorm(_load_model(name)).eval()
+    checkpoint = str(directory / f'{name}.pth')
+    torch.save(model.state_dict(), checkpoint)
+    paths[name] = (checkpoint, export_onnx(name, str(directory / f'{name}.onnx'), checkpoint, resolution=64))
+  return paths
+
+
+@pytest.mark.parametrize('name', MODELS)
+@pytest.mark.parametrize('batch_size', [1, 3])
+@pytest.mark.parametrize('resolution', [96, 160])
+def test_runner_matches_eager(exported, name, batch_size, resolution):
+  checkpoint, path = exported[name]
+  model = _load_model(name, checkpoint)
+  torch.manual_seed(1)
+  inputs = make_inputs(name, batch_size, resolution)
+  with torch.no_grad():
+    expected = model(*inputs).numpy()
+  output = OnnxRunner(path, threads=1)(*[x.numpy() for x in inputs])
+  assert output.shape == expected.shape
+  torch.testing.assert_close(torch.from_numpy(output), torch.from_numpy(expected), rtol=1e-4, atol=1e-5)
@@ -0,0 +1,54 @@
+'''
+Pareto front of the latency / quality table and the fastest checkpoint above a quality level, on hand written rows :
+dominated, tied and single checkpoints, higher (psnr) and lower (hole_l1) is better metrics.
+
+  python -m pytest tests/test_pareto.py
+'''
+
+import pytest
+
+from artwork_inpainting.pareto import fastest_above, pareto_front
+
+
+def _rows(*points, metric='psnr'):
+  return [{'model':f'm{i}', 'latency_ms':latency, metric:quality} for i, (latency, quality) in enumerate(points)]
+
+
+@pytest.mark.parametrize('points, metric, expected', [
+  # single checkpoint
+  ([(10, 28.0)], 'psnr', [True]),
+  # slower and worse is dominated, slower and better is not
+  ([(10, 28.0), (20, 27.0), (30, 29.0)], 'psnr', [True, False, True]),
+  # a dominated point between two front points
+  ([(10, 26.0), (15, 25.0), (20, 30.0), (25, 29.0)], 'psnr', [True, False, True, False]),
+  # exact ties : neither is strictly better, both stay on the front
+  ([(10, 28.0), (10, 28.0)], 'psnr', [True, True]),
+  # same latency : the better quality dominates, same quality : the faster dominates
+  ([(10, 28.0), (10, 27.0)], 'psnr', [True, False]),
+  ([(10, 28.0), (12, 28.0)], 'psnr', [True, False]),
+  # lower is better
+  ([(10, 0.05), (20, 0.06), (30, 0.04)], 'hole_l1', [True, False, True]),
+  ([(10, 0.05), (10, 0.04)], 'hole_l1', [False, True]),
+])
+def test_pareto_front(points, metric, expected):
+  rows = pareto_front(_rows(*points, metric=metric), metric)
+  assert [row['pareto'] for row in rows] == expected
+
+
+def test_pareto_front_of_no_rows():
+  assert pareto_front([]) == []
+
+
+@pytest.mark.parametrize('points, metric, min_quality, expected', [
+  ([(10, 28.0)], 'psnr', 28.0, 'm0'), # the level is inclusive
+  ([(10, 28.0)], 'psnr', 28.5, None),
+  ([(30, 31.0), (10, 26.0), (20, 29.0)], 'psnr', 28.0, 'm2'),
+  ([(30, 31.0), (10, 26.0), (20, 29.0)], 'psnr', 20.0, 'm1'),
+  ([(20, 29.0), (20, 30.0)], 'psnr', 28.0, 'm0'), # latency tie : the first one
+  ([(10, 0.05), (20, 0.03), (30, 0.02)], 'hole_l1', 0.03, 'm1'), # at most for hole_l1
+  ([(10, 0.05), (20, 0.03)], 'hole_l1', 0.01, None),
+  ([], 'psnr', 0.0, None),
+])
+def test_fastest_above(points, metric, min_quality, expected):
+  best = fastest_above(_rows(*points, metric=metric), min_quality, metric)
+  assert (best and best['model']) == expected
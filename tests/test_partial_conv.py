@@ -0,0 +1,100 @@
+'''
+PartialConv of the partial convolution script against the former layer (pconv_benchmark.LegacyPartialConv, the
+all-ones mask_conv implementation) : outputs and new masks, on masks whose channels differ, and loading of checkpoints
+saved with mask_conv.
+
+  python -m pytest tests/test_partial_conv.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from artwork_inpainting.loader import build_model, load_script, make_inputs
+from artwork_inpainting.pconv_benchmark import LegacyPartialConv, legacy_model
+
+# (in_channels, out_channels, kernel_size, stride, padding) of the layers compared
+LAYERS = [(3, 8, 3, 1, 'same'), (8, 16, 5, 1, 'same'), (4, 6, 3, 2, 1), (6, 4, 4, 2, 1)]
+
+
+def channel_masks(batch_size, channels, size, seed=0):
+  '''
+  Binary masks with a different random mask per channel and a square hole in every channel, so some windows have valid
+  pixels in only some channels and some have none at all.
+  '''
+  generator = torch.Generator().manual_seed(seed)
+  mask = (torch.rand(batch_size, channels, size, size, generator=generator) > 0.5).float()
+  mask[:, :, size // 4:size // 2, size // 4:size // 2] = 0
+  return mask
+
+
+def layer_pair(in_channels, out_channels, kernel_size, stride, padding):
+  torch.manual_seed(0)
+  layer = load_script('pconv').PartialConv(in_channels, out_channels, kernel_size, stride, padding)
+  return layer, LegacyPartialConv(layer.input_conv)
+
+
+@pytest.mark.parametrize('in_channels, out_channels, kernel_size, stride, padding', LAYERS)
+def test_output_and_mask_match_legacy(in_channels, out_channels, kernel_size, stride, padding):
+  layer, legacy = layer_pair(in_channels, out_channels, kernel_size, stride, padding)
+  input = torch.randn(2, in_channels, 32, 32)
+  mask = channel_masks(2, in_channels, 32)
+
+  with torch.no_grad():
+    output, new_mask = layer(input, mask)
+    expected, expected_mask = legacy(input, mask)
+
+  assert (expected_mask == 0).any() and (expected_mask == 1).any()
+  assert torch.equal(new_mask.expand_as(expected_mask), expected_mask)
+  torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_legacy_checkpoint_loads():
+  torch.manual_seed(0)
+  legacy = legacy_model(build_model('pconv_unet')).eval()
+  state_dict = legacy.state_dict()
+  assert any(key.endswith('mask_conv.weight') for key in state_dict)
+
+  model = build_model('pconv_unet')
+  model.load_state_dict(state_dict) # strict : mask_conv.weight is dropped, nothing else is missing
+  model.eval()
+  input, mask = make_inputs('pconv_unet', 2, 64)
+  with torch.no_grad():
+    torch.testing.assert_close(model(input, mask), legacy(input, mask), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('in_channels, out_channels, kernel_size, stride, padding', LAYERS)
+@pytest.mark.parametrize('recompute', [False, True])
+def test_gradients_match_legacy(in_channels, out_channels, kernel_size, stride, padding, recompute):
+  layer, legacy = layer_pair(in_channels, out_channels, kernel_size, stride, padding)
+  layer.recompute_masked_input = recompute
+  input = torch.randn(2, in_channels, 32, 32)
+  mask = channel_masks(2, in_channels, 32)
+
+  results = []
+  for module in [layer, legacy]:
+    module.zero_grad(set_to_none=True)
+    x = input.clone().requires_grad_(True)
+    output, new_mask = module(x, mask)
+    # non uniform upstream gradient, the windows without valid pixels included
+    (output * torch.linspace(-1, 1, output.numel()).view_as(output)).sum().backward()
+    results.append((output.detach(), new_mask, x.grad, layer.input_conv.weight.grad.clone(),
+                    layer.input_conv.bias.grad.clone()))
+
+  (output, new_mask, *grads), (expected, expected_mask, *expected_grads) = results
+  torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-6)
+  assert torch.equal(new_mask.expand_as(expected_mask), expected_mask)
+  for grad, expected_grad in zip(grads, expected_grads):
+    torch.testing.assert_close(grad, expected_grad, rtol=1e-5, atol=1e-5)
+
+
+def test_recompute_is_used_while_training():
+  layer, _ = layer_pair(3, 8, 3, 1, 'same')
+  layer.recompute_masked_input = True
+  output, _ = layer(torch.randn(1, 3, 16, 16, requires_grad=True), channel_masks(1, 3, 16))
+  nodes, seen = [output.grad_fn], set()
+  while nodes:
+    node = nodes.pop()
+    seen.add(type(node).__name__)
+    nodes += [next_node for next_node, _ in node.next_functions if next_node is not None]
+  assert 'MaskedConv2dFunctionBackward' in seen
@@ -0,0 +1,89 @@
+'''
+Structured channel pruning : the channel counts of pruning_plan(), the forward of the rebuilt models, eval mode outputs
+through the save_pruned / load_pruned round trip and the MAC reduction.
+
+  python -m pytest tests/test_prune.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch import nn
+
+from artwork_inpainting.fold_bn import randomize_batchnorm
+from artwork_inpainting.loader import build_model, make_inputs
+from artwork_inpainting.prune import apply_plan, conv_macs, load_pruned, pruning_plan, save_pruned
+
+MODELS = ['pconv_unet', 'unet', 'unet_inception']
+
+
+def _pruned(name, amount=0.5):
+  torch.manual_seed(0)
+  model = randomize_batchnorm(build_model(name)).eval()
+  plan = pruning_plan(model, amount, amount)
+  return model, plan
+
+
+def _inputs(name):
+  torch.manual_seed(1)
+  return make_inputs(name, 2, 64)
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_plan_channel_counts(name):
+  model, plan = _pruned(name)
+  modules = dict(model.named_modules())
+  assert plan
+  for path, kept in plan.items():
+    module = modules[path]
+    if 'out' in kept:
+      out_channels = module.num_features if isinstance(module, nn.BatchNorm2d) else module.out_channels
+      assert kept['out'] == sorted(set(kept['out'])) and max(kept['out']) < out_channels
+    if 'in' in kept:
+      assert kept['in'] == sorted(set(kept['in'])) and max(kept['in']) < module.in_channels
+
+  # every group keeps half of its channels, the reader of a group keeps the same ones as its producer
+  for path, kept in plan.items():
+    if isinstance(modules[path], nn.BatchNorm2d):
+      assert len(kept['out']) == round(modules[path].num_features / 2)
+  if name == 'pconv_unet':
+    outputs = [plan[f'encoder.inception_module_3.{branch}']['out'] for branch in
+               ['channel_1', 'channel_2.1', 'channel_3.1', 'channel_4.1']]
+    assert len(plan['decoder.up_transpose1']['in']) == sum(len(kept) for kept in outputs)
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_pruned_forward_shape(name):
+  model, plan = _pruned(name)
+  inputs = _inputs(name)
+  with torch.no_grad():
+    expected = model(*inputs)
+    output = apply_plan(model, plan)(*inputs)
+  assert output.shape == expected.shape
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_eval_outputs_round_trip(name, tmp_path):
+  model, plan = _pruned(name)
+  pruned = apply_plan(model, plan)
+  assert not any(m.training for m in pruned.modules())
+
+  inputs = _inputs(name)
+  with torch.no_grad():
+    output = pruned(*inputs)
+    torch.testing.assert_close(pruned(*inputs), output, rtol=0, atol=0) # the running statistics are left alone
+  save_pruned(pruned, plan, tmp_path / 'pruned.pth')
+  loaded = load_pruned(tmp_path / 'pruned.pth', name).eval()
+  with torch.no_grad():
+    torch.testing.assert_close(loaded(*inputs), output, rtol=0, atol=0)
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_macs_drop(name):
+  model, plan = _pruned(name)
+  inputs = _inputs(name)
+  before = conv_macs(model, inputs)
+  after = conv_macs(apply_plan(model, plan), inputs)
+  # half of the channels of every group, both sides of a pruned 3x3 / 5x5 convolution for the inception branches
+  assert after < 0.8 * before
@@ -0,0 +1,63 @@
+'''
+pyramid_inpaint with a stub identity model : build_pyramid levels and their coarse masks, the result (valid pixels
+kept, holes filled with what the model returns), the refined band of every level and the model cost against flat
+tiling (tiled_cost, checked against the pixels tiled_inpaint actually sends through the model, the tiles without
+holes being skipped).
+
+  python -m pytest tests/test_pyramid_inference.py
+'''
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+
+from artwork_inpainting.inference import (_CountingModel, build_pyramid, pyramid_inpaint, tiled_cost,
+                                          tiled_inpaint)
+
+
+def _scan(height, width, seed=0):
+  # an image with a few rectangular holes, a large one and thin cracks
+  rng = np.random.RandomState(seed)
+  image = rng.rand(height, width, 3).astype(np.float32)
+  mask = np.ones((height, width), dtype=bool)
+  mask[100:260, 150:330] = False
+  mask[400:404, 20:500] = False
+  mask[30:500, 600:603] = False
+  return image, mask
+
+
+def test_build_pyramid_levels():
+  image, mask = _scan(512, 768)
+  levels = build_pyramid(image, mask, tile=128, scale=2)
+  assert [valid.shape for _, valid in levels] == [(64, 96), (128, 192), (256, 384), (512, 768)]
+  np.testing.assert_array_equal(levels[-1][0], image)
+  np.testing.assert_array_equal(levels[-1][1], mask)
+  for (_, coarse), (_, fine) in zip(levels, levels[1:]):
+    # a coarse pixel is valid only if the 2x2 pixels it covers are
+    blocks = fine.reshape(coarse.shape[0], 2, coarse.shape[1], 2).all(axis=(1, 3))
+    np.testing.assert_array_equal(coarse, blocks)
+
+
+def test_identity_model_keeps_valid_pixels(identity_model):
+  image, mask = _scan(512, 768)
+  result, stats = pyramid_inpaint(identity_model, image, mask, tile=128, overlap=32, band=16, batch_size=4)
+  np.testing.assert_array_equal(result[mask], image[mask])
+  np.testing.assert_allclose(result[~mask], 1.0, rtol=0, atol=1e-6)
+  assert [(level['height'], level['width']) for level in stats] == [(64, 96), (128, 192), (256, 384), (512, 768)]
+
+
+def test_refined_band_and_cost(identity_model):
+  import torch
+  import torch.nn.functional as F
+
+  image, mask = _scan(512, 768)
+  band = 16
+  _, stats = pyramid_inpaint(identity_model, image, mask, tile=128, overlap=32, band=band, batch_size=4)
+  near_valid = F.max_pool2d(torch.from_numpy(mask[None, None].astype(np.float32)), 2 * band + 1, 1, band)[0, 0]
+  assert stats[-1]['refined_pixels'] == int((~mask & (near_valid.numpy() > 0)).sum())
+  assert stats[0]['refined_pixels'] == int((~build_pyramid(image, mask, 128, 2)[0][1]).sum())
+
+  counter = _CountingModel(identity_model)
+  tiled_inpaint(counter, image, mask, tile=128, overlap=32, batch_size=4)
+  assert counter.pixels == tiled_cost(512, 768, 128, 32, mask) < tiled_cost(512, 768, 128, 32)
@@ -0,0 +1,78 @@
+'''
+INT8 quantization : every quantized unit and the whole quantized model against the float ones on random masked
+images, and the transposed convolutions kept float with the backends whose int8 kernel for them is wrong.
+
+  python -m pytest tests/test_quantize.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch import nn
+from torch.ao import quantization as tq
+
+from artwork_inpainting import quantize
+from artwork_inpainting.loader import build_model
+
+
+def _masked_images(n, resolution=64, seed=0):
+  generator = torch.Generator().manual_seed(seed)
+  gt = torch.rand(n, 3, resolution, resolution, generator=generator)
+  mask = torch.ones(n, 3, resolution, resolution)
+  for i in range(n):
+    y, x = torch.randint(0, resolution // 2, (2,), generator=generator).tolist()
+    mask[i, :, y:y + resolution // 3, x:x + resolution // 3] = 0
+  return torch.where(mask.bool(), gt, 1.0), mask
+
+
+@torch.no_grad()
+def _convert(name, model):
+  prepared = quantize.prepare_quantization(model, [], quantize.CONFIG['backend'])
+  image, mask = _masked_images(8, seed=1)
+  prepared(*quantize._model_inputs(name, image, mask))
+  return tq.convert(prepared, inplace=True)
+
+
+@pytest.mark.parametrize('name', ['unet', 'pconv_unet'])
+def test_int8_close_to_float(name):
+  torch.manual_seed(0)
+  model = build_model(name).eval()
+  int8_model = _convert(name, model)
+
+  image, mask = _masked_images(4)
+  with torch.no_grad():
+    expected = model(*quantize._model_inputs(name, image, mask))
+    output = int8_model(*quantize._model_inputs(name, image, mask))
+  error = torch.mean(torch.abs(output - expected)) / torch.mean(torch.abs(expected))
+  assert error < 0.1, f'int8 output off by {error:.3f} of the float output'
+
+
+@pytest.mark.parametrize('name', ['unet', 'pconv_unet'])
+def test_int8_units_close_to_float(name):
+  torch.manual_seed(0)
+  model = build_model(name).eval()
+  int8_model = _convert(name, model)
+  float_model = quantize.fold_batchnorm(model)
+  units = [path for path, m in int8_model.named_modules() if isinstance(m, tq.QuantWrapper)]
+
+  inputs = {}
+  hooks = [float_model.get_submodule(unit).register_forward_pre_hook(
+             lambda module, args, unit=unit: inputs.setdefault(unit, args[0])) for unit in units]
+  image, mask = _masked_images(4)
+  with torch.no_grad():
+    float_model(*quantize._model_inputs(name, image, mask))
+    for hook in hooks:
+      hook.remove()
+    for unit, x in inputs.items():
+      expected = float_model.get_submodule(unit)(x)
+      error = torch.mean(torch.abs(int8_model.get_submodule(unit)(x) - expected)) / torch.mean(torch.abs(expected))
+      assert error < 0.05, f'{unit} : int8 output off by {error:.3f} of the float output'
+
+
+def test_transpose_convolutions_stay_float():
+  if quantize.CONFIG['backend'] not in quantize._FLOAT_TRANSPOSE_BACKENDS:
+    pytest.skip('the transposed convolutions are quantized with this backend')
+  int8_model = _convert('pconv_unet', build_model('pconv_unet').eval())
+  transposes = [path for path, m in int8_model.named_modules() if isinstance(m, nn.ConvTranspose2d)]
+  assert transposes == ['decoder.up_transpose1', 'decoder.up_transpose2', 'decoder.up_transpose3']
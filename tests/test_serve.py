@@ -0,0 +1,144 @@
+'''
+Dynamic batching of the inpainting service, with a stub model recording its batch sizes : concurrent requests sent
+over localhost HTTP are answered from one batch, requests further apart than max_delay_ms are not batched together,
+batches stop at max_batch_size and the queue depth / batch size metrics follow the requests.
+
+  python -m pytest tests/test_serve.py
+'''
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from artwork_inpainting.load_test import _client, get_metrics
+from artwork_inpainting.serve import DynamicBatcher, encode_arrays, make_handler
+
+
+class GatedModel:
+  '''
+  Stub inpainting model predicting 0.5 everywhere, after `gate` is set.
+  '''
+  def __init__(self):
+    self.gate = threading.Event()
+    self.gate.set()
+    self.batch_sizes = []
+
+  def __call__(self, image, mask):
+    self.gate.wait()
+    self.batch_sizes.append(len(image))
+    return image * 0 + 0.5
+
+
+def _request(seed, size=32):
+  rng = np.random.default_rng(seed)
+  image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+  mask = np.ones((size, size), dtype=bool)
+  mask[4:12, 8:20] = False
+  return image, mask
+
+
+def _wait_for(condition, timeout=10):
+  end = time.perf_counter() + timeout
+  while not condition():
+    assert time.perf_counter() < end, 'timed out'
+    time.sleep(0.005)
+
+
+@pytest.fixture
+def server():
+  model = GatedModel()
+  batcher = DynamicBatcher(model, 'image_mask', max_batch_size=16, max_delay_ms=500, workers=1, threads=1)
+  httpd = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(batcher))
+  httpd.daemon_threads = True
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield model, httpd.server_address[1]
+  httpd.shutdown()
+  httpd.server_close()
+  batcher.close()
+
+
+def test_concurrent_requests_share_a_batch(server):
+  model, port = server
+  payloads = [encode_arrays(image=image, mask=mask) for image, mask in map(_request, range(6))]
+  with ThreadPoolExecutor(6) as pool:
+    results = list(pool.map(_client, ['127.0.0.1'] * 6, [port] * 6, [payloads] * 6, [1] * 6, range(6)))
+  assert all(len(latencies) == 1 and errors == 0 for latencies, errors in results)
+  # the 6 requests arrive within max_delay_ms of the first one
+  assert model.batch_sizes == [6]
+
+  metrics = get_metrics('127.0.0.1', port)
+  assert metrics['completed'] == 6 and metrics['batches'] == 1 and metrics['batch_sizes'] == {'6':1}
+  assert metrics['mean_batch_size'] == 6.0 and metrics['queue_depth'] == 0 and metrics['running'] == 0
+  assert metrics['latency_p50_ms'] > 0
+
+
+def test_only_holes_replaced():
+  batcher = DynamicBatcher(GatedModel(), 'image_mask', max_delay_ms=1, workers=1, threads=1)
+  try:
+    image, mask = _request(0, size=37) # padded to 48 for the model, cropped back
+    output = batcher.submit(image, mask).result(timeout=10)
+  finally:
+    batcher.close()
+  assert output.shape == image.shape and output.dtype == np.uint8
+  np.testing.assert_array_equal(output[mask], image[mask])
+  assert np.all(np.abs(output[~mask].astype(int) - 128) <= 1)
+
+
+def test_requests_beyond_the_delay_are_not_batched():
+  model = GatedModel()
+  batcher = DynamicBatcher(model, 'image_mask', max_delay_ms=50, workers=1, threads=1)
+  try:
+    start = time.perf_counter()
+    batcher.submit(*_request(0)).result(timeout=10)
+    assert time.perf_counter() - start >= 0.05 # a lone request waits max_delay_ms for company
+    time.sleep(0.1)
+    batcher.submit(*_request(1)).result(timeout=10)
+    assert model.batch_sizes == [1, 1]
+    assert batcher.metrics()['batch_sizes'] == {'1':2}
+  finally:
+    batcher.close()
+
+
+def test_max_batch_size_and_queue_depth():
+  model = GatedModel()
+  batcher = DynamicBatcher(model, 'image_mask', max_batch_size=2, max_delay_ms=20, workers=1, threads=1)
+  try:
+    model.gate.clear()
+    futures = [batcher.submit(*_request(0))]
+    _wait_for(lambda: batcher.metrics()['running'] == 1) # the only worker is busy
+    futures += [batcher.submit(*_request(i)) for i in range(1, 6)]
+    # collected in batches of at most 2 (the last one after max_delay_ms), none of them can start
+    _wait_for(lambda: batcher.metrics()['queue_depth'] == 5)
+    time.sleep(0.05)
+    metrics = batcher.metrics()
+    assert metrics['queue_depth'] == 5 and metrics['running'] == 1 and metrics['completed'] == 0
+
+    model.gate.set()
+    for future in futures:
+      future.result(timeout=10)
+    metrics = batcher.metrics()
+    assert max(model.batch_sizes) == 2 and sum(model.batch_sizes) == 6
+    assert metrics['queue_depth'] == 0 and metrics['running'] == 0 and metrics['completed'] == 6
+    assert metrics['batch_sizes'] == {str(k):model.batch_sizes.count(k) for k in sorted(set(model.batch_sizes))}
+  finally:
+    model.gate.set()
+    batcher.close()
+
+
+def test_sizes_are_batched_separately():
+  model = GatedModel()
+  batcher = DynamicBatcher(model, 'image_mask', max_delay_ms=200, workers=1, threads=1)
+  try:
+    futures = [batcher.submit(*_request(i, size)) for i, size in enumerate([32, 48, 32, 48, 32])]
+    outputs = [future.result(timeout=10) for future in futures]
+  finally:
+    batcher.close()
+  assert [o.shape[0] for o in outputs] == [32, 48, 32, 48, 32]
+  assert sorted(model.batch_sizes) == [2, 3]
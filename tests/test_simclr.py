@@ -0,0 +1,123 @@
+'''
+Contrastive pretraining of the SimCLR draft : infoNCE_loss against the cross entropy of the former dense
+(logits, labels) construction, for 2 and 3 views, with and without row chunks, the MoCo queue, loss and momentum
+update, and one training step of both contrastive modes.
+
+  python -m pytest tests/test_simclr.py
+'''
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import torch.nn.functional as F
+
+from artwork_inpainting.loader import load_script
+
+
+@pytest.fixture(scope='module')
+def script():
+  return load_script('simclr')
+
+
+def former_logits_labels(features, batch_size, n_views, temp):
+  '''
+  infoNCE_loss of the first draft : dense labels and eye mask, positives first, label 0.
+  '''
+  labels = torch.cat([torch.arange(batch_size) for i in range(n_views)], dim=0)
+  labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
+  features = F.normalize(features, dim=1)
+  similarity_matrix = torch.matmul(features, features.T)
+  mask = torch.eye(labels.shape[0], dtype=torch.bool)
+  labels = labels[~mask].view(labels.shape[0], -1)
+  similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
+  positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)
+  negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)
+  logits = torch.cat([positives, negatives], dim=1) / temp
+  return logits, torch.zeros(logits.shape[0], dtype=torch.long)
+
+
+@pytest.mark.parametrize('n_views', [2, 3])
+@pytest.mark.parametrize('chunk', [None, 5])
+def test_info_nce_matches_cross_entropy(script, n_views, chunk):
+  batch_size = 8
+  args = script.AttrDict(n_views=n_views, temp=0.07, loss_chunk_size=chunk)
+  torch.manual_seed(0)
+  features = torch.randn(n_views * batch_size, 16)
+
+  new_features = features.clone().requires_grad_(True)
+  loss = script.infoNCE_loss(args, new_features)
+  loss.backward()
+
+  old_features = features.clone().requires_grad_(True)
+  expected = F.cross_entropy(*former_logits_labels(old_features, batch_size, n_views, args.temp))
+  expected.backward()
+
+  torch.testing.assert_close(loss, expected, rtol=1e-5, atol=1e-6)
+  torch.testing.assert_close(new_features.grad, old_features.grad, rtol=1e-4, atol=1e-6)
+
+
+def test_positives_pair_the_views_of_an_image(script):
+  positives = script.info_nce_positives(4, 3, torch.device('cpu'))
+  # rows are view-major : row v * 4 + i is view v of image i
+  assert positives.tolist() == [4, 5, 6, 7, 0, 1, 2, 3, 0, 1, 2, 3]
+
+
+def test_incomplete_views_rejected(script):
+  args = script.AttrDict(n_views=3, temp=0.07, loss_chunk_size=None)
+  with pytest.raises(AssertionError, match='n_views=3'):
+    script.infoNCE_loss(args, torch.randn(8, 16))
+
+
+def _args(script, contrastive):
+  return script.AttrDict(gpu=False, model='SimCLR', learn_rate=1e-3, batch_size=4, n_views=2, temp=0.07,
+                         loss_chunk_size=None, contrastive=contrastive, queue_size=16, momentum=0.99, epochs=1,
+                         seed=0, experiment_name='test')
+
+
+@pytest.mark.parametrize('contrastive', ['simclr', 'moco'])
+def test_training_step(script, contrastive, tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path) # train_simCLR creates outputs/<experiment_name>
+  torch.manual_seed(0)
+  gen = script.SimCLR()
+  with torch.no_grad():
+    proj = gen([torch.rand(3, 3, 32, 32)])
+  assert proj.shape == (3, 256)
+
+  before = [p.detach().clone() for p in gen.parameters()]
+  data = torch.rand(8, 2, 3, 32, 32).numpy()
+  gen = script.train_simCLR(data, _args(script, contrastive), gen)
+  assert all(torch.isfinite(p).all() for p in gen.parameters())
+  assert any(not torch.equal(b, p) for b, p in zip(before, gen.parameters()))
+
+
+def test_queue_is_a_ring_buffer(script):
+  queue = script.ProjectionQueue(5, 2)
+  storage = queue.keys.data_ptr()
+  for start in range(0, 12, 3):
+    queue.enqueue(torch.arange(start, start + 3, dtype=torch.float32)[:, None].expand(-1, 2))
+  # 12 keys through a queue of 5 : the last 5 (7..11), written in place at positions 12 % 5 onwards
+  assert queue.keys.data_ptr() == storage and queue.ptr == 12 % 5
+  assert queue.keys[:, 0].tolist() == [10, 11, 7, 8, 9]
+
+
+def test_moco_loss_matches_cross_entropy(script):
+  torch.manual_seed(0)
+  queue = script.ProjectionQueue(32, 16)
+  query, key = torch.randn(6, 16, requires_grad=True), torch.randn(6, 16)
+  loss = script.moco_loss(query, key, queue, 0.2)
+
+  q, k = F.normalize(query, dim=1), F.normalize(key, dim=1)
+  logits = torch.cat([(q * k).sum(1, keepdim=True), q @ queue.keys.T], 1) / 0.2
+  torch.testing.assert_close(loss, F.cross_entropy(logits, torch.zeros(6, dtype=torch.long)))
+
+
+def test_momentum_update(script):
+  gen = torch.nn.Linear(3, 2)
+  key_gen = script.momentum_encoder(gen)
+  with torch.no_grad():
+    gen.weight.add_(1)
+  expected = 0.9 * key_gen.weight + 0.1 * gen.weight
+  script.momentum_update(gen, key_gen, 0.9)
+  torch.testing.assert_close(key_gen.weight, expected)
+  assert not key_gen.weight.requires_grad
@@ -0,0 +1,28 @@
+'''
+Lazy imports of the package : in a fresh interpreter, `import artwork_inpainting` imports none of the heavy modules
+(loader.LAZY_IMPORTS, nor torch), and getting to a model class or a built model imports torch but none of them beyond
+what `import torch` itself imports (torch.hub imports tqdm).
+
+  python -m pytest tests/test_startup.py
+'''
+
+import pytest
+
+from artwork_inpainting.loader import LAZY_IMPORTS
+from artwork_inpainting.startup_benchmark import STAGES, time_stage
+
+
+@pytest.mark.parametrize('stage', ['import', 'inpaint'])
+def test_import_is_light(stage):
+  modules = time_stage(*STAGES[stage])['modules']
+  assert not set(modules) & set(LAZY_IMPORTS)
+  assert 'torch' not in modules
+
+
+@pytest.mark.parametrize('stage', ['model', 'build'])
+def test_model_imports_only_torch(stage):
+  pytest.importorskip('torch')
+  modules = time_stage(*STAGES[stage])['modules']
+  assert 'torch' in modules
+  with_torch = time_stage('', 'import torch')['modules']
+  assert not (set(modules) - set(with_torch)) & set(LAZY_IMPORTS)
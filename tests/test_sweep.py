@@ -0,0 +1,79 @@
+'''
+Successive halving sweep : the trial grid, the rung budgets and the promotion of the best 1/eta trials, and a small
+sweep run end to end on the shared data fixture (spawned workers training a narrow PartialConvUNet), in which only the
+best trial of the first rung is trained further.
+
+  python -m pytest tests/test_sweep.py
+'''
+
+import os
+import re
+
+import pytest
+
+from artwork_inpainting.sweep import grid, promoted, rungs, validation_score
+
+
+def test_grid():
+  configs = grid({'lr':[1e-4, 5e-4], 'hole_coef':[6, 10, 14]})
+  assert len(configs) == 6 and configs[0] == {'hole_coef':6, 'lr':1e-4}
+  assert len({tuple(sorted(c.items())) for c in configs}) == 6
+  sample = grid({'lr':[1e-4, 5e-4], 'hole_coef':[6, 10, 14]}, n_trials=4)
+  assert len(sample) == 4 and all(c in configs for c in sample)
+  assert sample == grid({'lr':[1e-4, 5e-4], 'hole_coef':[6, 10, 14]}, n_trials=4) # seeded
+  assert grid({'lr':[1e-4]}, n_trials=10) == [{'lr':1e-4}]
+
+
+@pytest.mark.parametrize('min_epochs, max_epochs, eta, expected', [
+  (1, 9, 3, [1, 3, 9]),
+  (1, 10, 3, [1, 3, 9, 10]),
+  (1, 4, 2, [1, 2, 4]),
+  (2, 5, 3, [2, 5]),
+  (3, 3, 3, [3]),
+])
+def test_rungs(min_epochs, max_epochs, eta, expected):
+  assert rungs(min_epochs, max_epochs, eta) == expected
+
+
+@pytest.mark.parametrize('scores, eta, expected', [
+  ({0:0.3, 1:0.1, 2:0.2}, 3, [1]),
+  ({0:0.3, 1:0.1, 2:0.2, 3:0.05, 4:0.4, 5:0.25}, 3, [3, 1]),
+  ({0:0.3, 1:0.1, 2:0.2, 3:0.05}, 2, [3, 1]),
+  ({7:0.5}, 3, [7]), # the last trial always stays
+  ({0:0.2, 1:0.1}, 3, [1]), # fewer trials than eta : the best one
+  ({0:0.1, 1:0.1, 2:0.3}, 3, [0]), # ties : the first one
+])
+def test_promoted(scores, eta, expected):
+  assert promoted(scores, eta) == expected
+
+
+def test_validation_score():
+  losses = {'hole':1.0, 'valid':2.0, 'prc':0.5, 'style':0.25, 'tv':0.125}
+  assert validation_score(losses, 'hole') == 1.0
+  assert validation_score(losses, 'total') == 3.875
+
+
+def test_successive_halving_run(shared_data, vgg_weights, tmp_path, capsys):
+  pytest.importorskip('torch')
+  from artwork_inpainting.sweep import run_sweep
+
+  # a narrow model, 3 batches of 4 images per epoch and a 4 image fast validation set
+  base = {'down_conv_out':[8, 16, 32, 64], 'up_conv_out':[32, 16, 8], 'batch_size_train':4, 'batch_size_eval':4,
+          'fast_val_images':4, 'fast_val_batch_size':4, 'vgg_weights_path':vgg_weights, 'device':'cpu'}
+  configs = [{**base, 'lr':lr} for lr in [1e-2, 1e-3, 0.0]]
+  out_dir = str(tmp_path / 'sweep')
+  rows = run_sweep(configs, shared_data, out_dir, workers=1, min_epochs=1, max_epochs=3, eta=3)
+
+  first_rung = {int(trial):float(score) for trial, score in
+                re.findall(r'rung 0 trial (\d+) epochs 1 hole (\S+)', capsys.readouterr().out)}
+  assert sorted(first_rung) == [0, 1, 2]
+  best = min(first_rung, key=first_rung.get)
+
+  assert [row['trial'] for row in rows][0] == best # the rung 1 trial comes first
+  by_trial = {row['trial']:row for row in rows}
+  for trial, row in by_trial.items():
+    assert (row['rung'], row['epochs']) == ((1, 3) if trial == best else (0, 1))
+    assert row['lr'] == configs[trial]['lr'] and row['hole'] == row['val_hole']
+    assert os.path.exists(os.path.join(out_dir, f'trial_{trial}.pth'))
+  for trial in set(by_trial) - {best}:
+    assert by_trial[trial]['hole'] == pytest.approx(first_rung[trial], abs=1e-5) # printed with 5 decimals
@@ -0,0 +1,72 @@
+'''
+tiled_inpaint with a stub identity model : the banded accumulation, the flushing of finished rows by the writer thread,
+the reader thread and the feathered blending must give back the model input (exactly for uint8 outputs, to float32
+rounding of the blend otherwise), on images whose size is not a multiple of the tile stride, with the tiles without
+holes skipped when compositing. tile_positions and feather_window must give every pixel a non zero weight.
+
+  python -m pytest tests/test_tiled_inference.py
+'''
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from artwork_inpainting.inference import _CountingModel, feather_window, tile_positions, tiled_cost, tiled_inpaint
+
+# (height, width, tile, overlap), none of the sizes a multiple of tile - overlap
+SHAPES = [(301, 437, 128, 32), (200, 90, 64, 16), (50, 70, 128, 32), (129, 257, 128, 0), (517, 131, 96, 40)]
+
+
+def _image_mask(height, width, seed=0):
+  rng = np.random.RandomState(seed)
+  image = rng.rand(height, width, 3).astype(np.float32)
+  mask = rng.rand(height, width) > 0.2
+  return image, mask
+
+
+@pytest.mark.parametrize('height, width, tile, overlap', SHAPES)
+def test_positions_and_window_cover_every_pixel(height, width, tile, overlap):
+  window = feather_window(tile, overlap)
+  assert window.min() > 0
+  ys, xs = tile_positions(height, tile, overlap), tile_positions(width, tile, overlap)
+  assert ys[0] == 0 and xs[0] == 0
+  assert ys[-1] == max(height - tile, 0) and xs[-1] == max(width - tile, 0)
+
+  weights = np.zeros((max(height, tile), max(width, tile)), dtype=np.float32)
+  for y in ys:
+    for x in xs:
+      weights[y:y + tile, x:x + tile] += window
+  assert (weights[:height, :width] > 0).all()
+
+
+@pytest.mark.parametrize('height, width, tile, overlap', SHAPES)
+@pytest.mark.parametrize('inputs', ['image', 'image_mask'])
+def test_identity_model_reproduces_input(height, width, tile, overlap, inputs, identity_model):
+  pytest.importorskip('torch')
+  image, mask = _image_mask(height, width)
+  result = tiled_inpaint(identity_model, image, mask, inputs=inputs, tile=tile, overlap=overlap, batch_size=3,
+                         composite=False, prefetch=2)
+  np.testing.assert_allclose(result, np.where(mask[..., None], image, 1.0), rtol=0, atol=1e-6)
+
+
+def test_composite_uint8_output_in_place(identity_model):
+  pytest.importorskip('torch')
+  image, mask = _image_mask(301, 437)
+  image = (image * 255).astype(np.uint8)
+  output = np.zeros_like(image)
+  result = tiled_inpaint(identity_model, image, mask, tile=128, overlap=32, batch_size=5, output=output)
+  assert result is output
+  np.testing.assert_array_equal(output, np.where(mask[..., None], image, 255))
+
+
+def test_tiles_without_holes_are_skipped(identity_model):
+  pytest.importorskip('torch')
+  image, _ = _image_mask(301, 437)
+  mask = np.ones((301, 437), dtype=bool)
+  mask[200:230, 20:60] = False
+  mask[10:12, 300:437] = False
+  counter = _CountingModel(identity_model)
+  result = tiled_inpaint(counter, image, mask, tile=128, overlap=32, batch_size=3)
+  np.testing.assert_array_equal(result, np.where(mask[..., None], image, np.float32(1.0)))
+  # 2 tiles over the hole (two bands), 3 along the line in the top right corner, out of 3 x 5
+  assert counter.pixels == tiled_cost(301, 437, 128, 32, mask) == 5 * 128 * 128
@@ -7,6 +7,18 @@ Original file is located at
     https://colab.research.google.com/drive/1kWRBgCuuth5tahB9RCXK_s4Fyyp-sPj2
 """
 
+import os
+import copy
+import time
+import functools
+import torch
+import numpy as np
+from torch import nn
+import numpy.random as npr
+import torch.nn.functional as F
+from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
+
 #getting the latent features the unet model extracted from images for calculating contrastive loss
 def double_conv_layers(in_channels, out_channels, kernel_size, activation, padding=0, batch_norm=True):
 
@@ -42,15 +54,15 @@ class SimCLR(nn.Module):
             nn.Linear(256, 256)
         )
 
-    def forward(self, x, projection == True):
+    def forward(self, x, projection=True):
         x = torch.cat(x, dim=0)
         x = self.maxpool(self.down_conv1(x))
         x = self.maxpool(self.down_conv2(x))
         x = self.maxpool(self.down_conv3(x))
         x = self.down_conv4(x)
-        proj = self.projection(x)
         if projection==True:
-          return proj
+          # one 512 vector per image for the projection head, the contrastive losses compare (N, 256) rows
+          return self.projection(torch.flatten(F.adaptive_avg_pool2d(x, 1), 1))
         else:
           return x
 
@@ -85,34 +97,91 @@ class decoder(nn.Module):
 
 #device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def infoNCE_loss(args, features):
-
-    labels = torch.cat([torch.arange(args.batch_size) for i in range(args.n_views)], dim=0)
-    labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float() 
-    #labels = labels.to(self.args.device)
+# indices of the positive of every row, cached per (batch size, views, device) :
+# only 2N longs instead of the dense 2N x 2N labels and eye masks rebuilt at every call
+@functools.lru_cache(maxsize=None)
+def info_nce_positives(batch_size, n_views, device):
+    # rows are view-major (row v * batch_size + i is view v of image i, see train_simCLR),
+    # the positive of a row is the first other view of its image like the first column of
+    # the positives in the former boolean indexing : view 1 for view 0, view 0 otherwise
+    rows = torch.arange(batch_size * n_views, device=device)
+    return torch.where(rows < batch_size, rows + batch_size, rows % batch_size)
+
+def _info_nce_rows(features, positives, start, stop, temp):
+    # summed loss of rows [start, stop) : logsumexp over all the other rows minus the positive,
+    # the self similarity is removed by index (set to -inf) instead of a boolean mask
+    rows = torch.arange(start, stop, device=features.device)
+    logits = torch.matmul(features[start:stop], features.T) / temp
+    logits[rows - start, rows] = float('-inf')
+    positive_logits = (features[start:stop] * features[positives[start:stop]]).sum(1) / temp
+    return (torch.logsumexp(logits, dim=1) - positive_logits).sum()
 
+def infoNCE_loss(args, features):
+    '''
+    InfoNCE (NT-Xent) loss of a batch of n_views * batch_size projections, equal to the cross
+    entropy of the former (logits, labels) formulation : for every row, the first other view
+    of the same image against all the other rows.
+
+    args.temp : temperature
+    args.loss_chunk_size : if set, the similarity matrix is computed by blocks of this many rows,
+                           each recomputed in the backward pass (activation checkpointing), so
+                           the memory grows linearly with the batch size instead of quadratically
+    '''
     features = F.normalize(features, dim=1)
-
-    similarity_matrix = torch.matmul(features, features.T) 
-    
-    mask = torch.eye(labels.shape[0], dtype=torch.bool) #.to(args.device)
-    # ~mask is the negative of the mask
-
-    labels = labels[~mask].view(labels.shape[0], -1) 
-    similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1) 
-
-    # select and combine multiple positives
-    positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1) 
-
-    # select only the negatives
-    negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1) 
-
-    logits = torch.cat([positives, negatives], dim=1) 
-    labels = torch.zeros(logits.shape[0], dtype=torch.long) #.to(args.device)
-
-    logits = logits / args.temp
-
-    return logits, labels
+    n = features.shape[0]
+    assert n % args.n_views == 0, f'{n} projections are not n_views={args.n_views} views of the same images'
+    positives = info_nce_positives(n // args.n_views, args.n_views, features.device)
+    chunk = getattr(args, 'loss_chunk_size', None) or n
+
+    if chunk >= n:
+        total = _info_nce_rows(features, positives, 0, n, args.temp)
+    else:
+        total = sum(checkpoint(_info_nce_rows, features, positives, start, min(start + chunk, n), args.temp,
+                               use_reentrant=False)
+                    for start in range(0, n, chunk))
+    return total / n
+
+# MoCo style negatives : projections of past batches by a momentum copy of the encoder, kept in a
+# fixed size FIFO queue so every query sees queue_size negatives whatever the batch size
+class ProjectionQueue:
+    def __init__(self, size, dim, device=None):
+        # preallocated ring buffer, filled with random unit vectors until the first size keys arrive
+        self.keys = F.normalize(torch.randn(size, dim, device=device), dim=1)
+        self.ptr = 0
+
+    @torch.no_grad()
+    def enqueue(self, keys):
+        # overwrite the oldest rows in place, wrapping around the end of the buffer
+        keys = keys[-self.keys.shape[0]:]
+        rows = (self.ptr + torch.arange(keys.shape[0], device=self.keys.device)) % self.keys.shape[0]
+        self.keys.index_copy_(0, rows, keys.to(self.keys.dtype))
+        self.ptr = (self.ptr + keys.shape[0]) % self.keys.shape[0]
+
+def momentum_encoder(gen):
+    key_gen = copy.deepcopy(gen)
+    for p in key_gen.parameters():
+        p.requires_grad_(False)
+    return key_gen
+
+@torch.no_grad()
+def momentum_update(gen, key_gen, momentum):
+    # key = momentum * key + (1 - momentum) * query over all the parameters in one call, the
+    # batch norm statistics are copied
+    torch._foreach_lerp_(list(key_gen.parameters()), list(gen.parameters()), 1 - momentum)
+    for k, q in zip(key_gen.buffers(), gen.buffers()):
+        k.copy_(q)
+
+def moco_loss(query, key, queue, temp):
+    '''
+    InfoNCE of every query against its key (positive) and all the queue rows (negatives), the
+    cross entropy with the positive at index 0 without building the (N, 1 + K) logits : the
+    positive logit is log-added to the logsumexp of the (N, K) negatives.
+    '''
+    query = F.normalize(query, dim=1)
+    key = F.normalize(key, dim=1)
+    positive_logits = (query * key).sum(1) / temp
+    negative_logits = torch.matmul(query, queue.keys.T) / temp
+    return (torch.logaddexp(positive_logits, torch.logsumexp(negative_logits, dim=1)) - positive_logits).mean()
 
 #the data should be in the form of pairs (each with a different mask) of an image like 
 #[[image_mask1, image_mask2],[image1_mask1, image2_mask2]....]
@@ -147,7 +216,6 @@ def train_simCLR(train, args, gen=None):
         #gen = Net(args.kernel, args.num_filters)
         gen = Net()
 
-    criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(gen.parameters(), lr=args.learn_rate)
 
     # Create the outputs folder if not created already
@@ -157,6 +225,11 @@ def train_simCLR(train, args, gen=None):
     print("Beginning training ...")
     if args.gpu:
         gen.cuda()
+    moco = args.get('contrastive', 'simclr') == 'moco'
+    if moco:
+        key_gen = momentum_encoder(gen)
+        queue = ProjectionQueue(args.queue_size, gen.projection[-1].out_features,
+                                device='cuda' if args.gpu else None)
     start = time.time()
 
     for epoch in range(args.epochs):
@@ -165,12 +238,22 @@ def train_simCLR(train, args, gen=None):
         losses = []
         for i, imgs in enumerate(get_batch(train, args.batch_size)):
             imgs = get_torch_vars(imgs, args.gpu)
-            proj = gen([view for view in imgs])
-            logits, labels = infoNCE_loss(args, proj)
-            loss = criterion(logits, labels)
+            if moco:
+                # queries from the first view, keys from the second by the momentum encoder
+                query = gen([imgs[:, 0]])
+                with torch.no_grad():
+                    key = key_gen([imgs[:, 1]])
+                loss = moco_loss(query, key, queue, args.temp)
+            else:
+                # imgs is (batch, n_views, C, H, W), the views are concatenated view-major
+                proj = gen([imgs[:, v] for v in range(args.n_views)])
+                loss = infoNCE_loss(args, proj)
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
+            if moco:
+                momentum_update(gen, key_gen, args.momentum)
+                queue.enqueue(F.normalize(key, dim=1))
 
             losses.append(loss.item())
 
@@ -187,6 +270,12 @@ args_dict = {
     "model": "SimCLR",
     'learn_rate':0.001, 
     "batch_size": 64,
+    "n_views": 2,
+    "temp": 0.07,
+    "loss_chunk_size": None, # rows of the similarity matrix per block, None computes it at once
+    "contrastive": "simclr", # simclr (in batch negatives) or moco (momentum encoder and queue of negatives)
+    "queue_size": 4096,
+    "momentum": 0.999,
     "epochs": 50,
     "seed": 0,
     "plot": False,
@@ -195,7 +284,9 @@ args_dict = {
     "downsize_input": False,
 }
 args.update(args_dict)
-simCLR = train_simCLR(data, args)
+if __name__ == '__main__':
+    # data : (N, n_views, 3, H, W) array of the masked views, built in the notebook session
+    simCLR = train_simCLR(data, args)
 
 #the input data here should be in the form of pairs of three with masked images AND the original image?
 def train(train, args, simCLR, gen=None):
@@ -257,4 +348,6 @@ args_dict = {
     "downsize_input": False,
 }
 args.update(args_dict)
-simCLR = train_simCLR(data, args)
\ No newline at end of file
+if __name__ == '__main__':
+    # data : (N, n_views, 3, H, W) array of the masked views, built in the notebook session
+    simCLR = train_simCLR(data, args)
@@ -39,6 +39,8 @@ CONFIG = {'model_type':'Vanilla_UNet_small',
           'batch_size_eval':256,
           'coding_layer_activation':nn.Sigmoid,
           'kl_weights':0.01,
+          'merge_inception_projections':False, # InceptionModule : one 1x1 convolution for the channel_1..channel_3 projections
+          'channels_last':False, # train and evaluate the model in channels last memory format
           'device':"cuda" if torch.cuda.is_available() else 'cpu'}
 
 # seed everything for reproducibility 
@@ -50,6 +52,10 @@ def seed_everything(seed=42):
   torch.backends.cudnn.deterministic = True
   torch.backends.cudnn.benchmark = False
 
+def memory_format():
+  # layout of the model weights and of the batches, channels last (NHWC) lets oneDNN skip its layout reorders on cpu
+  return torch.channels_last if CONFIG['channels_last'] else torch.preserve_format
+
 seed_everything()
 
 def print_shape(verbose, to_print):
@@ -91,7 +97,7 @@ class InceptionModule(nn.Module):
   Create a layer of Inception Module which were introduced in GoogLeNet, it is termed as "Convolutional layer on Steroids" by Aurelian geron in his book
   'Hands on ml with scikit learn and tensorflow'
   '''
-  def __init__(self, input_channels, verbose=False):
+  def __init__(self, input_channels, verbose=False, merge_projections=CONFIG['merge_inception_projections']):
     super().__init__()
     
     self.verbose = verbose
@@ -112,14 +118,37 @@ class InceptionModule(nn.Module):
     
     self.channel_4 = nn.Sequential(nn.MaxPool2d(kernel_size=3, stride=1, padding=1),
                               nn.Conv2d(in_channels=input_channels, out_channels=out_channels[3], kernel_size=1, stride=1, padding='same'))
+
+    # merge_projections : the 1x1 convolutions of channel_1, channel_2 and channel_3 all read the input, compute them as
+    # one convolution whose output is split between the branches (checkpoints of both layouts load in both)
+    self.merge_projections = merge_projections
+    self.projection_split = [out_channels[0], out_channels[1], out_channels[2]]
+    if merge_projections:
+      self.projection = nn.Conv2d(in_channels=input_channels, out_channels=sum(self.projection_split), kernel_size=1)
+      self.channel_1 = nn.Identity()
+      self.channel_2[0] = nn.Identity()
+      self.channel_3[0] = nn.Identity()
+
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    names = [prefix + 'channel_1.', prefix + 'channel_2.0.', prefix + 'channel_3.0.']
+    if self.merge_projections and names[0] + 'weight' in state_dict:
+      for param in ['weight', 'bias']:
+        state_dict[prefix + 'projection.' + param] = torch.cat([state_dict.pop(name + param) for name in names], 0)
+    elif not self.merge_projections and prefix + 'projection.weight' in state_dict:
+      for param in ['weight', 'bias']:
+        split = torch.split(state_dict.pop(prefix + 'projection.' + param), self.projection_split, 0)
+        for name, value in zip(names, split):
+          state_dict[name + param] = value
+    super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
   def forward(self, input):
     print_shape(self.verbose, f'input shape : {input.shape}')
-    x1 = self.channel_1(input)
+    projected = torch.split(self.projection(input), self.projection_split, 1) if self.merge_projections else [input] * 3
+    x1 = self.channel_1(projected[0])
     print_shape(self.verbose, f'Channel 1 : {x1.shape}')
-    x2 = self.channel_2(input)
+    x2 = self.channel_2(projected[1])
     print_shape(self.verbose, f'Channel 2 : {x2.shape}')
-    x3 = self.channel_3(input)
+    x3 = self.channel_3(projected[2])
     print_shape(self.verbose, f'Channel 3 : {x3.shape}')
     x4 = self.channel_4(input)
     print_shape(self.verbose, f'Channel 4 : {x4.shape}')
@@ -407,8 +436,8 @@ def train_one_epoch(model, dataloader, epoch, masks, optimizer, criterion, spars
   for step, batch in bar:
     targets = batch[0].to(float)
     masked_inputs = get_masked_inputs(targets, masks)
-    masked_inputs = masked_inputs.to(device=CONFIG['device'], dtype=torch.float)
-    targets = torch.tensor(targets, requires_grad=True).to(device=CONFIG['device'], dtype=torch.float)
+    masked_inputs = masked_inputs.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+    targets = torch.tensor(targets, requires_grad=True).to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
     #print(masked_inputs.requires_grad, targets.requires_grad)
     if sparse_encoder:
       preds, encodings = model(masked_inputs)
@@ -452,8 +481,8 @@ def val_one_epoch(model, dataloader, epoch, masks, criterion, sparse_encoder=Fal
   for step, batch in bar:
     targets = batch[0].to(float)
     masked_inputs = get_masked_inputs(targets, masks)
-    masked_inputs = masked_inputs.to(device=CONFIG['device'], dtype=torch.float)
-    targets = targets.to(device=CONFIG['device'], dtype=torch.float)
+    masked_inputs = masked_inputs.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+    targets = targets.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
 
     if sparse_encoder:
       preds, encodings = model(masked_inputs)
@@ -484,8 +513,8 @@ def test_samples(model, samples, masks):
 
   targets = samples.to(float)
   masked_inputs = get_masked_inputs(targets, masks)
-  masked_inputs = masked_inputs.to(device=CONFIG['device'], dtype=torch.float)
-  targets = targets.to(device=CONFIG['device'], dtype=torch.float)
+  masked_inputs = masked_inputs.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
+  targets = targets.to(device=CONFIG['device'], dtype=torch.float, memory_format=memory_format())
 
   preds = model(masked_inputs)
 
@@ -504,7 +533,7 @@ model = UNet(down_conv_out=[16, 32, 64, 128],
              up_conv_activation=nn.ReLU,
              sparse_encoder=True,
              verbose=False,
-             ).to(device=CONFIG['device'])
+             ).to(device=CONFIG['device'], memory_format=memory_format())
 criterion = nn.MSELoss()
 optimizer = torch.optim.AdamW(model.parameters(), lr=CONFIG['lr'], weight_decay=CONFIG['weight_decay'])
 
@@ -525,7 +554,7 @@ for epoch in range(CONFIG['epochs']):
 
 torch.save(model.state_dict(), f'model.pth')
 
-model = UNet().to(device=CONFIG['device'])
+model = UNet().to(device=CONFIG['device'], memory_format=memory_format())
 model.load_state_dict(torch.load('/content/model.pth'))
 
 for batch in test_dataloader:
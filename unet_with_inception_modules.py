@@ -34,6 +34,7 @@ CONFIG = {'model_type':'Vanilla_UNet_big_bce',
           'coding_layer_activation':nn.Sigmoid,
           'kl_weights':0.01,
           'inception_out_multiplier':1.2, #times input channels count to get output channel count as inception module output
+          'merge_inception_projections':False, # InceptionModule : one 1x1 convolution for the channel_1..channel_3 projections
           'loss':nn.MSELoss(),
           'device':"cuda" if torch.cuda.is_available() else 'cpu'}
 
@@ -87,7 +88,7 @@ class InceptionModule(nn.Module):
   Create a layer of Inception Module which were introduced in GoogLeNet, it is termed as "Convolutional layer on Steroids" by Aurelian geron in his book
   'Hands on ml with scikit learn and tensorflow'
   '''
-  def __init__(self, input_channels, ratios={'c1':0.3, 'c2':0.35, 'c3':0.1, 'c4':0.25}, verbose=False, coding_layer=False):
+  def __init__(self, input_channels, ratios={'c1':0.3, 'c2':0.35, 'c3':0.1, 'c4':0.25}, verbose=False, coding_layer=False, merge_projections=CONFIG['merge_inception_projections']):
     super().__init__()
     
     self.verbose = verbose
@@ -130,14 +131,37 @@ class InceptionModule(nn.Module):
     
     self.channel_4 = nn.Sequential(nn.MaxPool2d(kernel_size=3, stride=1, padding=1),
                               nn.Conv2d(in_channels=input_channels, out_channels=c4_out, kernel_size=1, stride=1, padding='same'))
+
+    # merge_projections : the 1x1 convolutions of channel_1, channel_2 and channel_3 all read the input, compute them as
+    # one convolution whose output is split between the branches (checkpoints of both layouts load in both)
+    self.merge_projections = merge_projections
+    self.projection_split = [c1_out, c2_in, c3_in]
+    if merge_projections:
+      self.projection = nn.Conv2d(in_channels=input_channels, out_channels=sum(self.projection_split), kernel_size=1)
+      self.channel_1 = nn.Identity()
+      self.channel_2[0] = nn.Identity()
+      self.channel_3[0] = nn.Identity()
+
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    names = [prefix + 'channel_1.', prefix + 'channel_2.0.', prefix + 'channel_3.0.']
+    if self.merge_projections and names[0] + 'weight' in state_dict:
+      for param in ['weight', 'bias']:
+        state_dict[prefix + 'projection.' + param] = torch.cat([state_dict.pop(name + param) for name in names], 0)
+    elif not self.merge_projections and prefix + 'projection.weight' in state_dict:
+      for param in ['weight', 'bias']:
+        split = torch.split(state_dict.pop(prefix + 'projection.' + param), self.projection_split, 0)
+        for name, value in zip(names, split):
+          state_dict[name + param] = value
+    super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
   def forward(self, input):
     print_shape(self.verbose, f'input shape : {input.shape}')
-    x1 = self.channel_1(input)
+    projected = torch.split(self.projection(input), self.projection_split, 1) if self.merge_projections else [input] * 3
+    x1 = self.channel_1(projected[0])
     print_shape(self.verbose, f'Channel 1 : {x1.shape}')
-    x2 = self.channel_2(input)
+    x2 = self.channel_2(projected[1])
     print_shape(self.verbose, f'Channel 2 : {x2.shape}')
-    x3 = self.channel_3(input)
+    x3 = self.channel_3(projected[2])
     print_shape(self.verbose, f'Channel 3 : {x3.shape}')
     x4 = self.channel_4(input)
     print_shape(self.verbose, f'Channel 4 : {x4.shape}')